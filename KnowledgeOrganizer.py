@@ -1,20 +1,137 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-import json
-import datetime
-from collections import defaultdict
-import random
+import queue
+import threading
 import webbrowser
+from knowledge_core import (KnowledgeBase, Metrics, NoteArchiveReader, NoteArchiveWriter, Profiler, SearchWorker,
+                            instrumented, validate_note_record)
 
-class SpacedRepetitionCalculator:
-    """Implements a simple spaced repetition algorithm"""
-    def __init__(self):
-        self.intervals = [1, 3, 7, 14, 30, 60]  # Days between reviews
-    
-    def next_review_date(self, current_streak):
-        if current_streak >= len(self.intervals):
-            return datetime.date.today() + datetime.timedelta(days=self.intervals[-1])
-        return datetime.date.today() + datetime.timedelta(days=self.intervals[current_streak])
+MAX_SORTED_RESULTS = 100000  # Larger result lists are shown in their original order only
+
+class VirtualResultList:
+    """Treeview that only holds the rows scrolled into view, pulling rows from an iterator as needed"""
+    def __init__(self, master, columns, rows, on_open, total=None, sort_rows=None, visible_rows=25, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.on_open = on_open
+        self.sort_rows = sort_rows
+        self.visible_rows = visible_rows
+        self.sort_state = (None, False)
+        
+        self.frame = ttk.Frame(master)
+        self.tree = ttk.Treeview(self.frame, columns=[name for name, _ in columns], show='headings',
+                                 height=visible_rows, selectmode='browse')
+        for i, (name, width) in enumerate(columns):
+            self.tree.heading(name, text=name, command=(lambda i=i: self.sort(i)) if sort_rows else '')
+            self.tree.column(name, width=width)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scrollbar)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        self.tree.bind('<Double-1>', lambda e: self.open_selected())
+        self.tree.bind('<Return>', lambda e: self.open_selected())
+        self.tree.bind('<Up>', lambda e: self.move_selection(-1))
+        self.tree.bind('<Down>', lambda e: self.move_selection(1))
+        self.tree.bind('<Prior>', lambda e: self.move_selection(-visible_rows))
+        self.tree.bind('<Next>', lambda e: self.move_selection(visible_rows))
+        self.tree.bind('<MouseWheel>', lambda e: self.scroll_to(self.offset - 3 * (e.delta // 120 or (1 if e.delta > 0 else -1))))
+        self.tree.bind('<Button-4>', lambda e: self.scroll_to(self.offset - 3))
+        self.tree.bind('<Button-5>', lambda e: self.scroll_to(self.offset + 3))
+        
+        self.set_rows(rows, total)
+        
+    def set_rows(self, rows, total=None):
+        """Show a new row source of (note_id, values) pairs; total sizes the scrollbar if known"""
+        self.source = iter(rows)
+        self.fetched = []
+        self.exhausted = False
+        self.total = total
+        self.offset = 0
+        self.selected = None
+        self.scroll_to(0)
+        
+    def fetch_until(self, count):
+        while len(self.fetched) < count and not self.exhausted:
+            try:
+                self.fetched.append(next(self.source))
+            except StopIteration:
+                self.exhausted = True
+                
+    def row_count(self):
+        if self.total is not None:
+            return self.total
+        # Until the source runs dry, assume there is at least one more screenful
+        return len(self.fetched) + (0 if self.exhausted else self.visible_rows)
+        
+    @instrumented('gui.result_rows')
+    def scroll_to(self, offset):
+        self.fetch_until(max(offset, 0) + self.visible_rows)
+        self.offset = max(0, min(offset, len(self.fetched) - self.visible_rows))
+        
+        self.tree.delete(*self.tree.get_children())
+        for note_id, values in self.fetched[self.offset:self.offset + self.visible_rows]:
+            self.tree.insert('', tk.END, iid=str(note_id), values=values)
+        if self.selected is not None and self.tree.exists(str(self.selected)):
+            self.tree.selection_set(str(self.selected))
+            self.tree.focus(str(self.selected))
+            
+        count = max(self.row_count(), 1)
+        self.scrollbar.set(self.offset / count, min(1.0, (self.offset + self.visible_rows) / count))
+        return 'break'
+        
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * self.row_count()))
+        else:
+            step = self.visible_rows if unit == 'pages' else 1
+            self.scroll_to(self.offset + int(amount) * step)
+            
+    def move_selection(self, step):
+        visible = self.tree.get_children()
+        if not visible:
+            return 'break'
+        focus = self.tree.focus()
+        index = self.offset + visible.index(focus) + step if focus in visible else self.offset
+        
+        self.fetch_until(index + 1)
+        index = max(0, min(index, len(self.fetched) - 1))
+        self.selected = self.fetched[index][0]
+        if index < self.offset:
+            self.scroll_to(index)
+        elif index >= self.offset + self.visible_rows:
+            self.scroll_to(index - self.visible_rows + 1)
+        else:
+            self.tree.selection_set(str(self.selected))
+            self.tree.focus(str(self.selected))
+        return 'break'
+        
+    def open_selected(self):
+        item = self.tree.focus()
+        if item:
+            self.on_open(int(item))
+            
+    def sort(self, column):
+        column_sorted, descending = self.sort_state
+        descending = not descending if column_sorted == column else False
+        self.sort_state = (column, descending)
+        self.set_rows(self.sort_rows(column, descending), self.total)
+
+class ProgressWindow:
+    """Small window showing the progress of a long-running import or export"""
+    def __init__(self, root, title):
+        self.window = tk.Toplevel(root)
+        self.window.title(title)
+        self.window.geometry("400x100")
+        self.label = ttk.Label(self.window, text="")
+        self.label.pack(pady=10)
+        self.bar = ttk.Progressbar(self.window, maximum=100, length=360)
+        self.bar.pack(padx=20)
+        
+    def update(self, fraction, text):
+        self.bar['value'] = 100 * fraction
+        self.label.config(text=text)
+        
+    def close(self):
+        self.window.destroy()
 
 class KnowledgeOrganizer:
     def __init__(self, root):
@@ -22,20 +139,33 @@ class KnowledgeOrganizer:
         self.root.title("Personal Knowledge Organizer")
         self.root.geometry("1000x700")
         
-        # Initialize data structures
-        self.notes = []
-        self.tags = set()
-        self.note_id_counter = 1
-        self.spaced_rep = SpacedRepetitionCalculator()
-        
         # Load previous data if available
+        self.pending_reads = {}  # token -> callback of reads waiting for the queued writes
         self.load_data()
+        self.check_storage_errors()
+        
+        # Searches run on a worker thread; typing waits for a short pause before searching
+        self.search_worker = SearchWorker(self.metrics)
+        self.profiler = Profiler()
+        self.search_after = None
+        self.search_request = None  # (generation, open results window) of the search being waited for
+        self.live_query = ''
+        self.review_session = None
+        self.review_views = {}  # note id -> prepared view of upcoming review session cards
         
         # Create GUI
         self.create_widgets()
         
-        # Display initial note
-        self.display_random_note_for_review()
+        # Display initial note, or the next card of a review session the last run left unfinished
+        self.review_session = self.kb.review_session(start=False)
+        if self.review_session:
+            self.show_session_card()
+        else:
+            self.display_random_note_for_review()
+        
+        # Other instances may be writing to sharded storage; their changes are taken in every few seconds
+        if self.kb.storage.shared:
+            self.root.after(2000, self.refresh_shared_notes)
         
     def create_widgets(self):
         # Main frames
@@ -54,25 +184,38 @@ class KnowledgeOrganizer:
         
         ttk.Button(review_frame, text="Show Random Note", command=self.display_random_note_for_review).pack(fill=tk.X)
         ttk.Button(review_frame, text="Today's Review Notes", command=self.show_todays_review_notes).pack(fill=tk.X, pady=5)
+        ttk.Button(review_frame, text="Start Review Session", command=self.start_review_session).pack(fill=tk.X)
+        self.session_status = ttk.Label(review_frame, text="")
+        self.session_status.pack()
         
         # Search section
         search_frame = ttk.LabelFrame(self.left_frame, text="Search")
         search_frame.pack(fill=tk.X, padx=5, pady=5)
         
-        self.search_entry = ttk.Entry(search_frame)
+        # Its drop-down offers completions of the word being typed
+        self.search_entry = ttk.Combobox(search_frame)
         self.search_entry.pack(fill=tk.X, padx=5, pady=5)
         self.search_entry.bind('<Return>', lambda e: self.search_notes())
+        self.search_entry.bind('<KeyRelease>', lambda e: self.schedule_search())
+        self.search_entry.bind('<<ComboboxSelected>>', lambda e: self.run_search())
         
         ttk.Button(search_frame, text="Search", command=self.search_notes).pack(fill=tk.X)
         
+        self.search_status = ttk.Label(search_frame, text="")
+        self.search_status.pack()
+        self.live_results = VirtualResultList(search_frame, [('Title', 260)], [], self.open_note, 0, visible_rows=8,
+                                              metrics=self.metrics)
+        self.live_results.frame.pack(fill=tk.X, padx=5, pady=5)
+        
         # Tags filter
         tags_frame = ttk.LabelFrame(self.left_frame, text="Filter by Tags")
         tags_frame.pack(fill=tk.X, padx=5, pady=5)
         
         self.tag_filter_var = tk.StringVar()
-        self.tag_filter = ttk.Combobox(tags_frame, textvariable=self.tag_filter_var, values=sorted(self.tags))
+        self.tag_filter = ttk.Combobox(tags_frame, textvariable=self.tag_filter_var, values=self.kb.tag_index.sorted_tags)
         self.tag_filter.pack(fill=tk.X, padx=5, pady=5)
         self.tag_filter.bind('<<ComboboxSelected>>', lambda e: self.filter_by_tag())
+        self.tag_filter.bind('<KeyRelease>', lambda e: self.refresh_tag_filter())
         
         # Stats section
         stats_frame = ttk.LabelFrame(self.left_frame, text="Statistics")
@@ -82,6 +225,8 @@ class KnowledgeOrganizer:
         self.stats_label.pack()
         self.update_stats()
         
+        ttk.Button(stats_frame, text="More Statistics", command=self.show_detailed_stats).pack(fill=tk.X)
+        
         # Right frame - Note display and editing
         self.note_display_frame = ttk.Frame(self.right_frame)
         self.note_display_frame.pack(fill=tk.BOTH, expand=True)
@@ -126,6 +271,13 @@ class KnowledgeOrganizer:
         self.metadata_label = ttk.Label(self.note_display_frame, text="", font=('Helvetica', 8))
         self.metadata_label.pack()
         
+        # Clicking the hint opens the closest duplicate
+        self.duplicate_label = ttk.Label(self.note_display_frame, text="", font=('Helvetica', 9), foreground='#b35900',
+                                         cursor='hand2')
+        self.duplicate_label.pack()
+        self.duplicate_label.bind('<Button-1>', lambda e: self.open_note(self.duplicate_ids[0]) if self.duplicate_ids else None)
+        self.duplicate_ids = []
+        
     def create_menu_bar(self):
         menubar = tk.Menu(self.root)
         
@@ -138,6 +290,12 @@ class KnowledgeOrganizer:
         file_menu.add_command(label="Exit", command=self.on_closing)
         menubar.add_cascade(label="File", menu=file_menu)
         
+        # Tools menu
+        tools_menu = tk.Menu(menubar, tearoff=0)
+        tools_menu.add_command(label="Find Duplicates", command=self.show_duplicates)
+        tools_menu.add_command(label="Diagnostics", command=self.show_diagnostics)
+        menubar.add_cascade(label="Tools", menu=tools_menu)
+        
         # Help menu
         help_menu = tk.Menu(menubar, tearoff=0)
         help_menu.add_command(label="About", command=self.show_about)
@@ -146,19 +304,61 @@ class KnowledgeOrganizer:
         
         self.root.config(menu=menubar)
         
+    @instrumented('gui.display_note')
     def display_note(self, note):
-        self.current_note_id = note['id']
+        self.show_view(self.note_view(note))
+        
+    def note_view(self, note):
+        """Everything display_note shows for a note, worked out ahead of showing it"""
+        # Stored fingerprints are looked up on the persistence thread once the note is shown
+        stored = self.kb.duplicate_index.stored
+        duplicates = [] if stored else self.kb.possible_duplicates(note)
+        return {
+            'id': note.id,
+            'title': note.title,
+            'tags': "Tags: " + ", ".join(note.tags),
+            'content': self.kb.note_content(note),
+            'metadata': f"Created: {note.created} | Last Reviewed: {note.last_reviewed} | Next Review: {note.next_review} | Strength: {note.streak}",
+            'duplicate_ids': [duplicate.id for duplicate, _ in duplicates],
+            'duplicate_hint': self.duplicate_hint(duplicates),
+            'fingerprint': self.kb.fingerprint(note) if stored else None
+        }
+        
+    def duplicate_hint(self, duplicates):
+        if not duplicates:
+            return ""
+        duplicate, similarity = duplicates[0]
+        hint = f"Possible duplicate of '{duplicate.title}' ({similarity:.0%} similar)"
+        if len(duplicates) > 1:
+            hint += f" and {len(duplicates) - 1} more"
+        return hint
         
-        self.title_label.config(text=note['title'])
-        self.tags_label.config(text="Tags: " + ", ".join(note['tags']))
+    def show_view(self, view):
+        self.current_note_id = view['id']
+        
+        self.title_label.config(text=view['title'])
+        self.tags_label.config(text=view['tags'])
         
         self.content_text.config(state=tk.NORMAL)
         self.content_text.delete(1.0, tk.END)
-        self.content_text.insert(tk.END, note['content'])
+        self.content_text.insert(tk.END, view['content'])
         self.content_text.config(state=tk.DISABLED)
         
-        metadata = f"Created: {note['created']} | Last Reviewed: {note['last_reviewed']} | Next Review: {note['next_review']} | Strength: {note['streak']}"
-        self.metadata_label.config(text=metadata)
+        self.metadata_label.config(text=view['metadata'])
+        self.duplicate_ids = view['duplicate_ids']
+        self.duplicate_label.config(text=view['duplicate_hint'])
+        if view['fingerprint'] and view['fingerprint'][1]:  # Notes too short for a signature match nothing
+            self.when_stored(self.kb.duplicate_index.stored_duplicates,
+                             lambda stored: self.show_stored_duplicates(view, stored), view['fingerprint'])
+            
+    def show_stored_duplicates(self, view, stored):
+        # The hint is only advice, so a failed lookup just leaves it out
+        note = self.kb.notes.get(view['id'])
+        if isinstance(stored, Exception) or not note or self.current_note_id != view['id']:
+            return
+        duplicates = self.kb.possible_duplicates(note, view['fingerprint'], stored)
+        self.duplicate_ids = [duplicate.id for duplicate, _ in duplicates]
+        self.duplicate_label.config(text=self.duplicate_hint(duplicates))
         
     def new_note(self):
         self.current_note_id = None
@@ -193,20 +393,7 @@ class KnowledgeOrganizer:
                 messagebox.showerror("Error", "Title and content cannot be empty")
                 return
                 
-            note_data = {
-                'id': self.note_id_counter,
-                'title': title,
-                'tags': tags,
-                'content': content,
-                'created': datetime.date.today().isoformat(),
-                'last_reviewed': datetime.date.today().isoformat(),
-                'next_review': (datetime.date.today() + datetime.timedelta(days=1)).isoformat(),
-                'streak': 0
-            }
-            
-            self.notes.append(note_data)
-            self.note_id_counter += 1
-            self.update_tags()
+            note_data = self.kb.add_note(title, tags, content)
             self.update_stats()
             edit_window.destroy()
             self.display_note(note_data)
@@ -218,7 +405,7 @@ class KnowledgeOrganizer:
             messagebox.showinfo("Info", "No note selected")
             return
             
-        note = next((n for n in self.notes if n['id'] == self.current_note_id), None)
+        note = self.kb.notes.get(self.current_note_id)
         if not note:
             return
             
@@ -230,19 +417,19 @@ class KnowledgeOrganizer:
         # Title
         ttk.Label(edit_window, text="Title:").pack(pady=(10, 0))
         title_entry = ttk.Entry(edit_window, width=80)
-        title_entry.insert(0, note['title'])
+        title_entry.insert(0, note.title)
         title_entry.pack(padx=10)
         
         # Tags
         ttk.Label(edit_window, text="Tags (comma separated):").pack(pady=(10, 0))
         tags_entry = ttk.Entry(edit_window, width=80)
-        tags_entry.insert(0, ", ".join(note['tags']))
+        tags_entry.insert(0, ", ".join(note.tags))
         tags_entry.pack(padx=10)
         
         # Content
         ttk.Label(edit_window, text="Content:").pack(pady=(10, 0))
         content_text = tk.Text(edit_window, wrap=tk.WORD, height=20, padx=10, pady=10)
-        content_text.insert(tk.END, note['content'])
+        content_text.insert(tk.END, self.kb.note_content(note))
         content_text.pack(fill=tk.BOTH, expand=True, padx=10)
         
         # Save button
@@ -255,278 +442,631 @@ class KnowledgeOrganizer:
                 messagebox.showerror("Error", "Title and content cannot be empty")
                 return
                 
-            note['title'] = title
-            note['tags'] = tags
-            note['content'] = content
-            self.update_tags()
+            self.kb.edit_note(note.id, title, tags, content)
+            self.update_stats()
             edit_window.destroy()
             self.display_note(note)
             
         ttk.Button(edit_window, text="Save Changes", command=save_note).pack(pady=10)
         
+    @instrumented('gui.delete_current_note')
     def delete_current_note(self):
         if not self.current_note_id:
             messagebox.showinfo("Info", "No note selected")
             return
             
         if messagebox.askyesno("Confirm", "Are you sure you want to delete this note?"):
-            self.notes = [n for n in self.notes if n['id'] != self.current_note_id]
+            self.kb.delete_note(self.current_note_id)
             self.current_note_id = None
-            self.update_tags()
             self.update_stats()
             self.init_note_display()
             messagebox.showinfo("Info", "Note deleted")
             
     def search_notes(self):
+        # Return and the Search button open the full results window once the search finishes
+        self.run_search(open_window=True)
+        
+    def schedule_search(self):
+        """Debounce typing: search once the entry has been still for a moment"""
+        if self.search_after:
+            self.root.after_cancel(self.search_after)
+        self.search_after = self.root.after(250, self.run_search)
+        
+    @instrumented('gui.run_search')
+    def run_search(self, open_window=False):
+        if self.search_after:
+            self.root.after_cancel(self.search_after)
+            self.search_after = None
+            
         query = self.search_entry.get().lower()
-        if not query:
+        if not open_window and query == self.live_query:
+            return  # Keys such as arrows change nothing
+        self.live_query = query
+        
+        if not query.strip():
+            self.search_worker.cancel()
+            self.search_request = None
+            self.search_status.config(text="")
+            self.live_results.set_rows([], 0)
             return
             
-        results = []
-        for note in self.notes:
-            if (query in note['title'].lower() or 
-                query in note['content'].lower() or 
-                any(query in tag.lower() for tag in note['tags'])):
-                results.append(note)
+        waiting = self.search_request is not None
+        self.search_request = (self.search_worker.submit(self.kb.search_snapshot(), query, 100, fuzzy=True), open_window)
+        self.search_status.config(text="Searching...")
+        if not waiting:
+            self.poll_search_results()
+            
+    def poll_search_results(self):
+        """Pick up worker results on the Tk thread, ignoring those of superseded queries"""
+        while self.search_request:
+            try:
+                generation, query, ids, total, suggestions = self.search_worker.results.get_nowait()
+            except queue.Empty:
+                self.root.after(30, self.poll_search_results)
+                return
+            if generation == self.search_request[0]:
+                open_window = self.search_request[1]
+                self.search_request = None
+                self.search_entry['values'] = suggestions
+                self.show_search_result(query, ids, total, open_window)
                 
-        if not results:
-            messagebox.showinfo("Search Results", "No notes found matching your search")
+    def when_stored(self, read, on_done, *args):
+        """Run read(*args) off the Tk thread once the queued writes are stored, then on_done(result) on it"""
+        self.pending_reads[self.kb.after_writes(read, *args)] = on_done
+        if len(self.pending_reads) == 1:
+            self.poll_stored_reads()
+            
+    def poll_stored_reads(self):
+        while True:
+            try:
+                token, result = self.kb.stored_reads.get_nowait()
+            except queue.Empty:
+                break
+            self.pending_reads.pop(token)(result)
+        if self.pending_reads:
+            self.root.after(30, self.poll_stored_reads)
+            
+    @instrumented('gui.show_search_result')
+    def show_search_result(self, query, ids, total, open_window):
+        if isinstance(ids, Exception):
+            self.search_status.config(text="Search failed")
+            messagebox.showerror("Error", f"Search failed: {str(ids)}")
             return
             
-        # Create results window
-        results_window = tk.Toplevel(self.root)
-        results_window.title(f"Search Results for '{query}'")
-        results_window.geometry("800x600")
-        
-        tree = ttk.Treeview(results_window, columns=('Title', 'Tags'), show='headings')
-        tree.heading('Title', text='Title')
-        tree.heading('Tags', text='Tags')
-        tree.column('Title', width=400)
-        tree.column('Tags', width=200)
-        
-        for note in results:
-            tree.insert('', tk.END, values=(note['title'], ", ".join(note['tags'])), tags=(note['id'],))
+        first_page = self.kb.notes.get_many(ids)
+        self.search_status.config(text=f"{total} matching notes")
+        self.live_results.set_rows(((note.id, (note.title,)) for note in first_page), len(first_page))
+        if not open_window:
+            return
+            
+        if not total:
+            messagebox.showinfo("Search Results", "No notes found matching your search")
+            return
             
-        tree.pack(fill=tk.BOTH, expand=True)
+        def ranked_notes():
+            # Pages grow geometrically so scrolling deep into the results stays cheap
+            notes, offset, limit = first_page, 0, 100
+            while notes:
+                yield from notes
+                offset += len(notes)
+                limit *= 2
+                notes = self.kb.search(query, limit, offset, fuzzy=True)[0] if offset < total else []
+                
+        self.show_results(f"Search Results for '{query}'", [('Title', 'title', 400), ('Tags', 'tags', 200)],
+                          ranked_notes(), total, lambda: self.kb.search_ids(query, fuzzy=True))
         
-        def on_select(event):
-            item = tree.focus()
-            note_id = int(tree.item(item, 'tags')[0])
-            note = next(n for n in self.notes if n['id'] == note_id)
+    def open_note(self, note_id):
+        note = self.kb.notes.get(note_id)
+        if note:
             self.display_note(note)
-            results_window.destroy()
             
-        tree.bind('<Double-1>', on_select)
-        
+    @instrumented('gui.filter_by_tag')
     def filter_by_tag(self):
         tag = self.tag_filter_var.get()
         if not tag:
             return
             
-        filtered_notes = [n for n in self.notes if tag in n['tags']]
+        note_ids = self.kb.tagged_note_ids(tag)
         
-        if not filtered_notes:
+        if not note_ids:
             messagebox.showinfo("Filter Results", f"No notes found with tag '{tag}'")
             return
             
+        self.show_results(f"Notes with tag '{tag}'", [('Title', 'title', 400), ('Tags', 'tags', 200)],
+                          (self.kb.notes.get(note_id) for note_id in note_ids), len(note_ids),
+                          lambda: note_ids)
+        
+    @instrumented('gui.show_results')
+    def show_results(self, title, columns, notes, total=None, all_note_ids=None):
+        """Open a results window over notes that are only consumed as far as the user scrolls"""
+        # columns are (heading, note field, width); all_note_ids supplies the ids to sort by a column
+        fields = [field for _, field, _ in columns]
+        
+        def rows(notes):
+            for note in notes:
+                yield note.id, tuple(self.column_value(note, field) for field in fields)
+                
+        def sort_rows(column, descending):
+            # Only ids are sorted, keyed on the one column; notes and rows are fetched for the visible window alone
+            field = fields[column]
+            notes = self.kb.notes
+            note_ids = sorted((note_id for note_id in all_note_ids() if note_id in notes),
+                              key=lambda note_id: self.column_value(notes.get(note_id), field), reverse=descending)
+            return rows(notes.get(note_id) for note_id in note_ids if note_id in notes)
+            
+        sortable = all_note_ids is not None and (total is None or total <= MAX_SORTED_RESULTS)
+            
         # Create results window
         results_window = tk.Toplevel(self.root)
-        results_window.title(f"Notes with tag '{tag}'")
+        results_window.title(title)
         results_window.geometry("800x600")
         
-        tree = ttk.Treeview(results_window, columns=('Title', 'Tags'), show='headings')
-        tree.heading('Title', text='Title')
-        tree.heading('Tags', text='Tags')
-        tree.column('Title', width=400)
-        tree.column('Tags', width=200)
-        
-        for note in filtered_notes:
-            tree.insert('', tk.END, values=(note['title'], ", ".join(note['tags'])), tags=(note['id'],))
-            
-        tree.pack(fill=tk.BOTH, expand=True)
-        
-        def on_select(event):
-            item = tree.focus()
-            note_id = int(tree.item(item, 'tags')[0])
-            note = next(n for n in self.notes if n['id'] == note_id)
-            self.display_note(note)
+        def open_note(note_id):
+            note = self.kb.notes.get(note_id)
+            if note:
+                self.display_note(note)
             results_window.destroy()
             
-        tree.bind('<Double-1>', on_select)
+        results = VirtualResultList(results_window, [(heading, width) for heading, _, width in columns],
+                                    rows(notes), open_note, total, sort_rows if sortable else None, metrics=self.metrics)
+        results.frame.pack(fill=tk.BOTH, expand=True)
+        
+    def column_value(self, note, field):
+        if field == 'tags':
+            return ", ".join(note.tags)
+        return getattr(note, field)
         
+    @instrumented('gui.display_random_note_for_review')
     def display_random_note_for_review(self):
-        if not self.notes:
+        # Prefers notes that are due for review
+        note = self.kb.random_review_note()
+        if not note:
             messagebox.showinfo("Info", "No notes available for review")
             return
             
-        # Filter notes that are due for review
-        today = datetime.date.today().isoformat()
-        due_notes = [n for n in self.notes if n['next_review'] <= today]
-        
-        if due_notes:
-            note = random.choice(due_notes)
-        else:
-            note = random.choice(self.notes)
-            
         self.display_note(note)
         
+    @instrumented('gui.show_todays_review_notes')
     def show_todays_review_notes(self):
-        today = datetime.date.today().isoformat()
-        due_notes = [n for n in self.notes if n['next_review'] <= today]
+        if self.review_session:
+            self.review_session.commit()
+        due_notes = self.kb.due_notes()
         
         if not due_notes:
             messagebox.showinfo("Today's Review", "No notes are due for review today")
             return
             
-        # Create results window
-        results_window = tk.Toplevel(self.root)
-        results_window.title("Today's Review Notes")
-        results_window.geometry("800x600")
-        
-        tree = ttk.Treeview(results_window, columns=('Title', 'Next Review', 'Strength'), show='headings')
-        tree.heading('Title', text='Title')
-        tree.heading('Next Review', text='Next Review')
-        tree.heading('Strength', text='Strength')
-        tree.column('Title', width=400)
-        tree.column('Next Review', width=150)
-        tree.column('Strength', width=100)
-        
-        for note in sorted(due_notes, key=lambda x: x['next_review']):
-            tree.insert('', tk.END, values=(note['title'], note['next_review'], note['streak']), tags=(note['id'],))
-            
-        tree.pack(fill=tk.BOTH, expand=True)
-        
-        def on_select(event):
-            item = tree.focus()
-            note_id = int(tree.item(item, 'tags')[0])
-            note = next(n for n in self.notes if n['id'] == note_id)
-            self.display_note(note)
-            results_window.destroy()
+        self.show_results("Today's Review Notes",
+                          [('Title', 'title', 400), ('Next Review', 'next_review', 150), ('Strength', 'streak', 100)],
+                          due_notes, len(due_notes), lambda: [note.id for note in due_notes])
+        
+    @instrumented('gui.start_review_session')
+    def start_review_session(self):
+        """Go through every due note in turn; a session already under way carries on"""
+        if not self.review_session:
+            self.review_session = self.kb.review_session()
+        self.show_session_card()
+        
+    @instrumented('gui.show_session_card')
+    def show_session_card(self):
+        note = self.review_session.current()
+        if note is None:
+            reviewed = self.review_session.reviewed
+            self.review_session.finish()
+            self.review_session = None
+            self.review_views = {}
+            self.session_status.config(text="")
+            self.update_stats()
+            messagebox.showinfo("Review Session", f"Session finished: {reviewed} notes reviewed" if reviewed
+                                else "No notes are due for review today")
+            return
             
-        tree.bind('<Double-1>', on_select)
-        
+        view = self.review_views.pop(note.id, None)
+        self.show_view(view if view and view['id'] == note.id else self.note_view(note))
+        self.session_status.config(text=f"Card {self.review_session.position + 1} of {len(self.review_session.queue)}")
+        # The next cards are prepared once the window is idle, so answering never waits for them
+        self.root.after_idle(self.prefetch_session_cards)
+        
+    def prefetch_session_cards(self):
+        if self.review_session:
+            for note in self.review_session.prefetch():
+                self.review_views[note.id] = self.note_view(note)
+                
+    @instrumented('gui.review_feedback')
     def review_feedback(self, feedback):
         if not self.current_note_id:
             messagebox.showinfo("Info", "No note selected")
             return
             
-        note = next((n for n in self.notes if n['id'] == self.current_note_id), None)
-        if not note:
+        session = self.review_session
+        if session and session.current() and session.current().id == self.current_note_id:
+            # Answers are committed in batches; the stats catch up whenever one is
+            session.answer(feedback)
+            if not session.pending:
+                self.update_stats()
+            self.show_session_card()
             return
             
-        today = datetime.date.today()
-        
-        # Update note based on feedback
-        if feedback == 'easy':
-            note['streak'] += 2
-        elif feedback == 'good':
-            note['streak'] += 1
-        else:  # hard
-            note['streak'] = max(0, note['streak'] - 1)
+        note = self.kb.review(self.current_note_id, feedback)
+        if not note:
+            return
             
-        note['last_reviewed'] = today.isoformat()
-        note['next_review'] = self.spaced_rep.next_review_date(note['streak']).isoformat()
-        
         self.display_note(note)
         self.update_stats()
         
-    def update_tags(self):
-        self.tags = set()
-        for note in self.notes:
-            self.tags.update(note['tags'])
-            
-        self.tag_filter['values'] = sorted(self.tags)
+    @instrumented('gui.refresh_tag_filter')
+    def refresh_tag_filter(self):
+        # Offer only the tags that complete what has been typed so far
+        self.tag_filter['values'] = self.kb.tag_index.complete(self.tag_filter_var.get())
         
+    @instrumented('gui.update_stats')
     def update_stats(self):
-        total_notes = len(self.notes)
-        total_tags = len(self.tags)
-        
-        today = datetime.date.today().isoformat()
-        due_reviews = len([n for n in self.notes if n['next_review'] <= today])
-        
-        avg_streak = sum(n['streak'] for n in self.notes) / total_notes if total_notes > 0 else 0
-        
-        stats_text = (f"Total Notes: {total_notes}\n"
-                     f"Total Tags: {total_tags}\n"
-                     f"Due Reviews: {due_reviews}\n"
-                     f"Avg. Strength: {avg_streak:.1f}")
+        stats = self.kb.stats()
+        stats_text = (f"Total Notes: {stats['total_notes']}\n"
+                     f"Total Tags: {stats['total_tags']}\n"
+                     f"Due Reviews: {stats['due_reviews']}\n"
+                     f"Avg. Strength: {stats['avg_streak']:.1f}")
                      
         self.stats_label.config(text=stats_text)
         
-    def export_notes(self):
+    @instrumented('gui.show_detailed_stats')
+    def show_detailed_stats(self):
+        if self.review_session:
+            self.review_session.commit()
+        stats_window = tk.Toplevel(self.root)
+        stats_window.title("Statistics")
+        stats_window.geometry("500x600")
+        
+        lines = ["Tag\tNotes\tAvg. Strength"]
+        for tag, (count, avg_streak) in sorted(self.kb.tag_stats().items()):
+            lines.append(f"{tag}\t{count}\t{avg_streak:.1f}")
+            
+        stats_text = tk.Text(stats_window, wrap=tk.WORD, font=('Helvetica', 11), padx=10, pady=10)
+        stats_text.insert(tk.END, "\n".join(lines + ["", "Reading review history..."]))
+        stats_text.config(state=tk.DISABLED)
+        stats_text.pack(fill=tk.BOTH, expand=True)
+        
+        def show_history(history):
+            # The review log is read once the reviews still queued are written
+            if not stats_window.winfo_exists():
+                return
+            if isinstance(history, Exception):
+                history_lines = ["", f"Failed to read review history: {str(history)}"]
+            else:
+                per_day, curve = history
+                history_lines = ["", "Reviews per day (oldest first)", " ".join(str(count) for count in per_day),
+                                 "", "Days since last review\tReviews\tRemembered"]
+                for shortest, longest, reviews, retention in curve:
+                    history_lines.append(f"{shortest}-{longest}\t{reviews}\t{retention:.0%}")
+            stats_text.config(state=tk.NORMAL)
+            stats_text.delete(1.0, tk.END)
+            stats_text.insert(tk.END, "\n".join(lines + history_lines))
+            stats_text.config(state=tk.DISABLED)
+            
+        self.when_stored(lambda: (self.kb.reviews_per_day(), self.kb.retention_curve()), show_history)
+        
+    @instrumented('gui.show_duplicates')
+    def show_duplicates(self):
+        """List groups of duplicate notes; merging keeps the oldest note of a group"""
+        window = tk.Toplevel(self.root)
+        window.title("Duplicate Notes")
+        window.geometry("800x600")
+        
+        columns = ('Title', 'Tags', 'Created')
+        tree = ttk.Treeview(window, columns=columns, show='tree headings', selectmode='browse')
+        tree.column('#0', width=120)
+        for name, width in zip(columns, (380, 180, 100)):
+            tree.heading(name, text=name)
+            tree.column(name, width=width)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        status = ttk.Label(window, text="")
+        status.pack()
+        groups = []
+        
+        def refresh():
+            status.config(text="Looking for duplicates...")
+            if self.kb.duplicate_index.stored:
+                # Stored fingerprints must cover every queued save, so they are read after those are written
+                self.when_stored(self.kb.duplicate_index.groups, show_groups)
+            else:
+                show_groups(self.kb.duplicate_index.groups())
+                
+        def show_groups(id_groups):
+            if not window.winfo_exists():
+                return
+            if isinstance(id_groups, Exception):
+                status.config(text="")
+                messagebox.showerror("Error", f"Failed to find duplicates: {str(id_groups)}")
+                return
+            groups[:] = self.kb.note_groups(id_groups)
+            tree.delete(*tree.get_children())
+            for index, group in enumerate(groups):
+                parent = tree.insert('', tk.END, iid=f'group{index}', text=f"{len(group)} notes", open=True)
+                for note in group:
+                    tree.insert(parent, tk.END, iid=str(note.id), values=(note.title, ", ".join(note.tags), note.created))
+            status.config(text=f"{len(groups)} groups of possible duplicates" if groups else "No duplicates found")
+            
+        def merge(selected_groups):
+            for group in selected_groups:
+                self.kb.merge_notes(group[0].id, [note.id for note in group[1:]])
+            if self.current_note_id is not None and self.current_note_id not in self.kb.notes:
+                self.current_note_id = None
+                self.init_note_display()
+            self.update_stats()
+            refresh()
+            
+        def merge_selected():
+            item = tree.focus()
+            if not item:
+                messagebox.showinfo("Info", "No group selected")
+                return
+            if not item.startswith('group'):
+                item = tree.parent(item)
+            merge([groups[int(item[len('group'):])]])
+            
+        def merge_all():
+            if groups and messagebox.askyesno("Confirm", f"Merge all {len(groups)} groups? Each group keeps its oldest note, "
+                                                         "with the tags of the others."):
+                merge(list(groups))
+                
+        def open_note(event):
+            item = tree.focus()
+            if item and not item.startswith('group'):
+                self.open_note(int(item))
+                
+        tree.bind('<Double-1>', open_note)
+        buttons = ttk.Frame(window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        ttk.Button(buttons, text="Merge Selected Group", command=merge_selected).pack(side=tk.LEFT)
+        ttk.Button(buttons, text="Merge All Groups", command=merge_all).pack(side=tk.LEFT, padx=5)
+        refresh()
+        
+    def show_diagnostics(self):
+        """Live view of recent operation latencies, event counts and memory use"""
+        window = tk.Toplevel(self.root)
+        window.title("Diagnostics")
+        window.geometry("700x600")
+        
+        columns = ('Operation', 'Count', 'p50 ms', 'p95 ms', 'Max ms')
+        tree = ttk.Treeview(window, columns=columns, show='headings', height=18)
+        for name in columns:
+            tree.heading(name, text=name)
+            tree.column(name, width=240 if name == 'Operation' else 100, anchor=tk.W if name == 'Operation' else tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
+        summary = ttk.Label(window, text="", justify=tk.LEFT)
+        summary.pack(fill=tk.X, padx=5)
+        
+        buttons = ttk.Frame(window)
+        buttons.pack(fill=tk.X, padx=5, pady=5)
+        profile_button = ttk.Button(buttons, command=lambda: self.toggle_profiling(profile_button))
+        profile_button.config(text="Stop Profiling" if self.profiler.running else "Start Profiling")
+        profile_button.pack(side=tk.LEFT)
+        ttk.Button(buttons, text="Export Metrics", command=self.export_metrics).pack(side=tk.LEFT, padx=5)
+        
+        def refresh():
+            if not window.winfo_exists():
+                return
+            snapshot = self.kb.diagnostics()
+            tree.delete(*tree.get_children())
+            for name, timer in snapshot['operations'].items():
+                tree.insert('', tk.END, values=(name, timer['count'], f"{timer['p50_ms']:.2f}",
+                                                f"{timer['p95_ms']:.2f}", f"{timer['max_ms']:.2f}"))
+            lines = [" | ".join(f"{name}: {value / 2 ** 20:.1f} MiB" for name, value in snapshot['memory'].items()),
+                     " | ".join(f"{name}: {value}" for name, value in snapshot['gauges'].items()),
+                     " | ".join(f"{name}: {value}" for name, value in sorted(snapshot['counters'].items()))]
+            summary.config(text="\n".join(line for line in lines if line))
+            window.after(1000, refresh)
+            
+        refresh()
+        
+    def toggle_profiling(self, button):
+        if not self.profiler.running:
+            self.profiler.start()
+            button.config(text="Stop Profiling")
+            return
+            
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".prof",
+            filetypes=[("Profiles", "*.prof"), ("All files", "*.*")]
+        )
+        if not file_path:
+            return  # Keep profiling until there is somewhere to save it
+            
+        try:
+            report = self.profiler.stop(file_path)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to save profile: {str(e)}")
+            return
+        finally:
+            if button.winfo_exists():
+                button.config(text="Start Profiling")
+                
+        report_window = tk.Toplevel(self.root)
+        report_window.title("Profile")
+        report_window.geometry("900x600")
+        report_text = tk.Text(report_window, wrap=tk.NONE, font=('Courier', 9))
+        report_text.insert(tk.END, report)
+        report_text.config(state=tk.DISABLED)
+        report_text.pack(fill=tk.BOTH, expand=True)
+        
+    def export_metrics(self):
         file_path = filedialog.asksaveasfilename(
             defaultextension=".json",
-            filetypes=[("JSON files", "*.json"), ("All files", "*.*")]
+            filetypes=[("JSON files", "*.json"), ("Prometheus text", "*.prom"), ("All files", "*.*")]
         )
         
         if not file_path:
             return
             
-        data = {
-            'notes': self.notes,
-            'note_id_counter': self.note_id_counter
-        }
+        try:
+            self.kb.export_metrics(file_path)
+            messagebox.showinfo("Success", f"Metrics exported to {file_path}")
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export metrics: {str(e)}")
+            
+    def export_notes(self):
+        file_path = filedialog.asksaveasfilename(
+            defaultextension=".jsonl",
+            filetypes=[("Note archives", "*.jsonl"), ("JSON files", "*.json"), ("All files", "*.*")]
+        )
         
+        if not file_path:
+            return
+            
         try:
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=2)
-            messagebox.showinfo("Success", "Notes exported successfully")
+            writer = NoteArchiveWriter(file_path, self.kb.note_id_counter)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to export notes: {str(e)}")
+            return
+            
+        note_ids = self.kb.notes.note_ids()
+        progress = ProgressWindow(self.root, "Exporting Notes")
+        state = {'done': 0, 'batch': None, 'finishing': False}
+        
+        def export_batch():
+            # Serialize one batch per Tk tick; the writer thread does the disk I/O
+            if writer.error:
+                progress.close()
+                messagebox.showerror("Error", f"Failed to export notes: {str(writer.error)}")
+                return
+            if state['finishing']:
+                if writer.done():
+                    progress.close()
+                    messagebox.showinfo("Success", f"Exported {len(note_ids)} notes")
+                else:
+                    self.root.after(50, export_batch)
+                return
+                
+            if state['batch'] is None:
+                ids = note_ids[state['done']:state['done'] + 1000]
+                state['batch'] = self.kb.archive_records(ids)
+                state['size'] = len(ids)
+                
+            if writer.put(state['batch'] if state['size'] else None):
+                state['done'] += state['size']
+                state['finishing'] = not state['size']
+                state['batch'] = None
+            progress.update(state['done'] / max(len(note_ids), 1), f"Exported {state['done']} of {len(note_ids)} notes")
+            self.root.after(1, export_batch)
             
+        export_batch()
+        
     def import_notes(self):
         file_path = filedialog.askopenfilename(
-            filetypes=[("JSON files", "*.json"), ("All files", "*.*")]
+            filetypes=[("Note archives", "*.jsonl *.json"), ("All files", "*.*")]
         )
         
         if not file_path:
             return
             
+        merge = messagebox.askyesnocancel(
+            "Import Notes",
+            "Merge the imported notes into your existing notes?\n\n"
+            "Yes keeps your notes and adds the imported ones; No replaces all of your notes.")
+        if merge is None:
+            return
+            
         try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                
-            if not all(key in data for key in ['notes', 'note_id_counter']):
-                raise ValueError("Invalid data format")
-                
-            self.notes = data['notes']
-            self.note_id_counter = data['note_id_counter']
-            self.update_tags()
-            self.update_stats()
-            self.current_note_id = None
-            self.init_note_display()
-            messagebox.showinfo("Success", "Notes imported successfully")
+            reader = NoteArchiveReader(file_path)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to import notes: {str(e)}")
+            return
             
-    def load_data(self):
-        try:
-            with open('knowledge_organizer_data.json', 'r') as f:
-                data = json.load(f)
+        batches = queue.Queue(maxsize=4)
+        state = {'pass': 0, 'imported': 0, 'started': False}
+        progress = ProgressWindow(self.root, "Importing Notes")
+        
+        def read():
+            # Check every record before anything is changed, then stream the file again in batches
+            try:
+                for record in reader:
+                    validate_note_record(record)
+                state['pass'] = 1
+                batch = []
+                for record in reader:
+                    batch.append(record)
+                    if len(batch) == 1000:
+                        batches.put(('notes', batch))
+                        batch = []
+                batches.put(('notes', batch))
+                batches.put(('done', reader.note_id_counter))
+            except Exception as e:
+                batches.put(('error', e))
                 
-            self.notes = data.get('notes', [])
-            self.note_id_counter = data.get('note_id_counter', 1)
-            self.update_tags()
-        except FileNotFoundError:
-            self.notes = []
-            self.note_id_counter = 1
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load data: {str(e)}")
-            self.notes = []
-            self.note_id_counter = 1
-            
-    def save_data(self):
-        data = {
-            'notes': self.notes,
-            'note_id_counter': self.note_id_counter
-        }
+        def apply_batch():
+            try:
+                kind, payload = batches.get_nowait()
+            except queue.Empty:
+                fraction = (state['pass'] + reader.bytes_read / max(reader.size, 1)) / 2
+                progress.update(fraction, "Checking notes..." if state['pass'] == 0 else f"Imported {state['imported']} notes")
+                self.root.after(50, apply_batch)
+                return
+                
+            if kind == 'error':
+                progress.close()
+                messagebox.showerror("Error", f"Failed to import notes: {str(payload)}")
+                return
+                
+            if not state['started']:
+                state['started'] = True
+                if not merge:
+                    self.kb.clear()
+                    self.current_note_id = None
+                    self.init_note_display()
+                    
+            if kind == 'notes':
+                self.kb.add_records(payload)
+                state['imported'] += len(payload)
+                self.root.after(1, apply_batch)
+                return
+                
+            self.kb.raise_note_id_counter(payload)
+            self.update_stats()
+            progress.close()
+            messagebox.showinfo("Success", f"Imported {state['imported']} notes")
+            
+        threading.Thread(target=read, name='import', daemon=True).start()
+        apply_batch()
         
-        try:
-            with open('knowledge_organizer_data.json', 'w') as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to save data: {str(e)}")
+    def load_data(self):
+        self.kb = KnowledgeBase(on_tags_changed=self.refresh_tag_filter)
+        self.kb.auto_refresh = False  # refresh_shared_notes takes in other instances' changes in the background
+        self.metrics = self.kb.metrics
+        if self.kb.load_error:
+            messagebox.showerror("Error", f"Failed to load data: {str(self.kb.load_error)}")
+            
+    def check_storage_errors(self, repeat=True):
+        """Report failures from the persistence thread on the Tk thread"""
+        error = self.kb.storage_error()
+        if error:
+            messagebox.showerror("Error", f"Failed to save data: {str(error)}")
+        if repeat:
+            self.root.after(1000, self.check_storage_errors)
             
+    @instrumented('gui.refresh_shared_notes')
+    def refresh_shared_notes(self):
+        """Show the changes other instances made to the shared notes"""
+        # Read behind the queued writes, so storage can tell this instance's own changes apart
+        self.when_stored(self.kb.read_changes, self.show_shared_changes, self.kb.local_writes)
+        
+    def show_shared_changes(self, result):
+        if isinstance(result, Exception):
+            messagebox.showerror("Error", f"Failed to refresh notes: {str(result)}")
+            self.root.after(2000, self.refresh_shared_notes)
+            return
+            
+        changed = self.kb.apply_changes(*result)
+        if changed:
+            self.update_stats()
+            if self.current_note_id in changed:
+                note = self.kb.notes.get(self.current_note_id)
+                if note:
+                    self.display_note(note)
+                else:
+                    self.current_note_id = None
+                    self.init_note_display()
+        self.root.after(2000, self.refresh_shared_notes)
+        
     def show_about(self):
         about_text = ("Personal Knowledge Organizer\n"
                      "Version 1.0\n\n"
@@ -539,7 +1079,12 @@ class KnowledgeOrganizer:
         webbrowser.open_new_tab(docs_url)
         
     def on_closing(self):
-        self.save_data()
+        # Waits for every queued write before the window goes away; an unfinished review session resumes next time
+        if self.review_session:
+            self.review_session.close()
+        self.search_worker.close()
+        self.kb.close()
+        self.check_storage_errors(repeat=False)
         self.root.destroy()
 
 if __name__ == "__main__":
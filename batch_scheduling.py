@@ -0,0 +1,80 @@
+import datetime
+import math
+
+try:
+    import numpy as np
+except ImportError:  # Only batch rescheduling needs NumPy; the rest of the app runs without it
+    np = None
+
+class BatchScheduler:
+    """Computes review dates for whole arrays of notes at once with a memory model"""
+    def __init__(self, model):
+        if np is None:
+            raise RuntimeError("Batch rescheduling needs NumPy (pip install numpy)")
+        self.model = model
+        
+    def note_arrays(self, notes):
+        """Ids, streaks, last review days and next review days of the notes as int64 arrays"""
+        count = len(notes)
+        note_ids = np.fromiter((n.id for n in notes), np.int64, count)
+        streaks = np.fromiter((n.streak for n in notes), np.int64, count)
+        reviewed_days = np.fromiter((n.reviewed_day for n in notes), np.int64, count)
+        review_days = np.fromiter((n.review_day for n in notes), np.int64, count)
+        return note_ids, streaks, reviewed_days, review_days
+        
+    def next_review_days(self, streaks, reviewed_days, ease=None):
+        return reviewed_days + self.model.next_intervals(streaks, ease)
+        
+    def reschedule(self, notes, today=None, smooth=True, max_per_day=None, ease=None):
+        """Return note ids and their recomputed review days, optionally spread by smooth_load"""
+        today = (today or datetime.date.today()).toordinal()
+        note_ids, streaks, reviewed_days, _ = self.note_arrays(notes)
+        review_days = self.next_review_days(streaks, reviewed_days, ease)
+        if smooth and len(review_days):
+            review_days = self.smooth_load(review_days, review_days - reviewed_days, today, max_per_day)
+        return note_ids, review_days
+        
+    def smooth_load(self, review_days, intervals, today, max_per_day=None, window=30):
+        """Push reviews later so no day from today on holds more than max_per_day of them"""
+        # Overdue notes all count as due today; by default a day may hold the average load of the next window days
+        targets = np.maximum(review_days, today)
+        if max_per_day is not None and max_per_day < 1:
+            raise ValueError(f"max_per_day must be at least 1, not {max_per_day}")
+        if max_per_day is None:
+            max_per_day = max(1, math.ceil(np.count_nonzero(targets < today + window) / window))
+            
+        first_day = int(targets.min())
+        demand = np.bincount(targets - first_day)
+        
+        # Fill each day up to the cap and carry the overflow to the next day
+        capacity = np.empty(len(demand) + math.ceil(len(targets) / max_per_day), np.int64)
+        carry = 0
+        for day in range(len(capacity)):
+            load = carry + (int(demand[day]) if day < len(demand) else 0)
+            capacity[day] = min(load, max_per_day)
+            carry = load - capacity[day]
+            if carry == 0 and day >= len(demand):
+                capacity = capacity[:day + 1]
+                break
+                
+        # Hand the days out in target order, shortest intervals first, so no note moves earlier
+        order = np.lexsort((intervals, targets))
+        days = np.empty_like(targets)
+        days[order] = first_day + np.searchsorted(np.cumsum(capacity), np.arange(len(targets)), side='right')
+        return days
+        
+    def forecast(self, notes, days=30, today=None, ease=None):
+        """Reviews per day for the coming days if every review is answered 'good'"""
+        today = (today or datetime.date.today()).toordinal()
+        _, streaks, _, review_days = self.note_arrays(notes)
+        review_days = np.maximum(review_days, today)
+        
+        counts = np.zeros(days, np.int64)
+        pending = review_days < today + days
+        while pending.any():
+            # Each pass reviews every note still inside the window once more
+            counts += np.bincount(review_days[pending] - today, minlength=days)
+            streaks = np.where(pending, streaks + 1, streaks)
+            review_days = np.where(pending, review_days + self.model.next_intervals(streaks, ease), review_days)
+            pending = review_days < today + days
+        return counts
@@ -0,0 +1,237 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from knowledge_core import KnowledgeBase, JSONStorage, SQLiteStorage, memory_usage
+from sharded_storage import ShardedStorage
+from benchmarks.synthetic import SyntheticNotes
+
+def open_bench_storage(backend, directory):
+    if backend == 'json':
+        return JSONStorage(os.path.join(directory, 'notes.json'), os.path.join(directory, 'index.json'))
+    if backend == 'sharded':
+        return ShardedStorage(os.path.join(directory, 'shards'), legacy_db_path=None, legacy_json_path=None)
+    # The legacy path points nowhere so the user's own JSON data is never migrated in
+    return SQLiteStorage(os.path.join(directory, 'notes.db'), os.path.join(directory, 'missing.json'))
+
+def transpose(query, rng):
+    """Query with two adjacent letters of its last word swapped, anywhere in the word"""
+    head, _, word = query.rpartition(' ')
+    i = rng.randrange(len(word) - 1)
+    return head + (' ' if head else '') + word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    
+def percentile(samples, fraction):
+    """Nearest-rank percentile of sorted samples"""
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+def summarize(durations, peak_bytes):
+    durations = sorted(durations)
+    total = sum(durations)
+    return {
+        'count': len(durations),
+        'p50_ms': percentile(durations, 0.50) * 1000,
+        'p90_ms': percentile(durations, 0.90) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'max_ms': durations[-1] * 1000,
+        'ops_per_sec': len(durations) / total if total else float('inf'),
+        'peak_kib': peak_bytes / 1024
+    }
+
+def measure(operation, arguments, traced=50):
+    """Time operation once per argument, then trace the allocations of the first few calls"""
+    durations = []
+    for args in arguments:
+        start = time.perf_counter()
+        operation(*args)
+        durations.append(time.perf_counter() - start)
+        
+    # Tracing slows every allocation down, so it gets its own pass
+    tracemalloc.start()
+    baseline = memory_usage()['traced']
+    for args in arguments[:traced]:
+        operation(*args)
+    peak = memory_usage()['traced_peak'] - baseline
+    tracemalloc.stop()
+    return summarize(durations, peak)
+
+def populate(kb, notes, count, batch_size=1000):
+    """Add count synthetic notes through the import path and wait until they are stored"""
+    elapsed = 0
+    records = notes.records(count)
+    while True:
+        # Only adding and storing the notes is timed, not making them up
+        batch = list(itertools.islice(records, batch_size))
+        start = time.perf_counter()
+        kb.add_records(batch)
+        elapsed += time.perf_counter() - start
+        if len(batch) < batch_size:
+            break
+    start = time.perf_counter()
+    kb.persistence.drain()
+    elapsed += time.perf_counter() - start
+    return {'count': count, 'seconds': elapsed, 'notes_per_sec': count / elapsed}
+
+def bench_size(args, notes, count, directory):
+    """Run every benchmark against a knowledge base of count notes"""
+    results = {}
+    rng = random.Random(args.seed)
+    kb = KnowledgeBase(open_bench_storage(args.backend, directory))
+    if len(kb.notes) != count:
+        kb.clear()
+        results['import'] = populate(kb, notes, count)
+    kb.close()
+    
+    # load_data: read the store and build every index
+    loaded = []
+    def load():
+        loaded.append(KnowledgeBase(open_bench_storage(args.backend, directory)))
+    results['load'] = measure(load, [()] * args.load_repeat, traced=1)
+    for extra in loaded[:-1]:
+        extra.close()
+    kb = loaded[-1]
+    if kb.load_error:
+        raise kb.load_error
+        
+    note_ids = rng.choices(kb.notes.note_ids(), k=args.samples)
+    tags = notes.tag_choices(args.samples, rng)
+    queries = notes.queries(args.samples, rng)
+    
+    # search_notes: one ranked page, exact and with a typo in the last word
+    results['search'] = measure(kb.search, [(query,) for query in queries])
+    typos = [transpose(query, rng) for query in queries]
+    results['search_fuzzy'] = measure(lambda query: kb.search(query, fuzzy=True), [(query,) for query in typos])
+    
+    # filter_by_tag: the ids carrying a tag and the first screen of their notes
+    def filter_by_tag(tag):
+        kb.notes.get_many(kb.tagged_note_ids(tag)[:100])
+    results['filter_by_tag'] = measure(filter_by_tag, [(tag,) for tag in tags])
+    
+    # update_tags: retag a note, updating the search, tag and statistics indexes
+    edits = []
+    originals = {}
+    for note_id, tag in zip(note_ids, tags):
+        note = kb.notes.get(note_id)
+        edits.append((note_id, note.title, [tag], kb.note_content(note)))
+        originals.setdefault(note_id, (note_id, note.title, note.tags, edits[-1][3]))
+    results['update_tags'] = measure(kb.edit_note, edits)
+    # Put the tags back so a store kept with --data-dir gives the same results next time
+    for original in originals.values():
+        kb.edit_note(*original)
+    kb.persistence.drain()
+    
+    # possible_duplicates: the lookup behind the hint shown after every save
+    results['possible_duplicates'] = measure(kb.possible_duplicates, [(kb.notes.get(note_id),) for note_id in note_ids])
+    
+    # update_stats: the figures shown in the main window
+    results['update_stats'] = measure(kb.stats, [()] * args.samples)
+    
+    # review_feedback: record a rating and reschedule the note
+    feedback = [(note_id, rng.choice(('easy', 'good', 'hard'))) for note_id in note_ids]
+    results['review_feedback'] = measure(kb.review, feedback)
+    kb.persistence.drain()
+    
+    # review_session: one card of a session over the notes due today, shown and answered
+    session = kb.review_session()
+    def review_card(feedback):
+        note = session.current()
+        if note:
+            kb.note_content(note)
+            session.prefetch()
+            session.answer(feedback)
+    results['review_session'] = measure(review_card, [(choice,) for _, choice in feedback])
+    session.finish()
+    kb.persistence.drain()
+    
+    # save_data: one changed note written through to storage
+    records = kb.archive_records(note_ids)
+    def save(record):
+        kb.store(kb.storage.save_note, record, kb.note_id_counter)
+        kb.persistence.drain()
+    results['save'] = measure(save, [(record,) for record in records])
+    
+    kb.close()
+    error = kb.storage_error()
+    if error:
+        raise error
+    usage = memory_usage()
+    if 'max_rss' in usage:  # Not reported on Windows; it is the peak of the whole run so far
+        results['max_rss_kib'] = usage['max_rss'] / 1024
+    return results
+
+def compare(results, baseline, tolerance):
+    """Operations whose median latency grew by more than tolerance times the baseline"""
+    regressions = []
+    for size, operations in results['sizes'].items():
+        for name, figures in operations.items():
+            old = baseline.get('sizes', {}).get(size, {}).get(name)
+            if isinstance(figures, dict) and isinstance(old, dict) and 'p50_ms' in old:
+                if figures['p50_ms'] > old['p50_ms'] * tolerance:
+                    regressions.append((size, name, old['p50_ms'], figures['p50_ms']))
+    return regressions
+
+def print_results(size, results):
+    print(f"\n{size} notes")
+    if 'import' in results:
+        print(f"  import: {results['import']['seconds']:.1f} s ({results['import']['notes_per_sec']:.0f} notes/s)")
+    print(f"  {'operation':<20}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'ops/s':>12}{'peak KiB':>12}")
+    for name, figures in results.items():
+        if name != 'import' and isinstance(figures, dict):
+            print(f"  {name:<20}{figures['p50_ms']:>10.3f}{figures['p90_ms']:>10.3f}{figures['p99_ms']:>10.3f}"
+                  f"{figures['ops_per_sec']:>12.0f}{figures['peak_kib']:>12.0f}")
+    if 'max_rss_kib' in results:
+        print(f"  peak resident memory: {results['max_rss_kib'] / 1024:.0f} MiB")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the knowledge base core on synthetic notes")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--backend', choices=['sqlite', 'json', 'sharded'], default='sqlite')
+    parser.add_argument('--samples', type=int, default=200, help="timed calls per operation")
+    parser.add_argument('--load-repeat', type=int, default=3, help="timed loads per size")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--content-words', type=int, default=60, help="median words per note")
+    parser.add_argument('--tags', type=int, default=200, help="number of distinct tags")
+    parser.add_argument('--data-dir', help="keep the generated stores here and reuse them on later runs")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="median slowdown over the baseline reported as a regression")
+    args = parser.parse_args(argv)
+    
+    notes = SyntheticNotes(args.seed, content_words=args.content_words, tag_vocabulary=args.tags)
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': args.backend,
+        'model': os.environ.get('KNOWLEDGE_ORGANIZER_MODEL', 'intervals'),
+        'samples': args.samples,
+        'sizes': {}
+    }
+    with tempfile.TemporaryDirectory() as scratch:
+        for size in args.sizes:
+            directory = os.path.join(args.data_dir or scratch, f"{args.backend}-{size}-{args.seed}")
+            os.makedirs(directory, exist_ok=True)
+            results['sizes'][str(size)] = bench_size(args, notes, size, directory)
+            print_results(size, results['sizes'][str(size)])
+            
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for size, name, old, new in regressions:
+            print(f"Regression: {name} at {size} notes went from {old:.3f} ms to {new:.3f} ms", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
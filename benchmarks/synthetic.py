@@ -0,0 +1,96 @@
+import argparse
+import datetime
+import math
+import random
+import sys
+from knowledge_core import NoteArchiveWriter
+
+class SyntheticNotes:
+    """Reproducible note records shaped like a real knowledge base"""
+    def __init__(self, seed=0, vocabulary_size=20000, content_words=60, content_sigma=0.8,
+                 tag_vocabulary=200, tags_per_note=(1, 4), review_spread=(-30, 120), max_streak=8):
+        self.seed = seed
+        self.content_words = content_words  # Median words per note; lengths are log-normal around it
+        self.content_sigma = content_sigma
+        self.tags_per_note = tags_per_note
+        self.review_spread = review_spread  # Next reviews fall this many days before and after today
+        self.max_streak = max_streak
+        
+        rng = random.Random(seed)
+        self.words = self.make_words(rng, vocabulary_size)
+        self.tags = [f"{word}-{i}" for i, word in enumerate(self.make_words(rng, tag_vocabulary))]
+        rng.shuffle(self.words)  # Ranks below follow list order, which should not be alphabetical
+        # Zipf-distributed pools, so a few words and tags are common and most are rare
+        self.word_pool = self.zipf_pool(self.words, 1 << 18)
+        self.tag_pool = self.zipf_pool(self.tags, 1 << 14)
+        
+    @staticmethod
+    def zipf_pool(items, size):
+        """Items repeated in proportion to 1/rank; uniform draws from it follow Zipf's law"""
+        harmonic = sum(1 / rank for rank in range(1, len(items) + 1))
+        return [item for rank, item in enumerate(items, 1) for _ in range(max(1, round(size / (rank * harmonic))))]
+        
+    @staticmethod
+    def make_words(rng, count):
+        syllables = [c + v for c in 'bcdfghjklmnprstvz' for v in 'aeiou']
+        words = set()
+        while len(words) < count:
+            words.add(''.join(rng.choices(syllables, k=rng.randint(2, 4))))
+        return sorted(words)
+        
+    def records(self, count, first_id=1, today=None):
+        """Yield count note records in the JSON data file schema"""
+        rng = random.Random(self.seed + first_id)
+        today = (today or datetime.date.today()).toordinal()
+        mu = math.log(self.content_words)
+        for note_id in range(first_id, first_id + count):
+            length = max(1, int(rng.lognormvariate(mu, self.content_sigma)))
+            review_day = today + rng.randint(*self.review_spread)
+            streak = rng.randint(0, self.max_streak)
+            reviewed_day = min(today, review_day - rng.randint(1, 2 ** min(streak, 6)))
+            yield {
+                'id': note_id,
+                'title': ' '.join(rng.choices(self.word_pool, k=rng.randint(2, 6))).capitalize(),
+                'tags': sorted(set(rng.choices(self.tag_pool, k=rng.randint(*self.tags_per_note)))),
+                'content': ' '.join(rng.choices(self.word_pool, k=length)),
+                'created': datetime.date.fromordinal(reviewed_day - rng.randint(0, 365)).isoformat(),
+                'last_reviewed': datetime.date.fromordinal(reviewed_day).isoformat(),
+                'next_review': datetime.date.fromordinal(review_day).isoformat(),
+                'streak': streak
+            }
+            
+    def queries(self, count, rng):
+        """Search queries of one to three words, drawn with the same skew as note text"""
+        return [' '.join(rng.choices(self.word_pool, k=rng.randint(1, 3)))
+                for _ in range(count)]
+                
+    def tag_choices(self, count, rng):
+        return rng.choices(self.tag_pool, k=count)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic knowledge base as an importable archive")
+    parser.add_argument('count', type=int)
+    parser.add_argument('path', help=".jsonl (or legacy .json) archive to write")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--content-words', type=int, default=60, help="median words per note")
+    parser.add_argument('--tags', type=int, default=200, help="number of distinct tags")
+    args = parser.parse_args(argv)
+    
+    notes = SyntheticNotes(args.seed, content_words=args.content_words, tag_vocabulary=args.tags)
+    writer = NoteArchiveWriter(args.path, args.count + 1)
+    batch = []
+    for record in notes.records(args.count):
+        batch.append(record)
+        if len(batch) == 1000:
+            writer.put(batch, block=True)
+            batch = []
+    writer.put(batch, block=True)
+    writer.put(None, block=True)
+    writer.thread.join()
+    if writer.error:
+        print(f"Failed to write {args.path}: {writer.error}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
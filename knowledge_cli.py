@@ -0,0 +1,193 @@
+import argparse
+import sys
+from knowledge_core import KnowledgeBase, MEMORY_MODELS, Profiler, open_memory_model
+
+def positive_int(text):
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return value
+    
+def note_line(note):
+    return f"{note.id}\t{note.title}\t{', '.join(note.tags)}\t{note.next_review}\t{note.streak}"
+
+def run(kb, args):
+    if args.command == 'add':
+        content = args.content if args.content is not None else sys.stdin.read().strip()
+        tags = [tag.strip() for tag in args.tags.split(',') if tag.strip()]
+        if not args.title.strip() or not content:
+            print("Title and content cannot be empty", file=sys.stderr)
+            return 1
+        print(kb.add_note(args.title.strip(), tags, content).id)
+        
+    elif args.command == 'import':
+        count = kb.import_archive(args.path, merge=not args.replace)
+        print(f"Imported {count} notes")
+        
+    elif args.command == 'export':
+        count = kb.export_archive(args.path)
+        print(f"Exported {count} notes")
+        
+    elif args.command == 'search':
+        notes, total = kb.search(args.query.lower(), args.limit, args.offset, fuzzy=args.fuzzy)
+        for note in notes:
+            print(note_line(note))
+        print(f"{total} matching notes", file=sys.stderr)
+        
+    elif args.command == 'due':
+        due_notes = kb.due_notes()
+        for note in due_notes[:args.limit]:
+            print(note_line(note))
+        print(f"{len(due_notes)} notes due for review", file=sys.stderr)
+        
+    elif args.command == 'review':
+        note = kb.review(args.id, args.feedback)
+        if not note:
+            print(f"No note with id {args.id}", file=sys.stderr)
+            return 1
+        print(note_line(note))
+        
+    elif args.command == 'reschedule':
+        model = open_memory_model(args.model) if args.model else None
+        moved = kb.reschedule_all(model, smooth=not args.no_smooth, max_per_day=args.max_per_day)
+        print(f"Rescheduled {moved} notes")
+        
+    elif args.command == 'forecast':
+        for day, count in enumerate(kb.forecast(args.days)):
+            print(f"{day}\t{count}")
+            
+    elif args.command == 'duplicates':
+        groups = kb.duplicate_groups()
+        for group in groups:
+            for note in group:
+                print(note_line(note))
+            print()
+            if args.merge:
+                kb.merge_notes(group[0].id, [note.id for note in group[1:]])
+        print(f"{len(groups)} groups of possible duplicates{' merged' if args.merge and groups else ''}", file=sys.stderr)
+        
+    elif args.command == 'merge':
+        if args.keep not in kb.notes:
+            print(f"No note with id {args.keep}", file=sys.stderr)
+            return 1
+        print(f"Merged {kb.merge_notes(args.keep, args.ids)} notes into {args.keep}")
+        
+    elif args.command == 'show':
+        note = kb.notes.get(args.id)
+        if not note:
+            print(f"No note with id {args.id}", file=sys.stderr)
+            return 1
+        print(note.title)
+        print("Tags: " + ", ".join(note.tags))
+        print(f"Created: {note.created} | Last Reviewed: {note.last_reviewed} | "
+              f"Next Review: {note.next_review} | Strength: {note.streak}")
+        print()
+        print(kb.note_content(note))
+        
+    elif args.command == 'stats':
+        stats = kb.stats()
+        print(f"Total Notes: {stats['total_notes']}\n"
+              f"Total Tags: {stats['total_tags']}\n"
+              f"Due Reviews: {stats['due_reviews']}\n"
+              f"Avg. Strength: {stats['avg_streak']:.1f}")
+        if args.detail:
+            print_detailed_stats(kb)
+    return 0
+    
+def print_detailed_stats(kb):
+    print("\nTag\tNotes\tAvg. Strength")
+    for tag, (count, avg_streak) in sorted(kb.tag_stats().items()):
+        print(f"{tag}\t{count}\t{avg_streak:.1f}")
+        
+    print("\nDays ago\tReviews")
+    counts = kb.reviews_per_day()
+    for days_ago, count in enumerate(reversed(counts)):
+        print(f"{days_ago}\t{count}")
+        
+    print("\nDays since last review\tReviews\tRemembered")
+    for shortest, longest, reviews, retention in kb.retention_curve():
+        print(f"{shortest}-{longest}\t{reviews}\t{retention:.0%}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Work with the knowledge base without the GUI")
+    parser.add_argument('--metrics', metavar='PATH', help="write operation timings to PATH (.prom for Prometheus text, else JSON)")
+    parser.add_argument('--profile', metavar='PATH', help="profile the command, saving cProfile stats to PATH")
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    add = commands.add_parser('add', help="add a note")
+    add.add_argument('title')
+    add.add_argument('--tags', default='', help="comma separated tags")
+    add.add_argument('--content', help="note content; read from standard input if omitted")
+    
+    import_ = commands.add_parser('import', help="add every note in a .jsonl or .json archive")
+    import_.add_argument('path')
+    import_.add_argument('--replace', action='store_true', help="replace all notes instead of merging")
+    
+    export = commands.add_parser('export', help="write every note to a .jsonl or .json archive")
+    export.add_argument('path')
+    
+    search = commands.add_parser('search', help="list notes matching a query, best first")
+    search.add_argument('query')
+    search.add_argument('--limit', type=int, default=20)
+    search.add_argument('--offset', type=int, default=0)
+    search.add_argument('--fuzzy', action='store_true', help="also match misspellings and word beginnings")
+    
+    due = commands.add_parser('due', help="list notes due for review")
+    due.add_argument('--limit', type=int, default=50)
+    
+    review = commands.add_parser('review', help="record how well a note was remembered")
+    review.add_argument('id', type=int)
+    review.add_argument('feedback', choices=['easy', 'good', 'hard'])
+    
+    reschedule = commands.add_parser('reschedule', help="recompute every next review date (needs NumPy)")
+    reschedule.add_argument('--model', choices=sorted(MEMORY_MODELS),
+                            help="memory model to use; defaults to KNOWLEDGE_ORGANIZER_MODEL")
+    reschedule.add_argument('--max-per-day', type=positive_int, help="most reviews to leave on one day")
+    reschedule.add_argument('--no-smooth', action='store_true', help="do not spread reviews over days")
+    
+    forecast = commands.add_parser('forecast', help="print reviews per day ahead, in days from today (needs NumPy)")
+    forecast.add_argument('--days', type=int, default=30)
+    
+    duplicates = commands.add_parser('duplicates', help="list groups of notes with the same or nearly the same text")
+    duplicates.add_argument('--merge', action='store_true', help="merge each group into its oldest note")
+    
+    merge = commands.add_parser('merge', help="merge notes into one, which keeps its text and gains their tags")
+    merge.add_argument('keep', type=int)
+    merge.add_argument('ids', type=int, nargs='+')
+    
+    show = commands.add_parser('show', help="print a note")
+    show.add_argument('id', type=int)
+    
+    stats = commands.add_parser('stats', help="print knowledge base statistics")
+    stats.add_argument('--detail', action='store_true', help="also print per-tag stats, recent reviews and retention")
+    
+    args = parser.parse_args(argv)
+    kb = KnowledgeBase()
+    if kb.load_error:
+        # Nothing is written over data that could not be read
+        print(f"Failed to load data: {kb.load_error}", file=sys.stderr)
+        return 1
+        
+    profiler = Profiler()
+    if args.profile:
+        profiler.start()
+    try:
+        status = run(kb, args)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        status = 1
+    finally:
+        kb.close()
+        
+    if args.profile:
+        print(profiler.stop(args.profile), file=sys.stderr)
+    if args.metrics:
+        kb.export_metrics(args.metrics)
+    error = kb.storage_error()
+    if error:
+        print(f"Failed to save data: {error}", file=sys.stderr)
+        return 1
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2725 @@
+import json
+import datetime
+from collections import defaultdict, Counter, OrderedDict, deque
+import random
+import functools
+import contextlib
+import time
+import sqlite3
+import threading
+import queue
+import codecs
+import struct
+import hashlib
+import zlib
+import heapq
+import bisect
+import math
+import re
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Not on Windows; peak resident memory is then not reported
+    resource = None
+
+class IntervalTableModel:
+    """The original memory model: a fixed table of review intervals indexed by streak"""
+    def __init__(self, intervals=(1, 3, 7, 14, 30, 60)):
+        self.intervals = list(intervals)  # Days between reviews
+        
+    def next_interval(self, streak, ease=None):
+        return self.intervals[min(streak, len(self.intervals) - 1)]
+        
+    def next_intervals(self, streaks, ease=None):
+        import numpy as np
+        return np.asarray(self.intervals, dtype=np.int64)[np.minimum(streaks, len(self.intervals) - 1)]
+
+class SM2Model:
+    """SM-2 style growth: 1 and 6 days, then each step multiplies the interval by the ease factor"""
+    def __init__(self, ease=2.5, maximum_interval=36500):
+        self.ease = ease
+        self.maximum_interval = maximum_interval
+        
+    def next_interval(self, streak, ease=None):
+        if streak == 0:
+            return 1
+        return int(min(round(6 * (ease or self.ease) ** (streak - 1)), self.maximum_interval))
+        
+    def next_intervals(self, streaks, ease=None):
+        import numpy as np
+        ease = self.ease if ease is None else ease
+        growth = 6 * np.power(ease, np.maximum(streaks - 1, 0).astype(np.float64))
+        return np.where(streaks == 0, 1, np.minimum(np.rint(growth), self.maximum_interval)).astype(np.int64)
+
+class FSRSModel:
+    """FSRS-style model: stability grows with each recall and intervals target a desired retention"""
+    # FSRS-4.5 default weights; w[2] is the initial stability after a 'good' first answer
+    weights = (0.4872, 1.4003, 3.7145, 13.8206, 5.1618, 1.2298, 0.8975, 0.031, 1.6474,
+               0.1367, 1.0461, 2.1072, 0.0793, 0.3246, 1.587, 0.2272, 2.8755)
+    decay = -0.5
+    factor = 19 / 81
+    
+    def __init__(self, desired_retention=0.9, difficulty=None, maximum_interval=36500):
+        self.desired_retention = desired_retention
+        self.difficulty = self.weights[4] if difficulty is None else difficulty
+        self.maximum_interval = maximum_interval
+        
+    def recall_stability(self, stability, difficulty, xp=math):
+        # Stability after a successful review held on schedule, i.e. at the desired retention
+        w = self.weights
+        return stability * (1 + xp.exp(w[8]) * (11 - difficulty) * stability ** -w[9] *
+                            (xp.exp(w[10] * (1 - self.desired_retention)) - 1))
+                            
+    def interval(self, stability):
+        return stability / self.factor * (self.desired_retention ** (1 / self.decay) - 1)
+        
+    def next_interval(self, streak, ease=None):
+        # ease, when given, is the note's difficulty (1 easy to 10 hard)
+        stability = self.weights[2]
+        for _ in range(streak):
+            if self.interval(stability) >= self.maximum_interval:
+                break
+            stability = self.recall_stability(stability, ease or self.difficulty)
+        return int(max(1, min(round(self.interval(stability)), self.maximum_interval)))
+        
+    def next_intervals(self, streaks, ease=None):
+        import numpy as np
+        difficulty = self.difficulty if ease is None else ease
+        stability = np.full(len(streaks), self.weights[2])
+        for step in range(int(streaks.max(initial=0))):
+            growing = (streaks > step) & (self.interval(stability) < self.maximum_interval)
+            if not growing.any():
+                break
+            stability = np.where(growing, self.recall_stability(stability, difficulty, np), stability)
+        return np.clip(np.rint(self.interval(stability)), 1, self.maximum_interval).astype(np.int64)
+
+MEMORY_MODELS = {'intervals': IntervalTableModel, 'sm2': SM2Model, 'fsrs': FSRSModel}
+
+def open_memory_model(name=None):
+    """Create the memory model named by KNOWLEDGE_ORGANIZER_MODEL ('intervals', 'sm2' or 'fsrs')"""
+    name = name or os.environ.get('KNOWLEDGE_ORGANIZER_MODEL', 'intervals')
+    if name not in MEMORY_MODELS:
+        raise ValueError(f"Unknown memory model: {name}")
+    return MEMORY_MODELS[name]()
+
+class SpacedRepetitionCalculator:
+    """Implements a simple spaced repetition algorithm on top of a pluggable memory model"""
+    def __init__(self, model=None):
+        self.model = model or IntervalTableModel()
+    
+    def next_review_date(self, current_streak, today=None):
+        today = today or datetime.date.today()
+        return today + datetime.timedelta(days=self.model.next_interval(current_streak))
+
+# Notes share a small set of distinct dates, so conversions are cached
+@functools.lru_cache(maxsize=4096)
+def iso_to_day(value):
+    return datetime.date.fromisoformat(value).toordinal()
+
+@functools.lru_cache(maxsize=4096)
+def day_to_iso(day):
+    return datetime.date.fromordinal(day).isoformat()
+
+class TagTable:
+    """Interns tag names as small ints shared by every note"""
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.lock = threading.Lock()  # Notes read in by a refresh are built on the persistence thread
+        
+    def intern(self, tag):
+        tag_id = self.ids.get(tag)
+        if tag_id is None:
+            with self.lock:
+                tag_id = self.ids.get(tag)
+                if tag_id is None:
+                    # The name goes in first, so an id seen without the lock always has one
+                    self.names.append(sys.intern(tag))
+                    tag_id = self.ids[tag] = len(self.names) - 1
+        return tag_id
+
+class Note:
+    """Compact note record; dates are kept as day ordinals and tags as TagTable ids"""
+    __slots__ = ('id', 'title', 'tag_ids', 'content', 'created_day', 'reviewed_day', 'review_day', 'streak')
+    tag_table = TagTable()
+    
+    def __init__(self, id, title, tags, content, created_day, reviewed_day, review_day, streak=0):
+        self.id = id
+        self.title = title
+        self.tags = tags
+        self.content = content  # None while the body is only in storage (lazy loading)
+        self.created_day = created_day
+        self.reviewed_day = reviewed_day
+        self.review_day = review_day
+        self.streak = streak
+        
+    @property
+    def tags(self):
+        return [self.tag_table.names[tag_id] for tag_id in self.tag_ids]
+        
+    @tags.setter
+    def tags(self, tags):
+        self.tag_ids = tuple(self.tag_table.intern(tag) for tag in tags)
+        
+    # ISO date views matching the JSON schema
+    @property
+    def created(self):
+        return day_to_iso(self.created_day)
+        
+    @property
+    def last_reviewed(self):
+        return day_to_iso(self.reviewed_day)
+        
+    @last_reviewed.setter
+    def last_reviewed(self, value):
+        self.reviewed_day = iso_to_day(value)
+        
+    @property
+    def next_review(self):
+        return day_to_iso(self.review_day)
+        
+    @next_review.setter
+    def next_review(self, value):
+        self.review_day = iso_to_day(value)
+        
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['title'], data['tags'], data.get('content'),
+                   iso_to_day(data['created']), iso_to_day(data['last_reviewed']), iso_to_day(data['next_review']),
+                   data['streak'])
+        
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'title': self.title,
+            'tags': self.tags,
+            'content': self.content,
+            'created': self.created,
+            'last_reviewed': self.last_reviewed,
+            'next_review': self.next_review,
+            'streak': self.streak
+        }
+        if self.content is None:
+            del data['content']
+        return data
+
+class SearchCancelled(Exception):
+    """Raised inside a search that a newer query has made unnecessary"""
+
+def checked(items, cancelled, every=4096):
+    """Iterate items, raising SearchCancelled once cancelled() turns true (polled every few thousand)"""
+    if cancelled is None:
+        return items
+    def generate():
+        for count, item in enumerate(items):
+            if not count % every and cancelled():
+                raise SearchCancelled()
+            yield item
+    return generate()
+
+def edit_distance(a, b, limit):
+    """Edit distance between a and b counting a swap of neighbouring letters as one edit,
+    or limit + 1 as soon as it must exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+class TrigramIndex:
+    """Character trigrams of the search vocabulary, for typo-tolerant term lookup and prefix completion"""
+    # Terms are only ever added, so another thread may read the index while it grows
+    candidates = 300  # Most terms verified with edit_distance per lookup
+    
+    def __init__(self):
+        self.terms = []     # term id -> term
+        self.term_ids = {}
+        self.grams = {}     # trigram -> ids of the terms containing it
+        self.counts = {}    # term -> notes containing it, where the caller tracks that here
+        self.sorted_terms = []
+        
+    @staticmethod
+    def trigrams(term):
+        padded = f'${term}$'
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+        
+    @staticmethod
+    def max_distance(term):
+        # Short words have too few trigrams to find their misspellings reliably
+        return 0 if len(term) < 4 else 1 if len(term) < 8 else 2
+        
+    def add(self, term, count=1, keep_sorted=True):
+        self.counts[term] = self.counts.get(term, 0) + count
+        if term in self.term_ids:
+            return
+        term_id = len(self.terms)
+        self.terms.append(term)
+        self.term_ids[term] = term_id
+        for gram in self.trigrams(term):
+            self.grams.setdefault(gram, []).append(term_id)
+        if keep_sorted:
+            bisect.insort(self.sorted_terms, term)
+            
+    def rebuild(self, terms):
+        """Index (term, count) pairs in bulk"""
+        for term, count in terms:
+            self.add(term, count, keep_sorted=False)
+        self.sorted_terms = sorted(self.terms)
+        
+    def similar(self, term, max_distance=None):
+        """Vocabulary terms within a few edits of term, closest first"""
+        if max_distance is None:
+            max_distance = self.max_distance(term)
+        if max_distance == 0:
+            return [term] if term in self.term_ids else []
+            
+        # Each edit touches at most four trigrams (a swap of two letters inside the word changes the four
+        # covering them), so a close term shares all the others; only the terms sharing the most are
+        # checked, which keeps lookups fast in a large vocabulary
+        grams = self.trigrams(term)
+        needed = max(1, len(grams) - 4 * max_distance)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+            
+        found = []
+        for term_id, count in shared.most_common(self.candidates):
+            candidate = self.terms[term_id]
+            if count < needed:
+                break
+            if abs(len(candidate) - len(term)) <= max_distance:
+                distance = edit_distance(term, candidate, max_distance)
+                if distance <= max_distance:
+                    found.append((distance, candidate))
+                    
+        # In a short word one swap can change every trigram, so single swaps are also looked up directly
+        seen = {candidate for _, candidate in found}
+        for i in range(len(term) - 1):
+            swapped = term[:i] + term[i + 1] + term[i] + term[i + 2:]
+            if swapped != term and swapped in self.term_ids and swapped not in seen:
+                seen.add(swapped)
+                found.append((1, swapped))
+        return [candidate for _, candidate in sorted(found)]
+        
+    def complete(self, prefix, limit=10, frequency=None, scan=2000):
+        """The most frequent terms starting with prefix (looking at no more than scan of them)"""
+        frequency = frequency or self.counts.get
+        terms = self.sorted_terms
+        start = bisect.bisect_left(terms, prefix)
+        end = start
+        while end < len(terms) and end - start < scan and terms[end].startswith(prefix):
+            end += 1
+        return heapq.nlargest(limit, terms[start:end], key=lambda term: frequency(term) or 0)
+        
+    def alternatives(self, query, known, frequency=None, limit=10):
+        """Map query words to the terms they may stand for: close spellings of unknown words,
+        and completions of a last word that is still being typed"""
+        # known(term) says whether a term still occurs in some note; phrases are left exact
+        phrases = SearchIndex.parse_query(query)
+        result = {}
+        for i, phrase in enumerate(phrases):
+            if len(phrase) > 1:
+                continue
+            word = phrase[0]
+            variants = [word] if known(word) else [term for term in self.similar(word) if known(term)][:limit]
+            if i == len(phrases) - 1 and query[-1:].isalnum():
+                variants += [term for term in self.complete(word, limit, frequency)
+                             if term not in variants and known(term)]
+            if variants and variants != [word]:
+                result[word] = variants
+        return result
+        
+    def suggestions(self, query, limit=8, frequency=None):
+        """Whole queries completing the query's last word"""
+        match = re.search(r'\w+$', query)
+        if not match:
+            return []
+        prefix = match.group().lower()
+        return [query[:match.start()] + term for term in self.complete(prefix, limit, frequency) if term != prefix]
+
+class SearchIndex:
+    """Inverted index mapping terms to the notes (and positions) they occur in"""
+    token_pattern = re.compile(r'\w+')
+    field_weights = (3.0, 2.0, 1.0)  # Title and tag matches count more than content
+    k1 = 1.2
+    b = 0.75
+    
+    def __init__(self):
+        # term -> {note_id: [title positions, tag positions, content positions]}
+        self.postings = {}
+        # note_id -> [title length, tags length, content length], in tokens
+        self.lengths = {}
+        self.total_lengths = [0, 0, 0]
+        self.frozen = None  # Latest snapshot, until the index changes
+        self.copied_terms = None  # Terms whose postings no longer share a dict with a snapshot
+        self.vocabulary = TrigramIndex()  # Shared with snapshots; only ever grows
+        
+    @classmethod
+    def tokenize(cls, text):
+        return cls.token_pattern.findall(text.lower())
+        
+    def note_fields(self, note):
+        tag_tokens = []
+        for tag in note.tags:
+            tag_tokens.extend(self.tokenize(tag))
+            tag_tokens.append(None)  # Gap so phrases never span two tags
+        return self.tokenize(note.title), tag_tokens, self.tokenize(note.content)
+        
+    def snapshot(self):
+        """A read-only copy for searching on another thread, cheap to take again until the index changes"""
+        if self.frozen is None:
+            frozen = SearchIndex()
+            frozen.postings = dict(self.postings)
+            frozen.lengths = dict(self.lengths)
+            frozen.total_lengths = list(self.total_lengths)
+            frozen.vocabulary = self.vocabulary
+            self.frozen = frozen
+            self.copied_terms = set()  # Every postings dict is now shared with the snapshot
+        return self.frozen
+        
+    def writable_postings(self, term):
+        # Copy on write: postings still shared with a snapshot are copied before their first change
+        notes = self.postings.get(term)
+        if self.copied_terms is not None and term not in self.copied_terms:
+            self.copied_terms.add(term)
+            if notes is not None:
+                notes = self.postings[term] = dict(notes)
+        return notes
+        
+    def add_note(self, note):
+        note_id = note.id
+        fields = self.note_fields(note)
+        self.frozen = None
+        self.lengths[note_id] = [len(tokens) - tokens.count(None) for tokens in fields]
+        for field, tokens in enumerate(fields):
+            self.total_lengths[field] += self.lengths[note_id][field]
+            for position, term in enumerate(tokens):
+                if term is None:
+                    continue
+                notes = self.writable_postings(term)
+                if notes is None:
+                    notes = self.postings[term] = {}
+                    if self.vocabulary is not None:
+                        self.vocabulary.add(term)
+                if note_id not in notes:
+                    notes[note_id] = [[], [], []]
+                notes[note_id][field].append(position)
+                
+    def remove_note(self, note):
+        # Must be called with the note as it was indexed (before editing it)
+        note_id = note.id
+        self.frozen = None
+        lengths = self.lengths.pop(note_id, None)
+        if lengths:
+            for field, length in enumerate(lengths):
+                self.total_lengths[field] -= length
+        for tokens in self.note_fields(note):
+            for term in tokens:
+                notes = self.writable_postings(term)
+                if notes is None:
+                    continue
+                notes.pop(note_id, None)
+                if not notes:
+                    del self.postings[term]
+                    
+    def rebuild(self, notes):
+        self.postings = {}
+        self.lengths = {}
+        self.total_lengths = [0, 0, 0]
+        self.frozen = self.copied_terms = None
+        self.vocabulary = None  # Built in bulk afterwards
+        for note in notes:
+            self.add_note(note)
+        self.rebuild_vocabulary()
+        
+    def rebuild_vocabulary(self):
+        self.vocabulary = TrigramIndex()
+        self.vocabulary.rebuild((term, 0) for term in self.postings)
+        
+    def frequency(self, term):
+        return len(self.postings.get(term, ()))
+        
+    def suggestions(self, query, limit=8):
+        return self.vocabulary.suggestions(query, limit, self.frequency)
+        
+    @classmethod
+    def parse_query(cls, query):
+        """Split a query into phrases; quoted text is a phrase, other words stand alone"""
+        phrases = []
+        for i, part in enumerate(query.split('"')):
+            terms = cls.tokenize(part)
+            if i % 2:
+                if terms:
+                    phrases.append(terms)
+            else:
+                phrases.extend([term] for term in terms)
+        return phrases
+        
+    def term_postings(self, terms, alternatives):
+        """Postings of each query term; a term with alternatives matches a note containing any of them.
+        Also returns, per such term, how much each note's closest variant counts towards its score"""
+        postings = {}
+        weights = {}
+        for term in terms:
+            if term not in alternatives:
+                postings[term] = self.postings.get(term, {})
+                continue
+            merged = {}
+            weight = weights[term] = {}
+            for variant in alternatives[term]:
+                # Completions count fully; misspellings less the further they are from what was typed
+                closeness = 1.0 if variant.startswith(term) else 1 / (1 + edit_distance(term, variant, 2))
+                for note_id, entry in self.postings.get(variant, {}).items():
+                    if weight.get(note_id, 0) < closeness:
+                        merged[note_id] = entry
+                        weight[note_id] = closeness
+            postings[term] = merged
+        return postings, weights
+        
+    def match(self, query, cancelled=None, fuzzy=False):
+        """Return the matching note ids with the query's terms, their postings and variant weights"""
+        phrases = self.parse_query(query)
+        if not phrases:
+            return [], set(), {}, {}
+            
+        # Fuzzy searches also accept close spellings and completions of the words typed
+        alternatives = self.vocabulary.alternatives(query, self.postings.__contains__, self.frequency) if fuzzy else {}
+        terms = {term for phrase in phrases for term in phrase}
+        postings, weights = self.term_postings(terms, alternatives)
+        
+        # Intersect posting lists starting from the rarest term
+        lists = sorted(postings.values(), key=len)
+        matches = [note_id for note_id in checked(lists[0], cancelled)
+                   if all(note_id in notes for notes in lists[1:])]
+                   
+        for phrase in phrases:
+            if len(phrase) > 1:
+                matches = [note_id for note_id in checked(matches, cancelled) if self.contains_phrase(note_id, phrase)]
+        return matches, terms, postings, weights
+        
+    def search(self, query, cancelled=None, fuzzy=False):
+        """Return ids of notes containing every query term and phrase"""
+        return self.match(query, cancelled, fuzzy)[0]
+        
+    def ranked_search(self, query, limit, offset=0, cancelled=None, fuzzy=False):
+        """Return one page of matching note ids, best BM25 score first, and the total match count"""
+        # cancelled, if given, is polled during long searches, which then raise SearchCancelled
+        matches, terms, postings, weights = self.match(query, cancelled, fuzzy)
+        if not matches:
+            return [], 0
+            
+        note_count = len(self.lengths)
+        idf = {term: math.log(1 + (note_count - len(postings[term]) + 0.5) / (len(postings[term]) + 0.5))
+               for term in terms}
+        average_lengths = [(total / note_count) or 1 for total in self.total_lengths]
+        
+        def score(note_id):
+            lengths = self.lengths[note_id]
+            total = 0.0
+            for term in terms:
+                # BM25F: length-normalise each field's frequency before weighting and saturating it
+                entry = postings[term][note_id]
+                frequency = 0.0
+                for field, positions in enumerate(entry):
+                    if positions:
+                        norm = 1 - self.b + self.b * lengths[field] / average_lengths[field]
+                        frequency += self.field_weights[field] * len(positions) / norm
+                total += idf[term] * frequency / (self.k1 + frequency) * weights.get(term, {}).get(note_id, 1.0)
+            return total
+            
+        # A bounded heap keeps only the notes up to the end of the requested page
+        top = heapq.nlargest(offset + limit, checked(matches, cancelled), key=score)
+        return top[offset:], len(matches)
+        
+    def contains_phrase(self, note_id, phrase):
+        entries = [self.postings[term][note_id] for term in phrase]
+        for field in range(3):
+            following = [set(entry[field]) for entry in entries[1:]]
+            for start in entries[0][field]:
+                if all(start + offset in positions for offset, positions in enumerate(following, 1)):
+                    return True
+        return False
+        
+    def save(self, path, stamp):
+        data = {'stamp': stamp, 'postings': self.postings, 'lengths': self.lengths}
+        with open(path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            
+    def load(self, path, stamp):
+        """Load a saved index; returns False if it is missing or was saved for other data"""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+            
+        if data.get('stamp') != stamp or 'lengths' not in data:
+            return False
+            
+        self.frozen = self.copied_terms = None
+        self.postings = {term: {int(note_id): entry for note_id, entry in notes.items()}
+                         for term, notes in data['postings'].items()}
+        self.lengths = {int(note_id): lengths for note_id, lengths in data['lengths'].items()}
+        self.total_lengths = [sum(lengths[field] for lengths in self.lengths.values()) for field in range(3)]
+        self.rebuild_vocabulary()
+        return True
+
+class TagIndex:
+    """Maps each tag to the ids of the notes carrying it; kept current by per-note deltas"""
+    def __init__(self):
+        self.notes_by_tag = {}
+        self.sorted_tags = []  # Kept sorted for the tag filter
+        
+    def __len__(self):
+        return len(self.notes_by_tag)
+        
+    def add_note(self, note):
+        """Returns True if this introduced a tag that no other note has"""
+        changed = False
+        for tag in set(note.tags):
+            note_ids = self.notes_by_tag.get(tag)
+            if note_ids is None:
+                note_ids = self.notes_by_tag[tag] = set()
+                bisect.insort(self.sorted_tags, tag)
+                changed = True
+            note_ids.add(note.id)
+        return changed
+        
+    def remove_note(self, note):
+        """Returns True if this removed the last note carrying some tag"""
+        changed = False
+        for tag in set(note.tags):
+            note_ids = self.notes_by_tag.get(tag)
+            if note_ids is None:
+                continue
+            note_ids.discard(note.id)
+            if not note_ids:
+                del self.notes_by_tag[tag]
+                del self.sorted_tags[bisect.bisect_left(self.sorted_tags, tag)]
+                changed = True
+        return changed
+        
+    def rebuild(self, notes):
+        self.notes_by_tag = {}
+        for note in notes:
+            for tag in note.tags:
+                self.notes_by_tag.setdefault(tag, set()).add(note.id)
+        self.sorted_tags = sorted(self.notes_by_tag)
+        
+    def note_ids(self, tag):
+        return sorted(self.notes_by_tag.get(tag, ()))
+        
+    def count(self, tag):
+        return len(self.notes_by_tag.get(tag, ()))
+        
+    def complete(self, prefix):
+        """Tags starting with prefix, in order"""
+        start = bisect.bisect_left(self.sorted_tags, prefix)
+        end = start
+        while end < len(self.sorted_tags) and self.sorted_tags[end].startswith(prefix):
+            end += 1
+        return self.sorted_tags[start:end]
+
+MINHASH_SLOTS = 32  # MinHash signature size; the slots are banded 4 at a time for LSH
+MINHASH_BANDS = 8
+MINHASH = struct.Struct(f'<{MINHASH_SLOTS}I')
+
+def note_fingerprint(title, content):
+    """Content hash and MinHash signature of a note's words, ignoring case, spacing and punctuation"""
+    words = SearchIndex.tokenize(title + '\n' + content)
+    content_hash = hashlib.blake2b(' '.join(words).encode(), digest_size=16).digest()
+    if not words:
+        return content_hash, b''
+        
+    # One permutation hashing: every word pair is hashed once into one of the slots, which keeps its minimum
+    empty = 1 << 32
+    slots = [empty] * MINHASH_SLOTS
+    hashes = [zlib.crc32(word.encode()) for word in words]
+    for shingle in ([a * 0x100000001B3 ^ b for a, b in zip(hashes, hashes[1:])] or hashes):
+        h = (shingle * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        slot, value = h >> 59, (h >> 27) & 0xFFFFFFFF
+        if value < slots[slot]:
+            slots[slot] = value
+    # Empty slots borrow from the next filled one so short notes still compare sensibly
+    for i in range(MINHASH_SLOTS):
+        j = i
+        while slots[j % MINHASH_SLOTS] == empty:
+            j += 1
+        if j != i:
+            slots[i] = (slots[j % MINHASH_SLOTS] + j - i) & 0xFFFFFFFF
+    return content_hash, MINHASH.pack(*slots)
+    
+def band_keys(signature):
+    """LSH bucket keys; notes sharing any of them are candidate near-duplicates"""
+    width = len(signature) // MINHASH_BANDS
+    return [band << 32 | zlib.crc32(signature[band * width:(band + 1) * width]) for band in range(MINHASH_BANDS)]
+    
+def signature_similarity(a, b):
+    """Estimated Jaccard similarity of the word pairs behind two signatures"""
+    if not a or not b:
+        return 0.0
+    return sum(x == y for x, y in zip(MINHASH.unpack(a), MINHASH.unpack(b))) / MINHASH_SLOTS
+    
+def group_duplicates(buckets, signature_of, threshold):
+    """Join notes that share a bucket and are similar enough into groups, largest first"""
+    parent = {}
+    
+    def find(note_id):
+        while parent.get(note_id, note_id) != note_id:
+            note_id = parent[note_id] = parent.get(parent[note_id], parent[note_id])
+        return note_id
+        
+    for bucket, exact in buckets:
+        # Members are compared with one note per group found so far instead of with each other
+        representatives = []
+        for note_id in bucket:
+            for other in representatives:
+                if exact or signature_similarity(signature_of(note_id), signature_of(other)) >= threshold:
+                    parent[find(note_id)] = find(other)
+                    break
+            else:
+                representatives.append(note_id)
+                
+    groups = defaultdict(list)
+    for note_id in parent:
+        groups[find(note_id)].append(note_id)
+    for root, members in groups.items():
+        if root not in parent:
+            members.append(root)
+    return sorted((sorted(members) for members in groups.values()), key=lambda g: (-len(g), g[0]))
+    
+class DuplicateIndex:
+    """Finds notes with the same words (content hash) or mostly the same words (MinHash banded into LSH buckets)"""
+    threshold = 0.7  # Estimated similarity from which a note is a possible duplicate
+    stored = False  # groups() reads memory only
+    
+    def __init__(self):
+        self.fingerprints = {}  # note_id -> (content hash, signature)
+        self.by_hash = {}       # content hash -> note ids
+        self.buckets = {}       # band key -> note ids
+        
+    def add_note(self, note):
+        self.add(note.id, note_fingerprint(note.title, note.content))
+        
+    def add_notes(self, notes):
+        for note in notes:
+            self.add_note(note)
+            
+    def add(self, note_id, fingerprint):
+        content_hash, signature = self.fingerprints[note_id] = fingerprint
+        if not signature:
+            return  # Nothing to compare
+        self.by_hash.setdefault(content_hash, []).append(note_id)
+        for key in band_keys(signature):
+            self.buckets.setdefault(key, []).append(note_id)
+            
+    def remove_note(self, note):
+        fingerprint = self.fingerprints.pop(note.id, None)
+        if not fingerprint or not fingerprint[1]:
+            return
+        content_hash, signature = fingerprint
+        for index, key in [(self.by_hash, content_hash)] + [(self.buckets, key) for key in band_keys(signature)]:
+            note_ids = index[key]
+            note_ids.remove(note.id)
+            if not note_ids:
+                del index[key]
+                
+    def rebuild(self, notes):
+        self.fingerprints = {}
+        self.by_hash = {}
+        self.buckets = {}
+        for note in notes:
+            self.add_note(note)
+            
+    def duplicates(self, note_id, fingerprint):
+        """(note id, similarity) of the notes resembling a fingerprint, most similar first"""
+        content_hash, signature = fingerprint
+        if not signature:
+            return []
+        found = {other: 1.0 for other in self.by_hash.get(content_hash, ())}
+        for key in band_keys(signature):
+            for other in self.buckets.get(key, ()):
+                if other not in found:
+                    found[other] = signature_similarity(signature, self.fingerprints[other][1])
+        return sorted(((other, similarity) for other, similarity in found.items()
+                       if other != note_id and similarity >= self.threshold), key=lambda d: (-d[1], d[0]))
+                       
+    def groups(self):
+        """Lists of note ids that all look like duplicates of each other"""
+        buckets = [(ids, True) for ids in self.by_hash.values() if len(ids) > 1]
+        buckets += [(ids, False) for ids in self.buckets.values() if len(ids) > 1]
+        return group_duplicates(buckets, lambda note_id: self.fingerprints[note_id][1], self.threshold)
+        
+    def save(self, path, stamp):
+        data = {'stamp': stamp, 'fingerprints': {note_id: [content_hash.hex(), signature.hex()]
+                                                 for note_id, (content_hash, signature) in self.fingerprints.items()}}
+        with open(path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+            
+    def load(self, path, stamp):
+        """Load saved fingerprints; returns False if they are missing or were saved for other data"""
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+            
+        if data.get('stamp') != stamp or 'fingerprints' not in data:
+            return False
+            
+        self.fingerprints = {}
+        self.by_hash = {}
+        self.buckets = {}
+        for note_id, (content_hash, signature) in data['fingerprints'].items():
+            self.add(int(note_id), (bytes.fromhex(content_hash), bytes.fromhex(signature)))
+        return True
+
+class ReviewScheduler:
+    """Min-heap of notes keyed on their next review date, with lazy invalidation"""
+    def __init__(self):
+        self.heap = []       # (next_review ordinal, note_id); may hold stale entries
+        self.scheduled = {}  # note_id -> current next_review ordinal
+        
+    def schedule(self, note):
+        note_id = note.id
+        if self.scheduled.get(note_id) == note.review_day:
+            return
+            
+        # The old heap entry is left in place and skipped once it no longer matches
+        self.scheduled[note_id] = note.review_day
+        heapq.heappush(self.heap, (note.review_day, note_id))
+        self.compact_if_stale()
+        
+    def unschedule(self, note_id):
+        self.scheduled.pop(note_id, None)
+        self.compact_if_stale()
+        
+    def rebuild(self, notes):
+        self.scheduled = {n.id: n.review_day for n in notes}
+        self.compact_if_stale(force=True)
+        
+    def compact_if_stale(self, force=False):
+        if force or len(self.heap) > 2 * len(self.scheduled) + 64:
+            self.heap = [(review_day, note_id) for note_id, review_day in self.scheduled.items()]
+            heapq.heapify(self.heap)
+            
+    def due_ids(self, today=None):
+        """Ids of notes due on or before today, soonest first; O(due + stale) rather than O(all notes)"""
+        today = (today or datetime.date.today()).toordinal()
+        
+        # Walk only the part of the heap tree whose entries are due
+        due = []
+        seen = set()
+        stack = [0] if self.heap else []
+        while stack:
+            i = stack.pop()
+            review_day, note_id = self.heap[i]
+            if review_day > today:
+                continue
+            if self.scheduled.get(note_id) == review_day and note_id not in seen:
+                seen.add(note_id)
+                due.append((review_day, note_id))
+            stack.extend(child for child in (2 * i + 1, 2 * i + 2) if child < len(self.heap))
+            
+        due.sort()
+        return [note_id for _, note_id in due]
+        
+    def due_count(self, today=None):
+        return len(self.due_ids(today))
+        
+    def random_due(self, today=None):
+        due = self.due_ids(today)
+        return random.choice(due) if due else None
+
+class StatisticsEngine:
+    """Running totals kept current by per-note deltas, so reading the stats never scans the notes"""
+    def __init__(self):
+        self.rebuild(())
+        
+    def rebuild(self, notes, today=None):
+        self.total_notes = 0
+        self.streak_sum = 0
+        self.due_by_day = defaultdict(int)      # next review ordinal -> notes scheduled that day
+        self.tag_counts = defaultdict(int)      # tag id -> notes carrying it
+        self.tag_streak_sums = defaultdict(int)  # tag id -> streak total of those notes
+        self.today = (today or datetime.date.today()).toordinal()
+        self.due = 0  # Notes whose next review is on or before self.today
+        for note in notes:
+            self.add_note(note)
+            
+    def add_note(self, note):
+        self.apply(note, 1)
+        
+    def remove_note(self, note):
+        """Call with the note as it was, before it is edited, reviewed or deleted"""
+        self.apply(note, -1)
+        
+    def apply(self, note, sign):
+        self.total_notes += sign
+        self.streak_sum += sign * note.streak
+        self.due_by_day[note.review_day] += sign
+        if not self.due_by_day[note.review_day]:
+            del self.due_by_day[note.review_day]
+        if note.review_day <= self.today:
+            self.due += sign
+        for tag_id in set(note.tag_ids):
+            self.tag_counts[tag_id] += sign
+            self.tag_streak_sums[tag_id] += sign * note.streak
+            if not self.tag_counts[tag_id]:
+                del self.tag_counts[tag_id], self.tag_streak_sums[tag_id]
+                
+    def due_count(self, today=None):
+        today = (today or datetime.date.today()).toordinal()
+        if today != self.today:
+            # Only happens when the date changes; a step back (clock change) recounts from scratch
+            if today > self.today:
+                self.due += sum(count for day, count in self.due_by_day.items() if self.today < day <= today)
+            else:
+                self.due = sum(count for day, count in self.due_by_day.items() if day <= today)
+            self.today = today
+        return self.due
+        
+    def average_streak(self):
+        return self.streak_sum / self.total_notes if self.total_notes > 0 else 0
+        
+    def tag_stats(self):
+        """Tag name -> (note count, average streak)"""
+        names = Note.tag_table.names
+        return {names[tag_id]: (count, self.tag_streak_sums[tag_id] / count)
+                for tag_id, count in self.tag_counts.items()}
+
+class NoteRepository:
+    """Notes indexed by id, kept in insertion order, with O(1) get, update and delete"""
+    def __init__(self, notes=()):
+        self.by_id = {}   # Dicts preserve insertion order, so this is also the note order
+        self.ids = []     # Dense list of ids for O(1) random picks
+        self.slots = {}   # note_id -> position in self.ids
+        for note in notes:
+            self.add(note)
+            
+    def __len__(self):
+        return len(self.by_id)
+        
+    def __iter__(self):
+        return iter(self.by_id.values())
+        
+    def __contains__(self, note_id):
+        return note_id in self.by_id
+        
+    def get(self, note_id):
+        return self.by_id.get(note_id)
+        
+    def note_ids(self):
+        return list(self.by_id)
+        
+    def get_many(self, note_ids):
+        """Notes for the given ids in the same order, skipping ids that no longer exist"""
+        return [self.by_id[note_id] for note_id in note_ids if note_id in self.by_id]
+        
+    def add(self, note):
+        if note.id in self.by_id:
+            raise ValueError(f"Duplicate note id {note.id}")
+        self.by_id[note.id] = note
+        self.slots[note.id] = len(self.ids)
+        self.ids.append(note.id)
+        
+    def update(self, note_id, **changes):
+        note = self.by_id[note_id]
+        for field, value in changes.items():
+            setattr(note, field, value)
+        return note
+        
+    def delete(self, note_id):
+        note = self.by_id.pop(note_id)
+        # Move the last id into the freed slot so removal stays O(1)
+        slot = self.slots.pop(note_id)
+        last_id = self.ids.pop()
+        if last_id != note_id:
+            self.ids[slot] = last_id
+            self.slots[last_id] = slot
+        return note
+        
+    def random_note(self):
+        return self.by_id[random.choice(self.ids)] if self.ids else None
+
+class JSONStorage:
+    """Keeps the knowledge base in a JSON snapshot plus an append-only journal of later changes"""
+    def __init__(self, path='knowledge_organizer_data.json', index_path='knowledge_organizer_index.json',
+                 compact_after=2000):
+        self.path = path
+        self.index_path = index_path
+        self.journal_path = os.path.splitext(path)[0] + '.journal'
+        self.compact_after = compact_after  # Journal records before the snapshot is rewritten
+        self.journal = None
+        self.journal_records = 0
+        self.generation = 0  # Bumped by every snapshot; the journal records which one it extends
+        self.search_index = None
+        self.duplicate_index = None
+        self.duplicates_path = os.path.splitext(path)[0] + '.duplicates'
+        self.lazy = False  # The whole file has to be parsed anyway
+        self.shared = False  # Only this process writes to the file, so the notes in memory stay current
+        self.review_log = ReviewLog(os.path.splitext(path)[0] + '.reviews')
+        
+    def load(self, include_content=True):
+        """Read the snapshot and replay the journal on top of it"""
+        # Notes are converted while parsing so their dicts never pile up in memory
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f, object_hook=lambda d: Note.from_dict(d) if 'next_review' in d else d)
+        except FileNotFoundError:
+            if not os.path.exists(self.journal_path):
+                raise
+            data = {}
+            
+        notes = {note.id: note for note in data.get('notes', [])}
+        note_id_counter = data.get('note_id_counter', 1)
+        self.generation = data.get('generation', 0)
+        self.journal_records = 0
+        for record in self.read_journal():
+            if record['op'] == 'begin':
+                if record['generation'] != self.generation:
+                    # Left over from before the last snapshot was written, which already contains it
+                    open(self.journal_path, 'w').close()
+                    break
+                continue
+                
+            self.journal_records += 1
+            if record['op'] == 'save':
+                notes[record['note']['id']] = Note.from_dict(record['note'])
+                note_id_counter = max(note_id_counter, record['note_id_counter'])
+            elif record['op'] == 'counter':
+                note_id_counter = max(note_id_counter, record['note_id_counter'])
+            elif record['op'] == 'review' and record['id'] in notes:
+                note = notes[record['id']]
+                note.last_reviewed = record['last_reviewed']
+                note.next_review = record['next_review']
+                note.streak = record['streak']
+            elif record['op'] == 'delete':
+                notes.pop(record['id'], None)
+        return list(notes.values()), note_id_counter
+        
+    def read_journal(self):
+        try:
+            with open(self.journal_path, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        return  # A torn final record from a crash mid-append
+        except FileNotFoundError:
+            return
+            
+    def load_content(self, note_id):
+        # Notes from a JSON file are always loaded with their content
+        raise KeyError(note_id)
+        
+    def create_search_index(self, notes):
+        # Reuse the saved search index unless the data changed since it was written
+        self.search_index = SearchIndex()
+        if (not os.path.exists(self.path) or self.journal_records
+                or not self.search_index.load(self.index_path, self.data_file_stamp())):
+            self.search_index.rebuild(notes)
+        return self.search_index
+        
+    def create_duplicate_index(self, notes):
+        # Reused on the same terms as the search index
+        self.duplicate_index = DuplicateIndex()
+        if (not os.path.exists(self.path) or self.journal_records
+                or not self.duplicate_index.load(self.duplicates_path, self.data_file_stamp())):
+            self.duplicate_index.rebuild(notes)
+        return self.duplicate_index
+        
+    def create_review_scheduler(self, notes):
+        scheduler = ReviewScheduler()
+        scheduler.rebuild(notes)
+        return scheduler
+        
+    def backfill_fingerprints(self, batch_size=1000):
+        # The in-memory duplicate index fingerprints every note itself
+        return False
+        
+    def data_file_stamp(self):
+        stat = os.stat(self.path)
+        return [stat.st_size, stat.st_mtime_ns]
+        
+    # Changes are appended to the journal; sync() makes a batch of them durable
+    def append(self, record):
+        if self.journal is None:
+            self.journal = open(self.journal_path, 'a')
+            if self.journal.tell() == 0:
+                self.journal.write(json.dumps({'op': 'begin', 'generation': self.generation}) + '\n')
+        self.journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.journal_records += 1
+        
+    def save_note(self, note, note_id_counter):
+        self.append({'op': 'save', 'note': note, 'note_id_counter': note_id_counter})
+        
+    def save_notes(self, notes, note_id_counter):
+        for note in notes:
+            self.save_note(note, note_id_counter)
+            
+    def save_note_id_counter(self, note_id_counter):
+        self.append({'op': 'counter', 'note_id_counter': note_id_counter})
+        
+    def save_review(self, note_id, last_reviewed, next_review, streak):
+        self.append({'op': 'review', 'id': note_id, 'last_reviewed': last_reviewed,
+                     'next_review': next_review, 'streak': streak})
+        
+    def save_reviews(self, reviews):
+        for review in reviews:
+            self.save_review(*review)
+            
+    def log_reviews(self, events):
+        self.review_log.extend(events)
+        
+    def delete_note(self, note_id):
+        self.append({'op': 'delete', 'id': note_id})
+        
+    def replace_all(self, notes, note_id_counter):
+        self.write_snapshot(notes, note_id_counter)
+        
+    def sync(self):
+        if self.journal is not None:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+        self.review_log.sync()
+        
+        # Only compact once the journal is large next to the snapshot, so big imports stay linear
+        if (self.journal_records >= self.compact_after and
+                2 * os.path.getsize(self.journal_path) >= (os.path.getsize(self.path) if os.path.exists(self.path) else 0)):
+            self.compact()
+            
+    def compact(self):
+        """Fold the journal into a fresh snapshot"""
+        if self.journal is not None:
+            self.journal.flush()  # load() re-reads the journal file, so nothing may sit in the buffer
+        notes, note_id_counter = self.load()
+        self.write_snapshot([note.to_dict() for note in notes], note_id_counter)
+        
+    def write_snapshot(self, notes, note_id_counter):
+        data = {
+            'notes': notes,
+            'note_id_counter': note_id_counter,
+            'generation': self.generation + 1
+        }
+        
+        # Write aside and rename over the old snapshot so a crash never leaves a partial file
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        
+        # A crash before this point leaves a journal for the previous generation, which load skips
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        open(self.journal_path, 'w').close()
+        self.generation += 1
+        self.journal_records = 0
+        
+    def flush(self):
+        self.compact()
+        if self.search_index:
+            self.search_index.save(self.index_path, self.data_file_stamp())
+        if self.duplicate_index:
+            self.duplicate_index.save(self.duplicates_path, self.data_file_stamp())
+            
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.review_log.close()
+
+class SQLiteStorage:
+    """Keeps notes as rows in an SQLite database so each change is one small transaction"""
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS notes (
+            id INTEGER PRIMARY KEY,
+            title TEXT NOT NULL,
+            tags TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created TEXT NOT NULL,
+            last_reviewed TEXT NOT NULL,
+            next_review TEXT NOT NULL,
+            streak INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS notes_next_review ON notes (next_review);
+        CREATE TABLE IF NOT EXISTS note_tags (
+            note_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            PRIMARY KEY (note_id, tag)
+        );
+        CREATE INDEX IF NOT EXISTS note_tags_tag ON note_tags (tag);
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+            title, tags, content, content='notes', content_rowid='id', tokenize="unicode61 tokenchars '_'"
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts_vocab USING fts5vocab(notes_fts, 'row');
+        CREATE TRIGGER IF NOT EXISTS notes_fts_insert AFTER INSERT ON notes BEGIN
+            INSERT INTO notes_fts (rowid, title, tags, content) VALUES (new.id, new.title, new.tags, new.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_fts_delete AFTER DELETE ON notes BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, tags, content) VALUES ('delete', old.id, old.title, old.tags, old.content);
+        END;
+        CREATE TRIGGER IF NOT EXISTS notes_fts_update AFTER UPDATE OF title, tags, content ON notes
+        WHEN old.title IS NOT new.title OR old.tags IS NOT new.tags OR old.content IS NOT new.content BEGIN
+            INSERT INTO notes_fts (notes_fts, rowid, title, tags, content) VALUES ('delete', old.id, old.title, old.tags, old.content);
+            INSERT INTO notes_fts (rowid, title, tags, content) VALUES (new.id, new.title, new.tags, new.content);
+        END;
+        CREATE TABLE IF NOT EXISTS note_signatures (
+            note_id INTEGER PRIMARY KEY,
+            content_hash BLOB NOT NULL,
+            signature BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS note_signatures_hash ON note_signatures (content_hash);
+        CREATE TABLE IF NOT EXISTS note_bands (
+            band INTEGER NOT NULL,
+            note_id INTEGER NOT NULL,
+            PRIMARY KEY (band, note_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS note_bands_note ON note_bands (note_id);
+        CREATE TRIGGER IF NOT EXISTS note_signatures_delete AFTER DELETE ON notes BEGIN
+            DELETE FROM note_signatures WHERE note_id = old.id;
+            DELETE FROM note_bands WHERE note_id = old.id;
+        END;
+    """
+    columns = ('id', 'title', 'tags', 'content', 'created', 'last_reviewed', 'next_review', 'streak')
+    
+    def __init__(self, path='knowledge_organizer_data.db', legacy_json_path='knowledge_organizer_data.json', lazy=True):
+        self.path = path
+        self.lazy = lazy  # Load only note metadata; bodies are fetched with load_content
+        self.shared = False
+        self.local = threading.local()
+        self.review_log = ReviewLog(os.path.splitext(path)[0] + '.reviews')
+        self.backfilled_id = 0  # Notes up to this id have fingerprints
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.executescript(self.schema)
+        if self.get_meta('tags_encoding') != 'utf-8':
+            self.unescape_tags()
+        if self.get_meta('note_id_counter') is None and legacy_json_path and os.path.exists(legacy_json_path):
+            self.migrate_from_json(legacy_json_path)
+            
+    @property
+    def conn(self):
+        """This thread's connection; writes happen on the persistence thread while the UI reads"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+        
+    def migrate_from_json(self, json_path):
+        """One-time import of the old JSON data file; the file itself is left untouched"""
+        notes, note_id_counter = JSONStorage(json_path).load()
+        self.replace_all([note.to_dict() for note in notes], note_id_counter)
+        with self.conn:
+            self.set_meta('migrated_from', os.path.abspath(json_path))
+            
+    def unescape_tags(self):
+        """One-time rewrite of tags stored with \\u escapes, which the search index could not match"""
+        rows = self.conn.execute(r"SELECT id, tags FROM notes WHERE tags LIKE '%\u%'").fetchall()
+        with self.conn:
+            self.conn.executemany('UPDATE notes SET tags = ? WHERE id = ?',
+                                  [(json.dumps(json.loads(tags), ensure_ascii=False), note_id) for note_id, tags in rows])
+            if rows:
+                self.conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('rebuild')")
+            self.set_meta('tags_encoding', 'utf-8')
+            
+    def get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+        
+    def set_meta(self, key, value):
+        self.conn.execute('INSERT INTO meta (key, value) VALUES (?, ?) '
+                          'ON CONFLICT(key) DO UPDATE SET value = excluded.value', (key, str(value)))
+        
+    def load(self, include_content=None):
+        columns = self.load_columns(include_content)
+        notes = [self.row_note(columns, row) for row in self.note_rows(columns)]
+        return notes, int(self.get_meta('note_id_counter') or 1)
+        
+    def load_columns(self, include_content=None):
+        if include_content is None:
+            include_content = not self.lazy
+        return [c for c in self.columns if include_content or c != 'content']
+        
+    def note_rows(self, columns, where='', parameters=()):
+        # Fetch in pages so the cursor never buffers the whole table
+        cursor = self.conn.execute(f"SELECT {', '.join(columns)} FROM notes {where} ORDER BY id", parameters)
+        rows = cursor.fetchmany(5000)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(5000)
+            
+    @staticmethod
+    def row_note(columns, row):
+        data = dict(zip(columns, row))
+        data['tags'] = json.loads(data['tags'])
+        return Note.from_dict(data)
+        
+    def load_content(self, note_id):
+        row = self.conn.execute('SELECT content FROM notes WHERE id = ?', (note_id,)).fetchone()
+        return row[0] if row else ''
+        
+    def load_contents(self, note_ids):
+        rows = self.conn.execute(f"SELECT id, content FROM notes WHERE id IN ({', '.join('?' * len(note_ids))})",
+                                 list(note_ids))
+        return dict(rows)
+        
+    def create_search_index(self, notes):
+        # The FTS5 table is kept current by triggers, so there is nothing to build
+        return FTSSearchIndex(self)
+        
+    def create_duplicate_index(self, notes):
+        return SQLiteDuplicateIndex(self)
+        
+    def create_review_scheduler(self, notes):
+        scheduler = ReviewScheduler()
+        scheduler.rebuild(notes)
+        return scheduler
+        
+    def write_fingerprint(self, note_id, title, content):
+        content_hash, signature = note_fingerprint(title, content)
+        self.conn.execute('INSERT OR REPLACE INTO note_signatures (note_id, content_hash, signature) VALUES (?, ?, ?)',
+                          (note_id, content_hash, signature))
+        self.conn.execute('DELETE FROM note_bands WHERE note_id = ?', (note_id,))
+        if signature:
+            self.conn.executemany('INSERT OR IGNORE INTO note_bands (band, note_id) VALUES (?, ?)',
+                                  [(key, note_id) for key in band_keys(signature)])
+                                  
+    def backfill_fingerprints(self, batch_size=1000):
+        """Fingerprint a batch of notes saved before duplicate detection existed; True if more remain"""
+        rows = self.conn.execute('SELECT id, title, content FROM notes WHERE id > ? AND id NOT IN '
+                                 '(SELECT note_id FROM note_signatures) ORDER BY id LIMIT ?',
+                                 (self.backfilled_id, batch_size)).fetchall()
+        with self.conn:
+            for row in rows:
+                self.write_fingerprint(*row)
+        if rows:
+            self.backfilled_id = rows[-1][0]
+        return len(rows) == batch_size
+        
+    def write_note(self, note):
+        values = [note[column] for column in self.columns]
+        # Unescaped, so the search index sees tags such as 'naïve' as written
+        values[2] = json.dumps(note['tags'], ensure_ascii=False)
+        self.conn.execute(
+            f"INSERT INTO notes ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))}) "
+            "ON CONFLICT(id) DO UPDATE SET " + ', '.join(f'{c} = excluded.{c}' for c in self.columns[1:]),
+            values)
+        self.conn.execute('DELETE FROM note_tags WHERE note_id = ?', (note['id'],))
+        self.conn.executemany('INSERT OR IGNORE INTO note_tags (note_id, tag) VALUES (?, ?)',
+                              [(note['id'], tag) for tag in note['tags']])
+        self.write_fingerprint(note['id'], note['title'], note['content'])
+        
+    def save_note(self, note, note_id_counter):
+        with self.conn:
+            self.write_note(note)
+            self.set_meta('note_id_counter', note_id_counter)
+            
+    def save_notes(self, notes, note_id_counter):
+        with self.conn:
+            for note in notes:
+                self.write_note(note)
+            self.set_meta('note_id_counter', note_id_counter)
+            
+    def save_note_id_counter(self, note_id_counter):
+        with self.conn:
+            self.set_meta('note_id_counter', note_id_counter)
+            
+    def save_review(self, note_id, last_reviewed, next_review, streak):
+        with self.conn:
+            self.conn.execute('UPDATE notes SET last_reviewed = ?, next_review = ?, streak = ? WHERE id = ?',
+                              (last_reviewed, next_review, streak, note_id))
+            
+    def save_reviews(self, reviews):
+        with self.conn:
+            self.conn.executemany('UPDATE notes SET last_reviewed = ?, next_review = ?, streak = ? WHERE id = ?',
+                                  [(last_reviewed, next_review, streak, note_id)
+                                   for note_id, last_reviewed, next_review, streak in reviews])
+                                   
+    def log_reviews(self, events):
+        self.review_log.extend(events)
+        
+    def delete_note(self, note_id):
+        with self.conn:
+            self.conn.execute('DELETE FROM notes WHERE id = ?', (note_id,))
+            self.conn.execute('DELETE FROM note_tags WHERE note_id = ?', (note_id,))
+            
+    def replace_all(self, notes, note_id_counter):
+        with self.conn:
+            self.conn.execute('DELETE FROM notes')
+            self.conn.execute('DELETE FROM note_tags')
+            for note in notes:
+                self.write_note(note)
+            self.set_meta('note_id_counter', note_id_counter)
+            
+    def sync(self):
+        # Every note change is already its own committed transaction
+        self.review_log.sync()
+        
+    def flush(self):
+        # Fold the WAL back into the database
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+        self.review_log.close()
+
+class FTSSearchIndex:
+    """SearchIndex counterpart answering queries from SQLiteStorage's FTS5 table"""
+    def __init__(self, storage):
+        self.storage = storage
+        self.vocabulary = None  # Read from notes_fts_vocab on the first fuzzy search
+        self.vocabulary_lock = threading.Lock()
+        
+    @property
+    def conn(self):
+        # Each thread searches through its own connection, which WAL gives a consistent snapshot
+        return self.storage.conn
+        
+    def snapshot(self):
+        return self
+        
+    # The FTS5 table follows the notes table through triggers; only new words need noting here
+    def add_note(self, note):
+        if self.vocabulary is not None:
+            text = ' '.join([note.title, ' '.join(note.tags), note.content or ''])
+            for term in set(SearchIndex.tokenize(text)):
+                self.vocabulary.add(term)
+                
+    def fuzzy_vocabulary(self):
+        # Words that have since disappeared stay in the vocabulary but simply match nothing
+        with self.vocabulary_lock:
+            if self.vocabulary is None:
+                vocabulary = TrigramIndex()
+                vocabulary.rebuild(self.conn.execute('SELECT term, doc FROM notes_fts_vocab'))
+                self.vocabulary = vocabulary
+        return self.vocabulary
+        
+    def suggestions(self, query, limit=8):
+        return self.fuzzy_vocabulary().suggestions(query, limit)
+        
+    def remove_note(self, note):
+        pass
+        
+    def rebuild(self, notes):
+        pass
+        
+    def match_expression(self, query, fuzzy=False):
+        # Every phrase is quoted, so FTS5 operators typed by the user are searched as plain words
+        phrases = SearchIndex.parse_query(query)
+        alternatives = {}
+        if fuzzy:
+            vocabulary = self.fuzzy_vocabulary()
+            alternatives = vocabulary.alternatives(query, vocabulary.term_ids.__contains__)
+            
+        def quoted(phrase):
+            if len(phrase) == 1 and phrase[0] in alternatives:
+                return '(' + ' OR '.join(f'"{term}"' for term in alternatives[phrase[0]]) + ')'
+            return '"' + ' '.join(phrase) + '"'
+        # FTS5 only allows implied ANDs between plain phrases, so they are spelled out
+        return ' AND '.join(quoted(phrase) for phrase in phrases)
+        
+    def search(self, query, fuzzy=False):
+        expression = self.match_expression(query, fuzzy)
+        if not expression:
+            return []
+        rows = self.conn.execute('SELECT rowid FROM notes_fts WHERE notes_fts MATCH ?', (expression,))
+        return [row[0] for row in rows]
+        
+    def ranked_search(self, query, limit, offset=0, cancelled=None, fuzzy=False):
+        rows, total = self.ranked_rows(query, limit, offset, cancelled, fuzzy)
+        return [note_id for _, note_id in rows], total
+        
+    def ranked_rows(self, query, limit, offset=0, cancelled=None, fuzzy=False):
+        """(bm25 score, note id) of one page of matches, best (lowest) score first, and the number of matches"""
+        expression = self.match_expression(query, fuzzy)
+        if not expression:
+            return [], 0
+            
+        conn = self.conn
+        if cancelled:
+            # SQLite calls the handler every few thousand instructions and aborts the query if it returns true
+            conn.set_progress_handler(cancelled, 10000)
+        try:
+            total = conn.execute('SELECT count(*) FROM notes_fts WHERE notes_fts MATCH ?', (expression,)).fetchone()[0]
+            # bm25() is lower-is-better; the weights favour title and tag matches as in SearchIndex
+            rows = conn.execute('SELECT bm25(notes_fts, 3.0, 2.0, 1.0) AS score, rowid FROM notes_fts '
+                                'WHERE notes_fts MATCH ? ORDER BY score LIMIT ? OFFSET ?',
+                                (expression, limit, offset)).fetchall()
+        except sqlite3.OperationalError:
+            if cancelled and cancelled():
+                raise SearchCancelled()
+            raise
+        finally:
+            if cancelled:
+                conn.set_progress_handler(None, 0)
+        return rows, total
+
+class SQLiteDuplicateIndex:
+    """Duplicate lookups against the signature and LSH bucket tables SQLiteStorage maintains"""
+    threshold = DuplicateIndex.threshold
+    stored = True  # groups() reads fingerprints from storage, which only hold saves already written
+    
+    def __init__(self, storage):
+        self.storage = storage
+        self.recent = DuplicateIndex()  # Notes saved here whose stored fingerprints may still be queued
+        
+    def add_note(self, note):
+        self.recent.add_note(note)
+        
+    def add_notes(self, notes):
+        pass  # Bulk additions are fingerprinted as they are stored
+        
+    def remove_note(self, note):
+        self.recent.remove_note(note)
+        
+    def rebuild(self, notes):
+        self.recent.rebuild(())
+        
+    def signatures(self, note_ids):
+        note_ids = list(note_ids)
+        signatures = {}
+        for start in range(0, len(note_ids), 500):
+            chunk = note_ids[start:start + 500]
+            signatures.update(self.storage.conn.execute(
+                f"SELECT note_id, signature FROM note_signatures WHERE note_id IN ({', '.join('?' * len(chunk))})", chunk))
+        return signatures
+        
+    def duplicates(self, note_id, fingerprint, stored=None):
+        """As DuplicateIndex.duplicates; stored is the stored_duplicates of fingerprint if already read"""
+        if not fingerprint[1]:
+            return []
+        if stored is None:
+            stored = self.stored_duplicates(fingerprint)
+        # Stored fingerprints of notes changed since may be out of date
+        found = {other: similarity for other, similarity in stored.items()
+                 if other not in self.recent.fingerprints}
+        found.update(self.recent.duplicates(note_id, fingerprint))
+        return sorted(((other, similarity) for other, similarity in found.items()
+                       if other != note_id and similarity >= self.threshold), key=lambda d: (-d[1], d[0]))
+                       
+    def stored_duplicates(self, fingerprint):
+        """Note id -> estimated similarity for every stored note sharing an LSH bucket with fingerprint"""
+        content_hash, signature = fingerprint
+        conn = self.storage.conn
+        found = {other: 1.0 for (other,) in conn.execute(
+            "SELECT note_id FROM note_signatures WHERE content_hash = ? AND signature != x''", (content_hash,))}
+        keys = band_keys(signature)
+        candidates = [other for (other,) in conn.execute(
+            f"SELECT DISTINCT note_id FROM note_bands WHERE band IN ({', '.join('?' * len(keys))})", keys)
+            if other not in found]
+        for other, other_signature in self.signatures(candidates).items():
+            found[other] = signature_similarity(signature, other_signature)
+        return found
+                       
+    def groups(self):
+        conn = self.storage.conn
+        buckets = [([int(i) for i in ids.split(',')], True) for (ids,) in conn.execute(
+            "SELECT group_concat(note_id) FROM note_signatures WHERE signature != x'' "
+            "GROUP BY content_hash HAVING count(*) > 1")]
+        buckets += [([int(i) for i in ids.split(',')], False) for (ids,) in conn.execute(
+            "SELECT group_concat(note_id) FROM note_bands GROUP BY band HAVING count(*) > 1")]
+        signatures = self.signatures({note_id for ids, exact in buckets if not exact for note_id in ids})
+        return group_duplicates(buckets, signatures.get, self.threshold)
+
+class ReviewLog:
+    """Append-only binary log of review events: day, note id, rating and days since the previous review"""
+    record = struct.Struct('<iiBi')  # 13 bytes per review
+    ratings = ('hard', 'good', 'easy')
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        
+    def extend(self, events):
+        """Append (day, note_id, rating, elapsed) events with a single write"""
+        if self.file is None:
+            # Unbuffered, so readers on other threads always see complete records
+            self.file = open(self.path, 'ab', buffering=0)
+        self.file.write(b''.join(self.record.pack(day, note_id, self.ratings.index(rating), elapsed)
+                                 for day, note_id, rating, elapsed in events))
+        
+    def events(self):
+        """Yield (day, note_id, rating index, elapsed days) for every logged review"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        usable = len(data) - len(data) % self.record.size  # Drop a torn final record from a crash
+        yield from self.record.iter_unpack(memoryview(data)[:usable])
+        
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+ARCHIVE_FORMAT = 'knowledge-organizer-notes'
+
+def validate_note_record(record):
+    """Raise ValueError unless record is a note in the JSON data file schema"""
+    if not isinstance(record, dict):
+        raise ValueError("Note record is not an object")
+    for key, kind in (('id', int), ('title', str), ('tags', list), ('content', str), ('streak', int)):
+        if not isinstance(record.get(key), kind) or isinstance(record.get(key), bool):
+            raise ValueError(f"Note {record.get('id')!r}: missing or invalid '{key}'")
+    if not all(isinstance(tag, str) for tag in record['tags']):
+        raise ValueError(f"Note {record['id']}: tags must be strings")
+    for key in ('created', 'last_reviewed', 'next_review'):
+        try:
+            iso_to_day(record[key])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Note {record['id']}: missing or invalid '{key}'")
+
+class NoteArchiveReader:
+    """Streams note records from a line-delimited export or a legacy {"notes": [...]} file"""
+    def __init__(self, path, chunk_size=1 << 20):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.size = os.path.getsize(path)
+        self.bytes_read = 0
+        self.note_id_counter = None  # Known once the header (or legacy key) has been read
+        
+    def __iter__(self):
+        self.bytes_read = 0
+        with open(self.path, 'rb') as f:
+            first_line = f.readline(self.chunk_size)
+            try:
+                header = json.loads(first_line)
+            except ValueError:
+                header = None
+            f.seek(0)
+            
+            if isinstance(header, dict) and header.get('format') == ARCHIVE_FORMAT:
+                yield from self.read_lines(f)
+            else:
+                yield from self.read_legacy(f)
+                
+    def read_lines(self, f):
+        header = json.loads(f.readline())
+        self.note_id_counter = header['note_id_counter']
+        self.bytes_read = f.tell()
+        for line in f:
+            self.bytes_read += len(line)
+            if line.strip():
+                yield json.loads(line)
+                
+    def read_legacy(self, f):
+        """Decode the notes array one element at a time instead of parsing the whole file"""
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        state = {'buffer': '', 'pos': 0, 'eof': False}
+        
+        def fill():
+            chunk = f.read(self.chunk_size)
+            self.bytes_read += len(chunk)
+            state['eof'] = not chunk
+            state['buffer'] = state['buffer'][state['pos']:] + utf8.decode(chunk, final=not chunk)
+            state['pos'] = 0
+            
+        def peek():
+            # Next non-whitespace character, reading more of the file as needed
+            while True:
+                buffer, pos = state['buffer'], state['pos']
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                state['pos'] = pos
+                if pos < len(buffer):
+                    return buffer[pos]
+                if state['eof']:
+                    raise ValueError("Unexpected end of file")
+                fill()
+                
+        def expect(char):
+            if peek() != char:
+                raise ValueError(f"Invalid data format: expected '{char}'")
+            state['pos'] += 1
+            
+        def value():
+            peek()
+            while True:
+                try:
+                    result, end = decoder.raw_decode(state['buffer'], state['pos'])
+                except ValueError:
+                    result, end = None, None
+                # A value running up to the end of the buffer may continue in the next chunk
+                if end is not None and (end < len(state['buffer']) or state['eof']):
+                    state['pos'] = end
+                    return result
+                if state['eof']:
+                    raise ValueError("Invalid data format")
+                fill()
+                
+        expect('{')
+        while peek() != '}':
+            key = value()
+            expect(':')
+            if key == 'notes':
+                expect('[')
+                while peek() != ']':
+                    yield value()
+                    if peek() == ',':
+                        expect(',')
+                expect(']')
+            elif key == 'note_id_counter':
+                self.note_id_counter = value()
+            else:
+                value()
+            if peek() == ',':
+                expect(',')
+        if self.note_id_counter is None:
+            raise ValueError("Invalid data format: missing note_id_counter")
+
+class NoteArchiveWriter:
+    """Writes an export on a background thread from batches of note dicts"""
+    def __init__(self, path, note_id_counter):
+        # A .json path gets the legacy single-object layout, anything else one note per line
+        self.legacy = path.lower().endswith('.json')
+        self.note_id_counter = note_id_counter
+        self.file = open(path, 'w')
+        self.batches = queue.Queue(maxsize=8)
+        self.error = None
+        self.first = True
+        self.thread = threading.Thread(target=self.run, name='export', daemon=True)
+        self.thread.start()
+        
+    def put(self, notes, block=False):
+        """Queue a batch, or None to end the file; returns False if the writer is behind"""
+        try:
+            self.batches.put(notes, block=block)
+            return True
+        except queue.Full:
+            return False
+            
+    def done(self):
+        return not self.thread.is_alive()
+        
+    def run(self):
+        try:
+            if self.legacy:
+                self.file.write('{\n  "notes": [')
+            else:
+                self.file.write(json.dumps({'format': ARCHIVE_FORMAT, 'version': 1,
+                                            'note_id_counter': self.note_id_counter}) + '\n')
+            while True:
+                notes = self.batches.get()
+                if notes is None:
+                    break
+                if self.legacy:
+                    for note in notes:
+                        self.file.write(('\n    ' if self.first else ',\n    ') + json.dumps(note))
+                        self.first = False
+                else:
+                    self.file.writelines(json.dumps(note) + '\n' for note in notes)
+            if self.legacy:
+                self.file.write(f'\n  ],\n  "note_id_counter": {self.note_id_counter}\n}}\n')
+        except Exception as e:
+            self.error = e
+            # Keep consuming so the Tk thread is never left waiting on a full queue
+            while self.batches.get() is not None:
+                pass
+        finally:
+            self.file.close()
+
+class Metrics:
+    """Thread-safe operation timers and event counters, cheap enough to leave on all the time"""
+    def __init__(self, window=256):
+        self.window = window  # Recent durations kept per operation for percentiles
+        self.lock = threading.Lock()
+        self.timers = {}  # name -> [count, total seconds, longest seconds, recent durations]
+        self.counters = Counter()
+        self.gauges = {}
+        
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, 0.0, deque(maxlen=self.window)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            timer[3].append(seconds)
+            
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+            
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+            
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+        
+    def snapshot(self):
+        """Current figures as a JSON-ready dict; percentiles cover the recent window only"""
+        with self.lock:
+            timers = {name: (count, total, longest, sorted(recent))
+                      for name, (count, total, longest, recent) in self.timers.items()}
+            counters = dict(self.counters)
+        operations = {}
+        for name, (count, total, longest, recent) in sorted(timers.items()):
+            operations[name] = {
+                'count': count,
+                'total_seconds': total,
+                'max_ms': longest * 1000,
+                'p50_ms': recent[len(recent) // 2] * 1000,
+                'p95_ms': recent[min(len(recent) - 1, len(recent) * 95 // 100)] * 1000
+            }
+        return {'operations': operations, 'counters': counters, 'gauges': dict(self.gauges),
+                'memory': memory_usage()}
+                
+    def prometheus(self):
+        """The snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = ['# TYPE knowledge_organizer_operation_seconds summary']
+        for name, timer in snapshot['operations'].items():
+            lines.append(f'knowledge_organizer_operation_seconds{{operation="{name}",quantile="0.5"}} {timer["p50_ms"] / 1000}')
+            lines.append(f'knowledge_organizer_operation_seconds{{operation="{name}",quantile="0.95"}} {timer["p95_ms"] / 1000}')
+            lines.append(f'knowledge_organizer_operation_seconds_sum{{operation="{name}"}} {timer["total_seconds"]}')
+            lines.append(f'knowledge_organizer_operation_seconds_count{{operation="{name}"}} {timer["count"]}')
+        lines.append('# TYPE knowledge_organizer_events_total counter')
+        for name, count in sorted(snapshot['counters'].items()):
+            lines.append(f'knowledge_organizer_events_total{{event="{name}"}} {count}')
+        lines.append('# TYPE knowledge_organizer_gauge gauge')
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'knowledge_organizer_gauge{{name="{name}"}} {value}')
+        lines.append('# TYPE knowledge_organizer_memory_bytes gauge')
+        for kind, value in sorted(snapshot['memory'].items()):
+            lines.append(f'knowledge_organizer_memory_bytes{{kind="{kind}"}} {value}')
+        return '\n'.join(lines) + '\n'
+        
+    def export(self, path):
+        """Write the metrics to path: Prometheus text for .prom or .txt files, JSON otherwise"""
+        if path.lower().endswith(('.prom', '.txt')):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+        
+def instrumented(name):
+    """Decorator timing a method under name in the metrics of the object it belongs to"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.metrics.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+    
+def memory_usage():
+    """Memory figures in bytes for whatever this platform can report"""
+    usage = {}
+    try:
+        with open('/proc/self/statm') as f:
+            usage['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        usage['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    tracemalloc = sys.modules.get('tracemalloc')
+    if tracemalloc and tracemalloc.is_tracing():
+        usage['traced'], usage['traced_peak'] = tracemalloc.get_traced_memory()
+    return usage
+    
+class Profiler:
+    """On-demand cProfile and tracemalloc capture; cProfile only sees the thread that starts it"""
+    def __init__(self):
+        self.profile = None
+        
+    @property
+    def running(self):
+        return self.profile is not None
+        
+    def start(self):
+        import cProfile
+        import tracemalloc
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        
+    def stop(self, path):
+        """Write the profile to path (readable with pstats) and return a text summary"""
+        profile, self.profile = self.profile, None
+        profile.disable()
+        import io
+        import pstats
+        import tracemalloc
+        try:
+            allocations = tracemalloc.take_snapshot().statistics('lineno')
+        finally:
+            tracemalloc.stop()
+        profile.dump_stats(path)
+        
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(25)
+        summary.write("Largest allocations made while profiling and still held\n")
+        for allocation in allocations[:15]:
+            summary.write(f"{allocation}\n")
+        return summary.getvalue()
+
+class SearchWorker:
+    """Answers searches on a background thread; a new query cancels any older one still waiting or running"""
+    def __init__(self, metrics=None):
+        self.metrics = metrics or Metrics()
+        self.condition = threading.Condition()
+        self.request = None
+        self.generation = 0
+        self.stopping = False
+        self.results = queue.Queue()  # (generation, query, note ids or the error raised, total, suggestions)
+        self.thread = threading.Thread(target=self.run, name='search', daemon=True)
+        self.thread.start()
+        
+    def submit(self, index, query, limit=100, fuzzy=False):
+        """Search an index snapshot for query; returns the generation its result will carry"""
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, index, query, limit, fuzzy)
+            self.condition.notify()
+            return self.generation
+            
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.request = None
+            
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                generation, index, query, limit, fuzzy = self.request
+                self.request = None
+                
+            start = time.perf_counter()
+            try:
+                ids, total = index.ranked_search(query, limit, cancelled=lambda: generation != self.generation,
+                                                 fuzzy=fuzzy)
+                # Fuzzy searches come from typing, so they also suggest completions of the last word
+                suggestions = index.suggestions(query) if fuzzy else []
+            except SearchCancelled:
+                self.metrics.count('search.cancelled')
+                continue
+            except Exception as e:
+                self.results.put((generation, query, e, 0, []))
+                continue
+            self.metrics.record('search.background', time.perf_counter() - start)
+            self.results.put((generation, query, ids, total, suggestions))
+            
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.generation += 1
+            self.condition.notify()
+        self.thread.join()
+
+class PersistenceWorker:
+    """Runs storage writes on a background thread so the Tk thread never waits on disk"""
+    def __init__(self, storage, batch_size=256, metrics=None):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.metrics = metrics or Metrics()
+        self.pending = queue.Queue()
+        self.errors = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='persistence', daemon=True)
+        self.thread.start()
+        
+    def submit(self, write, *args):
+        """Queue a storage call; its arguments must not be mutated afterwards"""
+        self.pending.put((write, args, False))
+        
+    def notify(self, callback, *args):
+        """Queue callback to run on this thread once every write queued before it is synced to disk"""
+        self.pending.put((callback, args, True))
+        
+    def run(self):
+        stopping = False
+        while not stopping:
+            # Take everything queued so far and make it durable with a single sync
+            batch = [self.pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+                    
+            callbacks = []
+            for item in batch:
+                if item is None:
+                    stopping = True
+                    continue
+                write, args, after_sync = item
+                if after_sync:
+                    callbacks.append((write, args))
+                    continue
+                try:
+                    with self.metrics.timed('storage.' + write.__name__):
+                        write(*args)
+                except Exception as e:
+                    self.metrics.count('storage.errors')
+                    self.errors.put(e)
+            try:
+                with self.metrics.timed('storage.sync'):
+                    self.storage.sync()
+            except Exception as e:
+                self.metrics.count('storage.errors')
+                self.errors.put(e)
+            for callback, args in callbacks:
+                callback(*args)
+            for _ in batch:
+                self.pending.task_done()
+        self.storage.close()
+        
+    def drain(self):
+        """Block until every write queued so far has been applied"""
+        self.pending.join()
+        
+    def close(self):
+        """Finish all queued writes and stop the thread"""
+        self.pending.put(None)
+        self.thread.join()
+
+class ContentCache:
+    """Bounded LRU cache of note bodies loaded on demand"""
+    def __init__(self, load, capacity=256, metrics=None):
+        self.load = load
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.dirty = {}  # Bodies whose write is still queued; storage holds an older version until it lands
+        self.lock = threading.Lock()  # The persistence thread unpins
+        self.metrics = metrics or Metrics()
+        
+    def __contains__(self, note_id):
+        return note_id in self.dirty or note_id in self.entries
+        
+    def get(self, note_id):
+        content = self.dirty.get(note_id)
+        if content is not None:
+            self.metrics.count('content_cache.hits')
+            return content
+        if note_id in self.entries:
+            self.metrics.count('content_cache.hits')
+            self.entries.move_to_end(note_id)
+            return self.entries[note_id]
+        self.metrics.count('content_cache.misses')
+        with self.metrics.timed('storage.load_content'):
+            content = self.load(note_id)
+        self.put(note_id, content)
+        return content
+        
+    def put(self, note_id, content):
+        self.entries[note_id] = content
+        self.entries.move_to_end(note_id)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            
+    def pin(self, note_id, content):
+        """Hold a saved body outside the LRU until unpin is called for it"""
+        with self.lock:
+            self.dirty[note_id] = content
+            
+    def unpin(self, bodies):
+        """Release (note id, content) pairs now in storage, unless the note was saved again since"""
+        with self.lock:
+            for note_id, content in bodies:
+                if self.dirty.get(note_id) is content:
+                    del self.dirty[note_id]
+                    
+    def discard(self, note_id):
+        self.entries.pop(note_id, None)
+        with self.lock:
+            self.dirty.pop(note_id, None)
+        
+    def clear(self):
+        self.entries.clear()
+        with self.lock:
+            self.dirty.clear()
+
+class ReviewSession:
+    """One pass through the notes due when it started, with bodies loaded ahead and answers committed in batches"""
+    def __init__(self, kb, path, prefetch=20, batch_size=25):
+        self.kb = kb
+        self.path = path  # Journal of the session so far, which lets a restarted app resume it
+        self.prefetch_count = prefetch
+        self.batch_size = batch_size
+        self.queue = []       # Ids of the due notes, in review order
+        self.position = 0     # Index in queue of the card to review now
+        self.prefetched = 0   # Cards before this index have had their bodies loaded
+        self.pending = []     # (note id, feedback) answered since the last commit
+        self.reviewed = 0
+        self.stored_position = 0    # Answers before this index are in storage, as the persistence thread reports
+        self.recorded_position = 0  # The last commit record in the journal covers answers before this index
+        self.journal = None
+        
+    def start(self, today=None):
+        """Take a snapshot of the notes due now; returns self"""
+        self.queue = [note.id for note in self.kb.due_notes(today)]
+        if self.queue:
+            self.journal = open(self.path, 'w', buffering=1)
+            self.write({'op': 'start', 'queue': self.queue})
+        return self
+        
+    def resume(self):
+        """Pick up the session an earlier run left unfinished; False if there is none"""
+        try:
+            with open(self.path) as f:
+                records = []
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break  # A torn final record from a crash mid-append
+        except FileNotFoundError:
+            return False
+        if not records or records[0]['op'] != 'start':
+            return False
+            
+        self.queue = records[0]['queue']
+        answers = []
+        for record in records[1:]:
+            if record['op'] == 'answer':
+                self.position = record['position'] + 1
+                answers.append(record)
+                self.reviewed += 1
+            elif record['op'] == 'commit':
+                answers = [answer for answer in answers if answer['position'] >= record['position']]
+        self.stored_position = self.recorded_position = self.position
+        self.journal = open(self.path, 'a', buffering=1)
+        # Answers given just before the app stopped; a batch stored before its commit record was written
+        # has already moved its notes on, and applying it again would count the answers twice
+        for answer in answers:
+            note = self.kb.notes.get(answer['id'])
+            if note and [note.streak, note.reviewed_day] == answer.get('before'):
+                self.pending.append((answer['id'], answer['feedback']))
+        self.commit()
+        return True
+        
+    def write(self, record):
+        self.journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+        
+    def current(self):
+        """The note to review now, skipping notes deleted since the start; None once the session is done"""
+        while self.position < len(self.queue):
+            note = self.kb.notes.get(self.queue[self.position])
+            if note:
+                return note
+            self.position += 1
+        return None
+        
+    def prefetch(self):
+        """Load the bodies of the next cards in one query once less than half of them are loaded; returns those notes"""
+        if self.prefetched - self.position >= self.prefetch_count // 2:
+            return []
+        note_ids = self.queue[max(self.prefetched, self.position):self.position + self.prefetch_count]
+        self.prefetched = self.position + self.prefetch_count
+        self.kb.prefetch_contents(note_ids)
+        return self.kb.notes.get_many(note_ids)
+        
+    def answer(self, feedback):
+        """Record 'easy', 'good' or 'hard' for the current card and return the next one"""
+        note = self.current()
+        if note is None:
+            return None
+        self.record_stored()
+        self.pending.append((note.id, feedback))
+        self.write({'op': 'answer', 'position': self.position, 'id': note.id, 'feedback': feedback,
+                    'before': [note.streak, note.reviewed_day]})
+        self.position += 1
+        self.reviewed += 1
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+        return self.current()
+        
+    def commit(self):
+        """Apply the pending answers to the notes and queue them for storage in one batch"""
+        if self.pending:
+            self.kb.review_many(self.pending)
+            self.pending = []
+            self.kb.persistence.notify(self.mark_stored, self.position)
+            
+    def mark_stored(self, position):
+        # Runs on the persistence thread once the batch is on disk; the journal is only written from the caller's
+        self.stored_position = position
+        
+    def record_stored(self):
+        """Note in the journal the batches storage holds now, so a resume need not look at their answers again"""
+        position = self.stored_position
+        if position > self.recorded_position:
+            self.write({'op': 'commit', 'position': position})
+            self.recorded_position = position
+            
+    def close(self):
+        """Commit the pending answers but keep the journal, so the session resumes on the next start"""
+        if self.journal:
+            self.commit()
+            self.record_stored()
+            self.journal.close()
+            self.journal = None
+            
+    def finish(self):
+        self.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+def open_storage(backend=None):
+    """Create the storage backend named by KNOWLEDGE_ORGANIZER_STORAGE ('sqlite', 'json' or 'sharded')"""
+    backend = backend or os.environ.get('KNOWLEDGE_ORGANIZER_STORAGE', 'sqlite')
+    if backend == 'json':
+        return JSONStorage()
+    if backend == 'sqlite':
+        # Note bodies are loaded on demand unless KNOWLEDGE_ORGANIZER_LAZY=0
+        return SQLiteStorage(lazy=os.environ.get('KNOWLEDGE_ORGANIZER_LAZY', '1') != '0')
+    if backend == 'sharded':
+        from sharded_storage import ShardedStorage
+        return ShardedStorage(shards=int(os.environ.get('KNOWLEDGE_ORGANIZER_SHARDS', '4')),
+                              lazy=os.environ.get('KNOWLEDGE_ORGANIZER_LAZY', '1') != '0')
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+class KnowledgeBase:
+    """The notes with their indexes and storage, independent of any user interface"""
+    def __init__(self, storage=None, on_tags_changed=None, model=None, metrics=None):
+        start = time.perf_counter()
+        self.metrics = metrics or Metrics()
+        self.spaced_rep = SpacedRepetitionCalculator(model or open_memory_model())
+        self.tag_index = TagIndex()
+        self.statistics = StatisticsEngine()
+        self.on_tags_changed = on_tags_changed  # Called after the set of tags in use changes
+        self.load_error = None
+        
+        self.storage = storage or open_storage()
+        try:
+            notes, self.note_id_counter = self.storage.load()
+            self.notes = NoteRepository(notes)
+        except FileNotFoundError:
+            self.notes = NoteRepository()
+            self.note_id_counter = 1
+        except Exception as e:
+            # Left for the caller to report; the knowledge base starts out empty
+            self.load_error = e
+            self.notes = NoteRepository()
+            self.note_id_counter = 1
+            
+        self.tag_index.rebuild(self.notes)
+        self.statistics.rebuild(self.notes)
+        self.review_scheduler = self.storage.create_review_scheduler(self.notes)
+        self.search_index = self.storage.create_search_index(self.notes)
+        self.duplicate_index = self.storage.create_duplicate_index(self.notes)
+        self.content_cache = ContentCache(self.storage.load_content, metrics=self.metrics)
+        self.persistence = PersistenceWorker(self.storage, metrics=self.metrics)
+        self.reserved_ids = range(0)  # Ids shared storage has set aside for notes added here
+        self.closing = False
+        self.local_writes = 0  # Changes stored from here, so a refresh read before one of them can be told stale
+        self.auto_refresh = True  # due_notes and random_review_note take in other instances' changes first
+        self.read_token = 0
+        self.stored_reads = queue.Queue()  # (token, result) of after_writes reads
+        self.persistence.submit(self.backfill_fingerprints)
+        self.metrics.record('load', time.perf_counter() - start)
+        
+    @instrumented('add_note')
+    def add_note(self, title, tags, content):
+        today = datetime.date.today()
+        note = Note(self.take_note_id(), title, tags, content, created_day=today.toordinal(),
+                    reviewed_day=today.toordinal(), review_day=self.spaced_rep.next_review_date(0, today).toordinal())
+        
+        self.notes.add(note)
+        self.search_index.add_note(note)
+        self.duplicate_index.add_note(note)
+        self.review_scheduler.schedule(note)
+        tags_changed = self.tag_index.add_note(note)
+        self.statistics.add_note(note)
+        self.store(self.storage.save_note, note.to_dict(), self.note_id_counter)
+        self.release_content(note)
+        if tags_changed:
+            self.tags_changed()
+        return note
+        
+    @instrumented('edit_note')
+    def edit_note(self, note_id, title, tags, content):
+        note = self.notes.get(note_id)
+        if not note:
+            return None
+            
+        self.search_index.remove_note(note)
+        self.duplicate_index.remove_note(note)
+        tags_changed = self.tag_index.remove_note(note)
+        self.statistics.remove_note(note)
+        self.notes.update(note.id, title=title, tags=tags, content=content)
+        self.search_index.add_note(note)
+        self.duplicate_index.add_note(note)
+        tags_changed = self.tag_index.add_note(note) or tags_changed
+        self.statistics.add_note(note)
+        self.store(self.storage.save_note, note.to_dict(), self.note_id_counter)
+        self.release_content(note)
+        if tags_changed:
+            self.tags_changed()
+        return note
+        
+    @instrumented('delete_note')
+    def delete_note(self, note_id):
+        note = self.notes.get(note_id)
+        if note:
+            self.search_index.remove_note(note)
+            self.duplicate_index.remove_note(note)
+            if self.tag_index.remove_note(note):
+                self.tags_changed()
+            self.statistics.remove_note(note)
+            self.notes.delete(note.id)
+        self.review_scheduler.unschedule(note_id)
+        self.store(self.storage.delete_note, note_id)
+        self.content_cache.discard(note_id)
+        return note is not None
+        
+    @instrumented('review')
+    def review(self, note_id, feedback):
+        """Record 'easy', 'good' or 'hard' for a note and schedule its next review"""
+        return self.review_many([(note_id, feedback)])[0]
+        
+    @instrumented('review_many')
+    def review_many(self, answers):
+        """Apply (note id, feedback) answers in order and store them as one batch; unknown ids give None"""
+        today = datetime.date.today()
+        reviewed = []
+        reviews = []
+        events = []
+        for note_id, feedback in answers:
+            note = self.notes.get(note_id)
+            reviewed.append(note)
+            if not note:
+                continue
+                
+            if feedback == 'easy':
+                streak = note.streak + 2
+            elif feedback == 'good':
+                streak = note.streak + 1
+            else:  # hard
+                streak = max(0, note.streak - 1)
+                
+            elapsed = today.toordinal() - note.reviewed_day
+            self.statistics.remove_note(note)
+            self.notes.update(note.id, streak=streak, reviewed_day=today.toordinal(),
+                              review_day=self.spaced_rep.next_review_date(streak, today).toordinal())
+            self.statistics.add_note(note)
+            self.review_scheduler.schedule(note)
+            reviews.append((note.id, note.last_reviewed, note.next_review, note.streak))
+            events.append((today.toordinal(), note.id, feedback if feedback in ('easy', 'good') else 'hard', elapsed))
+        if reviews:
+            self.store(self.storage.save_reviews, reviews)
+            self.store(self.storage.log_reviews, events)
+        return reviewed
+        
+    @instrumented('reschedule_all')
+    def reschedule_all(self, model=None, smooth=True, max_per_day=None):
+        """Recompute every next review with the memory model (NumPy required); returns the number moved"""
+        from batch_scheduling import BatchScheduler
+        if model:
+            self.spaced_rep.model = model
+        note_ids, review_days = BatchScheduler(self.spaced_rep.model).reschedule(
+            self.notes, smooth=smooth, max_per_day=max_per_day)
+            
+        changed = []
+        for note_id, review_day in zip(note_ids.tolist(), review_days.tolist()):
+            note = self.notes.get(note_id)
+            if note.review_day != review_day:
+                self.statistics.remove_note(note)
+                self.notes.update(note_id, review_day=review_day)
+                self.statistics.add_note(note)
+                self.review_scheduler.schedule(note)
+                changed.append((note_id, note.last_reviewed, note.next_review, note.streak))
+        self.store(self.storage.save_reviews, changed)
+        return len(changed)
+        
+    @instrumented('forecast')
+    def forecast(self, days=30):
+        """Reviews per day over the coming days if every review is answered 'good' (NumPy required)"""
+        from batch_scheduling import BatchScheduler
+        return BatchScheduler(self.spaced_rep.model).forecast(self.notes, days)
+        
+    @instrumented('search')
+    def search(self, query, limit=100, offset=0, fuzzy=False):
+        """Return one page of notes ranked by relevance and the total number of matches"""
+        ids, total = self.search_index.ranked_search(query, limit, offset, fuzzy=fuzzy)
+        return self.notes.get_many(ids), total
+        
+    @instrumented('search_snapshot')
+    def search_snapshot(self):
+        """An index that stays valid for searches on another thread while notes keep changing"""
+        return self.search_index.snapshot()
+        
+    @instrumented('search_ids')
+    def search_ids(self, query, fuzzy=False):
+        """Ids of every note matching query, unranked; search pages through them best first"""
+        return self.search_index.search(query, fuzzy=fuzzy)
+        
+    @instrumented('filter_by_tag')
+    def tagged_note_ids(self, tag):
+        return self.tag_index.note_ids(tag)
+        
+    @instrumented('due_notes')
+    def due_notes(self, today=None):
+        if self.auto_refresh:
+            self.refresh()
+        return self.notes.get_many(self.review_scheduler.due_ids(today))
+        
+    def random_review_note(self):
+        """Pick a random due note, or any note if none are due"""
+        if self.auto_refresh:
+            self.refresh()
+        if not self.notes:
+            return None
+        note_id = self.review_scheduler.random_due()
+        if note_id is not None and note_id in self.notes:
+            return self.notes.get(note_id)
+        return self.notes.random_note()
+        
+    @instrumented('stats')
+    def stats(self):
+        return {
+            'total_notes': self.statistics.total_notes,
+            'total_tags': len(self.tag_index),
+            'due_reviews': self.statistics.due_count(),
+            'avg_streak': self.statistics.average_streak()
+        }
+        
+    @instrumented('tag_stats')
+    def tag_stats(self):
+        """Tag name -> (note count, average streak)"""
+        return self.statistics.tag_stats()
+        
+    def reviews_per_day(self, days=14, today=None):
+        """Reviews logged on each of the last days, oldest first; reviews still queued are not counted yet"""
+        today = (today or datetime.date.today()).toordinal()
+        counts = [0] * days
+        for day, _, _, _ in self.storage.review_log.events():
+            if today - days < day <= today:
+                counts[day - today + days - 1] += 1
+        return counts
+        
+    def retention_curve(self):
+        """(shortest gap, longest gap, reviews, share not answered 'hard') for doubling gaps since the previous review"""
+        reviews = defaultdict(int)
+        remembered = defaultdict(int)
+        for _, _, rating, elapsed in self.storage.review_log.events():
+            bucket = max(elapsed, 0).bit_length()  # 0, 1, 2-3, 4-7, ... days
+            reviews[bucket] += 1
+            remembered[bucket] += rating != 0
+        return [((1 << bucket) >> 1, (1 << bucket) - 1, reviews[bucket], remembered[bucket] / reviews[bucket])
+                for bucket in sorted(reviews)]
+                
+                
+    def clear(self):
+        self.notes = NoteRepository()
+        self.note_id_counter = 1
+        self.store(self.storage.replace_all, [], self.note_id_counter)
+        self.search_index.rebuild(self.notes)
+        self.duplicate_index.rebuild(self.notes)
+        self.review_scheduler.rebuild(self.notes)
+        self.tag_index.rebuild(self.notes)
+        self.statistics.rebuild(self.notes)
+        self.content_cache.clear()
+        self.tags_changed()
+        
+    @instrumented('possible_duplicates')
+    def fingerprint(self, note):
+        return note_fingerprint(note.title, self.note_content(note))
+        
+    def possible_duplicates(self, note, fingerprint=None, stored=None):
+        """(note, estimated similarity) of other notes with the same or nearly the same words"""
+        # A stored index's own lookup may be read off this thread first and passed in as stored
+        fingerprint = fingerprint or self.fingerprint(note)
+        found = (self.duplicate_index.duplicates(note.id, fingerprint) if stored is None
+                 else self.duplicate_index.duplicates(note.id, fingerprint, stored))
+        return [(self.notes.get(note_id), similarity) for note_id, similarity in found if note_id in self.notes]
+                
+    @instrumented('duplicate_groups')
+    def duplicate_groups(self):
+        """Groups of notes that all look like duplicates, oldest note first in each"""
+        self.persistence.drain()  # Stored fingerprints must cover every queued save
+        return self.note_groups(self.duplicate_index.groups())
+        
+    def note_groups(self, id_groups):
+        """The notes of duplicate_index.groups() that still exist, dropping groups left with one note"""
+        return [group for group in (self.notes.get_many(ids) for ids in id_groups) if len(group) > 1]
+        
+    @instrumented('merge_notes')
+    def merge_notes(self, keep_id, note_ids):
+        """Fold notes into the one to keep: it gains their tags and earliest creation date, and they are deleted"""
+        keep = self.notes.get(keep_id)
+        others = [note for note in self.notes.get_many(note_ids) if note.id != keep_id]
+        if not keep or not others:
+            return 0
+            
+        tags = list(dict.fromkeys(keep.tags + [tag for note in others for tag in note.tags]))
+        self.notes.update(keep.id, created_day=min(note.created_day for note in [keep] + others))
+        self.edit_note(keep.id, keep.title, tags, self.note_content(keep))
+        for note in others:
+            self.delete_note(note.id)
+        return len(others)
+        
+    def review_session(self, start=True):
+        """The review session an earlier run left unfinished, else a new one over the notes due now (or None)"""
+        session = ReviewSession(self, os.path.splitext(self.storage.review_log.path)[0] + '.session')
+        if session.resume():
+            return session
+        return session.start() if start else None
+        
+    def prefetch_contents(self, note_ids):
+        """Read the bodies of lazily loaded notes into the cache with one query"""
+        # Bodies saved this session are already cached, so only those still on disk are read
+        missing = [note_id for note_id in note_ids if note_id in self.notes and note_id not in self.content_cache
+                   and self.notes.get(note_id).content is None]
+        if missing:
+            for note_id, content in self.storage.load_contents(missing).items():
+                self.content_cache.put(note_id, content)
+                
+    def take_note_id(self):
+        """The next free note id; shared storage sets ids aside for each instance in blocks so none is taken twice"""
+        if not self.storage.shared:
+            note_id = self.note_id_counter
+        else:
+            # Notes imported with their own ids may already use some of the block
+            note_id = next((i for i in self.reserved_ids if i not in self.notes), None)
+            if note_id is None:
+                note_id = self.storage.reserve_ids(self.note_id_counter, 64)
+                self.reserved_ids = range(note_id, note_id + 64)
+            self.reserved_ids = self.reserved_ids[self.reserved_ids.index(note_id) + 1:]
+        self.note_id_counter = max(self.note_id_counter, note_id + 1)
+        return note_id
+        
+    @instrumented('refresh')
+    def refresh(self):
+        """Take in the changes other instances made to shared storage; returns the ids of the notes they changed"""
+        if not self.storage.shared:
+            return set()
+        self.persistence.drain()  # Own writes must be stored before storage can tell them apart
+        return self.take_changes(self.storage.changes())
+        
+    def read_changes(self, local_writes):
+        """Run through after_writes to fetch other instances' changes without waiting; apply with apply_changes"""
+        return local_writes, self.storage.changes()
+        
+    @instrumented('apply_changes')
+    def apply_changes(self, local_writes, changes):
+        """Take in changes from read_changes; none are taken if notes were saved here since, as they may be older"""
+        if local_writes != self.local_writes:
+            return set()  # The next refresh reads them again, as storage still counts them unsynced
+        return self.take_changes(changes)
+        
+    def take_changes(self, changes):
+        changed, deleted, note_id_counter, versions = changes
+        tags_changed = False
+        for note_id in [note.id for note in changed] + deleted:
+            old = self.notes.get(note_id)
+            if old:
+                self.search_index.remove_note(old)
+                self.duplicate_index.remove_note(old)
+                self.review_scheduler.unschedule(note_id)
+                tags_changed = self.tag_index.remove_note(old) or tags_changed
+                self.statistics.remove_note(old)
+                self.notes.delete(note_id)
+                self.content_cache.discard(note_id)
+        # Shared storage searches and fingerprints the stored notes itself, so only the in-memory indexes take them in
+        for note in changed:
+            self.notes.add(note)
+            self.review_scheduler.schedule(note)
+            tags_changed = self.tag_index.add_note(note) or tags_changed
+            self.statistics.add_note(note)
+        self.note_id_counter = max(self.note_id_counter, note_id_counter)
+        self.storage.mark_synced(versions)
+        if tags_changed:
+            self.tags_changed()
+        return {note.id for note in changed} | set(deleted)
+        
+    def backfill_fingerprints(self):
+        # Runs on the persistence thread one batch at a time, so saves queued meanwhile are not held up
+        if self.storage.backfill_fingerprints() and not self.closing:
+            self.persistence.submit(self.backfill_fingerprints)
+            
+    @instrumented('add_records')
+    def add_records(self, records):
+        """Add validated note records, giving any whose id is already taken the next free id"""
+        saved = []
+        added = []
+        tags_changed = False
+        for record in records:
+            note = Note.from_dict(record)
+            if note.id in self.notes:
+                note.id = self.take_note_id()
+            self.note_id_counter = max(self.note_id_counter, note.id + 1)
+            
+            self.notes.add(note)
+            self.search_index.add_note(note)
+            self.review_scheduler.schedule(note)
+            tags_changed = self.tag_index.add_note(note) or tags_changed
+            self.statistics.add_note(note)
+            saved.append(note.to_dict())
+            added.append(note)
+        self.duplicate_index.add_notes(added)
+        self.store(self.storage.save_notes, saved, self.note_id_counter)
+        if self.storage.lazy:
+            # Lazy storages fingerprint notes themselves as they are stored
+            self.release_contents(added)
+        if tags_changed:
+            self.tags_changed()
+            
+    @instrumented('archive_records')
+    def archive_records(self, note_ids):
+        """Full note dicts for an export, reading lazily loaded bodies back in one query"""
+        notes = self.notes.get_many(note_ids)
+        # Bodies whose write is still queued are pinned in the cache; any other is already in storage
+        pinned = {note.id: self.content_cache.dirty.get(note.id) for note in notes if note.content is None}
+        stored_ids = [note_id for note_id, content in pinned.items() if content is None]
+        contents = self.storage.load_contents(stored_ids) if stored_ids else {}
+        contents.update((note_id, content) for note_id, content in pinned.items() if content is not None)
+        return [dict(note.to_dict(), content=contents.get(note.id, '')) if note.content is None
+                else note.to_dict() for note in notes]
+                
+    @instrumented('import_archive')
+    def import_archive(self, path, merge=True, batch_size=1000):
+        """Import a whole archive; nothing changes unless every record is valid"""
+        reader = NoteArchiveReader(path)
+        for record in reader:
+            validate_note_record(record)
+        if not merge:
+            self.clear()
+            
+        imported = 0
+        batch = []
+        for record in reader:
+            batch.append(record)
+            if len(batch) == batch_size:
+                self.add_records(batch)
+                imported += len(batch)
+                batch = []
+        self.add_records(batch)
+        self.raise_note_id_counter(reader.note_id_counter)
+        return imported + len(batch)
+        
+    def raise_note_id_counter(self, note_id_counter):
+        """Never hand out ids below note_id_counter, such as the counter of an imported archive"""
+        if note_id_counter > self.note_id_counter:
+            self.note_id_counter = note_id_counter
+            self.store(self.storage.save_note_id_counter, note_id_counter)
+        
+    @instrumented('export_archive')
+    def export_archive(self, path, batch_size=1000):
+        note_ids = self.notes.note_ids()
+        writer = NoteArchiveWriter(path, self.note_id_counter)
+        for start in range(0, len(note_ids), batch_size):
+            writer.put(self.archive_records(note_ids[start:start + batch_size]), block=True)
+        writer.put(None, block=True)
+        writer.thread.join()
+        if writer.error:
+            raise writer.error
+        return len(note_ids)
+        
+    def note_content(self, note):
+        if note.content is not None:
+            return note.content
+        return self.content_cache.get(note.id)
+        
+    def release_content(self, note):
+        """In lazy mode, move a saved note's body out of memory and into the LRU cache"""
+        if self.storage.lazy:
+            # Also kept in the LRU, so the note stays cached after its write lands
+            self.content_cache.put(note.id, note.content)
+            self.release_contents([note])
+            
+    def release_contents(self, notes):
+        """Drop the bodies of just-saved notes, keeping them pinned in the cache until their write is on disk"""
+        bodies = [(note.id, note.content) for note in notes]
+        for note_id, content in bodies:
+            self.content_cache.pin(note_id, content)
+        for note in notes:
+            note.content = None
+        self.persistence.notify(self.content_cache.unpin, bodies)
+            
+    def diagnostics(self):
+        """Metrics snapshot including the current size of the knowledge base and write queue"""
+        self.update_gauges()
+        return self.metrics.snapshot()
+        
+    def export_metrics(self, path):
+        self.update_gauges()
+        self.metrics.export(path)
+        
+    def update_gauges(self):
+        self.metrics.set_gauge('notes', len(self.notes))
+        self.metrics.set_gauge('tags', len(self.tag_index))
+        self.metrics.set_gauge('cached_contents', len(self.content_cache.entries))
+        self.metrics.set_gauge('pending_writes', self.persistence.pending.qsize())
+        
+    def tags_changed(self):
+        if self.on_tags_changed:
+            self.on_tags_changed()
+            
+    def store(self, write, *args):
+        """Queue a single change for the storage backend; arguments must be snapshots, not live notes"""
+        self.local_writes += 1
+        self.persistence.submit(write, *args)
+        
+    def after_writes(self, read, *args):
+        """Run read(*args) on the persistence thread once every write queued so far is stored; returns a token"""
+        # The result, or the exception raised, is put on stored_reads as (token, result) for the caller to poll
+        self.read_token += 1
+        self.persistence.notify(self.run_stored_read, self.read_token, read, args)
+        return self.read_token
+        
+    def run_stored_read(self, token, read, args):
+        try:
+            result = read(*args)
+        except Exception as e:
+            result = e
+        self.stored_reads.put((token, result))
+        
+    def storage_error(self):
+        """Return the next failure reported by the persistence thread, if any"""
+        try:
+            return self.persistence.errors.get_nowait()
+        except queue.Empty:
+            return None
+            
+    def close(self):
+        # Waits for every queued write, then releases the storage
+        self.closing = True
+        self.persistence.submit(self.storage.flush)
+        self.persistence.close()
+        self.storage.close()
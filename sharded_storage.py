@@ -0,0 +1,529 @@
+import contextlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import threading
+import uuid
+import zlib
+from collections import defaultdict
+from knowledge_core import (JSONStorage, SQLiteStorage, FTSSearchIndex, SQLiteDuplicateIndex, ReviewScheduler,
+                            ReviewLog, Note, SearchCancelled, group_duplicates)
+
+SHARDS_FORMAT = 'knowledge-organizer-shards'
+
+def shard_of(note_id, shards):
+    """Shard holding a note, from a hash of its id so consecutive ids spread evenly"""
+    return zlib.crc32(struct.pack('<q', note_id)) % shards
+
+class NoteConflict(Exception):
+    """Raised instead of overwriting notes another instance changed since this one last took in its changes"""
+    def __init__(self, note_ids):
+        self.note_ids = sorted(note_ids)
+        super().__init__(f"note{'s' if len(self.note_ids) > 1 else ''} {', '.join(map(str, self.note_ids))} "
+                         "changed in another window first; that version is kept")
+
+class ShardServer:
+    """One shard's SQLite database, answering requests inside its own worker process"""
+    # Every write transaction bumps the shard's version and stamps the notes it touched with it
+    schema = """
+        CREATE TABLE IF NOT EXISTS note_versions (
+            note_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL,
+            instance TEXT NOT NULL,
+            deleted INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS note_versions_version ON note_versions (version);
+    """
+    
+    def __init__(self, path, lazy):
+        self.storage = SQLiteStorage(path, legacy_json_path=None, lazy=lazy)
+        self.conn = self.storage.conn
+        with self.conn:
+            self.conn.executescript(self.schema)
+        self.search_index = FTSSearchIndex(self.storage)
+        self.duplicate_index = SQLiteDuplicateIndex(self.storage)
+        
+    @contextlib.contextmanager
+    def snapshot(self):
+        """A read transaction, so every query in it sees the shard as of one moment"""
+        self.conn.execute('BEGIN')
+        try:
+            yield
+        finally:
+            self.conn.commit()
+            
+    @contextlib.contextmanager
+    def transaction(self):
+        """A write transaction holding the shard's lock from the start, so checks and writes are atomic across instances"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        with self.conn:
+            yield
+            
+    def version(self):
+        return int(self.storage.get_meta('version') or 0)
+        
+    def next_version(self):
+        version = self.version() + 1
+        self.storage.set_meta('version', version)
+        return version
+        
+    def note_id_counter(self):
+        return int(self.storage.get_meta('note_id_counter') or 1)
+        
+    def mark(self, note_ids, version, instance, deleted=False):
+        self.conn.executemany('INSERT OR REPLACE INTO note_versions (note_id, version, instance, deleted) '
+                              'VALUES (?, ?, ?, ?)', [(note_id, version, instance, int(deleted)) for note_id in note_ids])
+                              
+    def conflicts(self, note_ids, instance, synced):
+        """Those of note_ids that another instance wrote after version synced"""
+        note_ids = list(note_ids)
+        conflicts = set()
+        for start in range(0, len(note_ids), 500):
+            chunk = note_ids[start:start + 500]
+            conflicts.update(note_id for (note_id,) in self.conn.execute(
+                f"SELECT note_id FROM note_versions WHERE note_id IN ({', '.join('?' * len(chunk))}) "
+                "AND version > ? AND instance != ?", chunk + [synced, instance]))
+        return conflicts
+        
+    def load_rows(self, include_content):
+        columns = self.storage.load_columns(include_content)
+        with self.snapshot():
+            rows = list(self.storage.note_rows(columns))
+            return self.version(), self.note_id_counter(), columns, rows
+            
+    def changes_since(self, version, instance, include_content):
+        """Rows of notes other instances saved after version, and the ids of those they deleted"""
+        columns = self.storage.load_columns(include_content)
+        with self.snapshot():
+            changed = self.conn.execute('SELECT note_id, deleted FROM note_versions WHERE version > ? AND instance != ?',
+                                        (version, instance)).fetchall()
+            saved = [note_id for note_id, deleted in changed if not deleted]
+            rows = []
+            for start in range(0, len(saved), 500):
+                chunk = saved[start:start + 500]
+                rows.extend(self.storage.note_rows(columns, f"WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+            deleted = [note_id for note_id, deleted in changed if deleted]
+            return self.version(), self.note_id_counter(), columns, rows, deleted
+            
+    def load_content(self, note_id):
+        return self.storage.load_content(note_id)
+        
+    def load_contents(self, note_ids):
+        return self.storage.load_contents(note_ids)
+        
+    def save_notes(self, notes, note_id_counter, instance, synced):
+        """Write the notes nobody else changed since version synced; returns the ids of the others"""
+        with self.transaction():
+            conflicts = self.conflicts([note['id'] for note in notes], instance, synced)
+            saved = [note for note in notes if note['id'] not in conflicts]
+            for note in saved:
+                self.storage.write_note(note)
+                if self.search_index.vocabulary is not None:
+                    self.search_index.add_note(Note.from_dict(note))
+            self.mark([note['id'] for note in saved], self.next_version(), instance)
+            self.storage.set_meta('note_id_counter', max(note_id_counter, self.note_id_counter()))
+        return sorted(conflicts)
+        
+    def save_reviews(self, reviews, instance):
+        # Reviews only touch the schedule columns, so the latest one simply wins
+        with self.transaction():
+            self.conn.executemany('UPDATE notes SET last_reviewed = ?, next_review = ?, streak = ? WHERE id = ?',
+                                  [(last_reviewed, next_review, streak, note_id)
+                                   for note_id, last_reviewed, next_review, streak in reviews])
+            self.mark([note_id for note_id, _, _, _ in reviews], self.next_version(), instance)
+            
+    def delete_notes(self, note_ids, instance, synced):
+        with self.transaction():
+            conflicts = self.conflicts(note_ids, instance, synced)
+            deleted = [note_id for note_id in note_ids if note_id not in conflicts]
+            self.conn.executemany('DELETE FROM notes WHERE id = ?', [(note_id,) for note_id in deleted])
+            self.conn.executemany('DELETE FROM note_tags WHERE note_id = ?', [(note_id,) for note_id in deleted])
+            self.mark(deleted, self.next_version(), instance, deleted=True)
+        return sorted(conflicts)
+        
+    def replace_all(self, notes, note_id_counter, instance):
+        with self.transaction():
+            version = self.next_version()
+            self.conn.execute('INSERT OR REPLACE INTO note_versions (note_id, version, instance, deleted) '
+                              'SELECT id, ?, ?, 1 FROM notes', (version, instance))
+            self.conn.execute('DELETE FROM notes')
+            self.conn.execute('DELETE FROM note_tags')
+            for note in notes:
+                self.storage.write_note(note)
+            self.mark([note['id'] for note in notes], version, instance)
+            self.storage.set_meta('note_id_counter', note_id_counter)
+            
+    def save_note_id_counter(self, note_id_counter):
+        with self.transaction():
+            self.storage.set_meta('note_id_counter', max(note_id_counter, self.note_id_counter()))
+            
+    def reserve_ids(self, first, count):
+        """Set aside count ids from first on, or later if another instance already took them"""
+        with self.transaction():
+            first = max(first, int(self.storage.get_meta('reserved_id') or 1))
+            self.storage.set_meta('reserved_id', first + count)
+        return first
+        
+    def ranked_rows(self, query, limit, fuzzy):
+        return self.search_index.ranked_rows(query, limit, fuzzy=fuzzy)
+        
+    def search(self, query, fuzzy):
+        return self.search_index.search(query, fuzzy)
+        
+    def suggestions(self, query, limit):
+        return self.search_index.suggestions(query, limit)
+        
+    def stored_duplicates(self, fingerprint):
+        return {note_id: similarity for note_id, similarity in self.duplicate_index.stored_duplicates(fingerprint).items()
+                if similarity >= self.duplicate_index.threshold}
+                
+    def duplicate_buckets(self):
+        """(content hash, ids) and (LSH band, ids) for every bucket, ids comma separated, to merge across shards"""
+        hashes = self.conn.execute("SELECT content_hash, group_concat(note_id) FROM note_signatures "
+                                   "WHERE signature != x'' GROUP BY content_hash").fetchall()
+        bands = self.conn.execute('SELECT band, group_concat(note_id) FROM note_bands GROUP BY band').fetchall()
+        return hashes, bands
+        
+    def signatures(self, note_ids):
+        return self.duplicate_index.signatures(note_ids)
+        
+    def backfill_fingerprints(self, batch_size):
+        return self.storage.backfill_fingerprints(batch_size)
+        
+    def flush(self):
+        self.storage.flush()
+        
+    def close(self):
+        self.storage.close()
+
+def answer(server, connection):
+    """Reply to the (method, arguments) requests sent over one pipe until sent None"""
+    for method, args in iter(connection.recv, None):
+        try:
+            reply = (True, getattr(server, method)(*args))
+        except Exception as e:
+            reply = (False, e)
+        try:
+            connection.send(reply)
+        except Exception as e:  # A result or error that cannot be pickled
+            connection.send((False, RuntimeError(f"{method} failed: {e}")))
+            
+def serve_shard(path, lazy, connection, reads):
+    """Worker process for one shard; note bodies are read over a pipe and thread of their own"""
+    try:
+        server = ShardServer(path, lazy)
+    except Exception as e:
+        connection.send((False, e))
+        return
+    connection.send((True, None))
+    # With its own SQLite connection the reader is not held up by a write transaction in progress
+    reader = threading.Thread(target=answer, args=(server, reads), daemon=True)
+    reader.start()
+    answer(server, connection)
+    reader.join()
+    server.close()
+
+class ShardClient:
+    """Pipes to one shard's worker process; each pipe's lock keeps every request on it paired with its reply"""
+    def __init__(self, context, path, lazy):
+        self.connection, child = context.Pipe()
+        self.reads, child_reads = context.Pipe()  # Note bodies only, so opening a note never waits behind a write
+        self.process = context.Process(target=serve_shard, args=(path, lazy, child, child_reads),
+                                       name=os.path.splitext(os.path.basename(path))[0], daemon=True)
+        self.process.start()
+        child.close()
+        child_reads.close()
+        self.lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        
+    def pipe(self, reads=False):
+        """(connection, lock) of the request pipe, or of the note body pipe"""
+        return (self.reads, self.read_lock) if reads else (self.connection, self.lock)
+        
+    def receive(self, connection=None):
+        try:
+            ok, result = (connection or self.connection).recv()
+        except EOFError:
+            self.process.join(1)
+            raise RuntimeError(f"{self.process.name} stopped (exit code {self.process.exitcode})") from None
+        if not ok:
+            raise result
+        return result
+        
+    def call(self, method, *args, reads=False):
+        connection, lock = self.pipe(reads)
+        with lock:
+            connection.send((method, args))
+            return self.receive(connection)
+            
+    def close(self):
+        with self.lock, self.read_lock:
+            with contextlib.suppress(OSError):  # The worker may already be gone
+                self.reads.send(None)
+                self.connection.send(None)
+            self.process.join()
+            self.connection.close()
+            self.reads.close()
+
+class ShardedStorage:
+    """Notes split by id hash over several SQLite shards, each served by a worker process of its own"""
+    def __init__(self, directory='knowledge_organizer_shards', shards=4, lazy=True,
+                 legacy_db_path='knowledge_organizer_data.db', legacy_json_path='knowledge_organizer_data.json'):
+        self.directory = directory
+        self.lazy = lazy
+        self.shared = True  # Other instances may write to the shards too; changes() brings in what they did
+        self.instance = uuid.uuid4().hex
+        os.makedirs(directory, exist_ok=True)
+        
+        # Where a note lives depends on the number of shards, so the first count chosen stays
+        manifest_path = os.path.join(directory, 'manifest.json')
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('format') != SHARDS_FORMAT:
+                raise ValueError(f"{manifest_path} is not a sharded knowledge base manifest")
+            self.shards = manifest['shards']
+        except FileNotFoundError:
+            manifest = None
+            self.shards = shards
+            
+        self.review_log = ReviewLog(os.path.join(directory, 'reviews'))
+        # Forking would copy the threads and locks of a running app into the workers
+        context = multiprocessing.get_context('spawn')
+        self.clients = [ShardClient(context, os.path.join(directory, f'shard-{i}.db'), lazy) for i in range(self.shards)]
+        try:
+            for client in self.clients:
+                client.receive()
+        except Exception:
+            self.close()
+            raise
+        self.synced = [0] * self.shards  # Per shard, the version whose changes the notes in memory include
+        if manifest is None:
+            self.migrate(legacy_db_path, legacy_json_path)
+            with open(manifest_path, 'w') as f:
+                json.dump({'format': SHARDS_FORMAT, 'shards': self.shards}, f)
+                
+    def migrate(self, legacy_db_path, legacy_json_path):
+        """One-time import of the single-file SQLite or JSON data; those files are left untouched"""
+        if legacy_db_path and os.path.exists(legacy_db_path):
+            legacy = SQLiteStorage(legacy_db_path, legacy_json_path=None, lazy=False)
+        elif legacy_json_path and os.path.exists(legacy_json_path):
+            legacy = JSONStorage(legacy_json_path)
+        else:
+            return
+        notes, note_id_counter = legacy.load()
+        legacy.close()
+        self.replace_all([note.to_dict() for note in notes], note_id_counter)
+        if os.path.exists(legacy.review_log.path):
+            shutil.copyfile(legacy.review_log.path, self.review_log.path)
+            
+    def gather(self, method, requests, reads=False):
+        """Send every (shard, arguments) request at once, then collect the replies; the shards work in parallel"""
+        # Locks are always taken in shard order, so concurrent gathers cannot deadlock
+        clients = [(self.clients[shard], args) for shard, args in sorted(requests, key=lambda request: request[0])]
+        pipes = [client.pipe(reads) for client, _ in clients]
+        with contextlib.ExitStack() as locks:
+            for _, lock in pipes:
+                locks.enter_context(lock)
+            for (connection, _), (_, args) in zip(pipes, clients):
+                connection.send((method, args))
+            replies = []
+            error = None
+            for (connection, _), (client, _) in zip(pipes, clients):
+                # Every reply is read, even after an error, so no pipe is left out of step
+                try:
+                    replies.append(client.receive(connection))
+                except Exception as e:
+                    replies.append(None)
+                    error = error or e
+        if error:
+            raise error
+        return replies
+        
+    def gather_all(self, method, *args):
+        return self.gather(method, [(shard, args) for shard in range(self.shards)])
+        
+    def by_shard(self, items, note_id=lambda item: item):
+        groups = defaultdict(list)
+        for item in items:
+            groups[shard_of(note_id(item), self.shards)].append(item)
+        return groups
+        
+    def load(self, include_content=None):
+        notes = []
+        note_id_counter = 1
+        for shard, (version, counter, columns, rows) in enumerate(self.gather_all('load_rows', include_content)):
+            self.synced[shard] = version
+            note_id_counter = max(note_id_counter, counter)
+            notes.append([SQLiteStorage.row_note(columns, row) for row in rows])
+        return list(heapq.merge(*notes, key=lambda note: note.id)), note_id_counter
+        
+    def changes(self):
+        """(notes other instances saved, ids they deleted, note id counter, shard versions) since the versions synced"""
+        replies = self.gather('changes_since', [(shard, (self.synced[shard], self.instance, None))
+                                                for shard in range(self.shards)])
+        changed = []
+        deleted = []
+        note_id_counter = 1
+        versions = []
+        for version, counter, columns, rows, deleted_ids in replies:
+            versions.append(version)
+            note_id_counter = max(note_id_counter, counter)
+            changed.extend(SQLiteStorage.row_note(columns, row) for row in rows)
+            deleted.extend(deleted_ids)
+        return changed, deleted, note_id_counter, versions
+        
+    def mark_synced(self, versions):
+        """Record that the notes in memory now include the changes up to versions, as returned by changes()"""
+        self.synced = list(versions)
+        
+    def load_content(self, note_id):
+        return self.clients[shard_of(note_id, self.shards)].call('load_content', note_id, reads=True)
+        
+    def load_contents(self, note_ids):
+        contents = {}
+        for reply in self.gather('load_contents', [(shard, (ids,)) for shard, ids in self.by_shard(note_ids).items()],
+                                 reads=True):
+            contents.update(reply)
+        return contents
+        
+    def create_search_index(self, notes):
+        return ShardedSearchIndex(self)
+        
+    def create_duplicate_index(self, notes):
+        return ShardedDuplicateIndex(self)
+        
+    def create_review_scheduler(self, notes):
+        # Kept in memory like SQLiteStorage's, so due notes never wait on the shards; refreshes bring in other reviews
+        scheduler = ReviewScheduler()
+        scheduler.rebuild(notes)
+        return scheduler
+        
+    def backfill_fingerprints(self, batch_size=1000):
+        return any(self.gather_all('backfill_fingerprints', batch_size))
+        
+    def reserve_ids(self, first, count):
+        # Notes imported with their own ids may have moved some shard's counter past the reservations
+        first = max([first] + self.gather_all('note_id_counter'))
+        return self.clients[0].call('reserve_ids', first, count)
+        
+    def save_note(self, note, note_id_counter):
+        self.save_notes([note], note_id_counter)
+        
+    def save_notes(self, notes, note_id_counter):
+        groups = self.by_shard(notes, lambda note: note['id'])
+        replies = self.gather('save_notes', [(shard, (group, note_id_counter, self.instance, self.synced[shard]))
+                                             for shard, group in groups.items()])
+        conflicts = [note_id for reply in replies for note_id in reply]
+        if conflicts:
+            raise NoteConflict(conflicts)
+            
+    def save_note_id_counter(self, note_id_counter):
+        # Loading takes the highest counter of any shard
+        self.clients[0].call('save_note_id_counter', note_id_counter)
+        
+    def save_review(self, note_id, last_reviewed, next_review, streak):
+        self.save_reviews([(note_id, last_reviewed, next_review, streak)])
+        
+    def save_reviews(self, reviews):
+        groups = self.by_shard(reviews, lambda review: review[0])
+        self.gather('save_reviews', [(shard, (group, self.instance)) for shard, group in groups.items()])
+        
+    def log_reviews(self, events):
+        self.review_log.extend(events)
+        
+    def delete_note(self, note_id):
+        shard = shard_of(note_id, self.shards)
+        conflicts = self.clients[shard].call('delete_notes', [note_id], self.instance, self.synced[shard])
+        if conflicts:
+            raise NoteConflict(conflicts)
+            
+    def replace_all(self, notes, note_id_counter):
+        groups = self.by_shard(notes, lambda note: note['id'])
+        self.gather('replace_all', [(shard, (groups[shard], note_id_counter, self.instance))
+                                    for shard in range(self.shards)])
+                                    
+    def sync(self):
+        # Every shard commits each change as its own transaction
+        self.review_log.sync()
+        
+    def flush(self):
+        self.gather_all('flush')
+        
+    def close(self):
+        for client in self.clients:
+            client.close()
+        self.clients = []
+        self.review_log.close()
+
+class ShardedSearchIndex:
+    """FTSSearchIndex counterpart asking every shard at once and merging their answers"""
+    def __init__(self, storage):
+        self.storage = storage
+        
+    def snapshot(self):
+        return self
+        
+    # Each shard indexes its notes as they are stored
+    def add_note(self, note):
+        pass
+        
+    def remove_note(self, note):
+        pass
+        
+    def rebuild(self, notes):
+        pass
+        
+    def search(self, query, fuzzy=False):
+        return sorted(note_id for ids in self.storage.gather_all('search', query, fuzzy) for note_id in ids)
+        
+    def ranked_search(self, query, limit, offset=0, cancelled=None, fuzzy=False):
+        if cancelled and cancelled():
+            raise SearchCancelled()
+        # Every shard ranks its own best matches; spreading notes by id hash keeps their bm25 statistics alike
+        replies = self.storage.gather_all('ranked_rows', query, offset + limit, fuzzy)
+        if cancelled and cancelled():
+            raise SearchCancelled()
+        rows = heapq.merge(*(rows for rows, _ in replies))
+        return [note_id for _, note_id in itertools.islice(rows, offset, offset + limit)], sum(total for _, total in replies)
+        
+    def suggestions(self, query, limit=8):
+        ranks = {}
+        for suggestions in self.storage.gather_all('suggestions', query, limit):
+            for rank, suggestion in enumerate(suggestions):
+                ranks[suggestion] = min(rank, ranks.get(suggestion, rank))
+        return sorted(ranks, key=lambda suggestion: (ranks[suggestion], suggestion))[:limit]
+
+class ShardedDuplicateIndex(SQLiteDuplicateIndex):
+    """SQLiteDuplicateIndex counterpart whose stored fingerprints are spread over the shards"""
+    def signatures(self, note_ids):
+        signatures = {}
+        for reply in self.storage.gather('signatures', [(shard, (ids,)) for shard, ids in
+                                                         self.storage.by_shard(note_ids).items()]):
+            signatures.update(reply)
+        return signatures
+        
+    def stored_duplicates(self, fingerprint):
+        found = {}
+        for reply in self.storage.gather_all('stored_duplicates', fingerprint):
+            found.update(reply)
+        return found
+        
+    def groups(self):
+        # A bucket may hold notes from several shards, so the shards' buckets are joined before grouping
+        exact = defaultdict(list)
+        bands = defaultdict(list)
+        for hashes, band_ids in self.storage.gather_all('duplicate_buckets'):
+            for content_hash, ids in hashes:
+                exact[content_hash].append(ids)
+            for band, ids in band_ids:
+                bands[band].append(ids)
+        buckets = [([int(i) for i in ','.join(ids).split(',')], exact_copies)
+                   for buckets, exact_copies in ((exact, True), (bands, False))
+                   for ids in buckets.values() if len(ids) > 1 or ',' in ids[0]]
+        signatures = self.signatures({note_id for ids, exact_copies in buckets if not exact_copies for note_id in ids})
+        return group_duplicates(buckets, signatures.get, self.threshold)
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import threading
+import unittest
+from knowledge_core import KnowledgeBase, SQLiteStorage, ContentCache
+
+class ContentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+        self.cache = ContentCache(self.load, capacity=2)
+        
+    def load(self, note_id):
+        self.loaded.append(note_id)
+        return f"stored {note_id}"
+        
+    def test_pinned_bodies_outlive_the_lru(self):
+        self.cache.pin(1, "saved 1")
+        for note_id in range(2, 6):
+            self.cache.get(note_id)
+        self.assertEqual(self.cache.get(1), "saved 1")
+        self.assertNotIn(1, self.loaded)
+        
+    def test_unpin_keeps_a_newer_save(self):
+        first = "first save"
+        self.cache.pin(1, first)
+        self.cache.pin(1, "second save")
+        self.cache.unpin([(1, first)])
+        self.assertEqual(self.cache.get(1), "second save")
+        self.cache.unpin([(1, "second save")])
+        self.assertNotIn(1, self.cache)
+
+class LazyContentTest(unittest.TestCase):
+    def test_queued_saves_are_read_back_before_they_are_stored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'notes.db')
+            kb = KnowledgeBase(SQLiteStorage(path, None))
+            note = kb.add_note("Original", [], "original body")
+            kb.close()
+            
+            kb = KnowledgeBase(SQLiteStorage(path, None))
+            try:
+                gate = threading.Event()
+                kb.store(gate.wait)  # Holds every later write in the queue
+                kb.edit_note(note.id, "Edited", [], "edited body")
+                added = kb.add_note("Added", [], "added body")
+                self.assertEqual(sorted(kb.content_cache.dirty), [note.id, added.id])
+                kb.content_cache.entries.clear()
+                self.assertEqual(kb.note_content(kb.notes.get(note.id)), "edited body")
+                self.assertEqual(kb.note_content(added), "added body")
+                
+                gate.set()
+                kb.persistence.drain()
+                self.assertEqual(kb.content_cache.dirty, {})
+                kb.content_cache.entries.clear()
+                self.assertEqual(kb.note_content(kb.notes.get(note.id)), "edited body")
+                self.assertEqual(kb.note_content(added), "added body")
+            finally:
+                kb.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import tempfile
+import unittest
+from knowledge_core import KnowledgeBase, JSONStorage, SQLiteStorage, TrigramIndex
+
+class TrigramIndexTest(unittest.TestCase):
+    words = ['python', 'search', 'review', 'memory', 'number', 'alpha', 'body', 'gradient']
+    
+    def setUp(self):
+        self.index = TrigramIndex()
+        self.index.rebuild((word, 1) for word in self.words)
+        
+    def test_swapped_letters_anywhere_in_the_word(self):
+        for word in self.words:
+            for i in range(len(word) - 1):
+                typo = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+                if typo != word:
+                    self.assertIn(word, self.index.similar(typo), typo)
+                    
+    def test_substitution_and_deletion(self):
+        self.assertEqual(self.index.similar('revuew'), ['review'])
+        self.assertEqual(self.index.similar('gradent'), ['gradient'])
+        
+    def test_short_words_are_exact(self):
+        self.assertEqual(self.index.similar('bdy'), [])
+
+class FuzzySearchTest(unittest.TestCase):
+    def check_backend(self, storage):
+        kb = KnowledgeBase(storage)
+        try:
+            note = kb.add_note("Learning python", ['code'], "A search through the review notes")
+            kb.persistence.drain()
+            for typo in ('pyhton', 'serach', 'reivew'):
+                notes, total = kb.search(typo, fuzzy=True)
+                self.assertEqual([n.id for n in notes], [note.id], typo)
+        finally:
+            kb.close()
+            
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(SQLiteStorage(os.path.join(directory, 'notes.db'), None))
+            
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(JSONStorage(os.path.join(directory, 'notes.json'), os.path.join(directory, 'index.json')))
+
+if __name__ == '__main__':
+    unittest.main()
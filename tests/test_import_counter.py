@@ -0,0 +1,41 @@
+import os
+import tempfile
+import unittest
+from knowledge_core import KnowledgeBase, JSONStorage, SQLiteStorage
+
+class ImportCounterTest(unittest.TestCase):
+    def check_backend(self, open_storage, directory):
+        source = KnowledgeBase(SQLiteStorage(os.path.join(directory, 'source.db'), None))
+        try:
+            source.add_note("Kept", ['a'], "An imported note")
+            source.note_id_counter = 50  # Ids up to here were handed out and deleted before the export
+            archive = os.path.join(directory, 'notes.json')
+            source.export_archive(archive)
+        finally:
+            source.close()
+            
+        kb = KnowledgeBase(open_storage())
+        try:
+            self.assertEqual(kb.import_archive(archive), 1)
+            self.assertEqual(kb.note_id_counter, 50)
+        finally:
+            kb.close()
+            
+        kb = KnowledgeBase(open_storage())
+        try:
+            self.assertEqual(kb.note_id_counter, 50)
+            self.assertEqual(kb.add_note("New", [], "").id, 50)
+        finally:
+            kb.close()
+            
+    def test_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(lambda: SQLiteStorage(os.path.join(directory, 'notes.db'), None), directory)
+            
+    def test_json(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.check_backend(lambda: JSONStorage(os.path.join(directory, 'data.json'),
+                                                   os.path.join(directory, 'index.json')), directory)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from knowledge_core import JSONStorage
+
+def record(note_id, title, streak=0):
+    return {'id': note_id, 'title': title, 'tags': ['t'], 'content': f"{title} body", 'created': '2024-01-01',
+            'last_reviewed': '2024-01-01', 'next_review': '2024-01-02', 'streak': streak}
+
+class JSONJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'data.json')
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def open(self, compact_after=2000):
+        return JSONStorage(self.path, os.path.join(self.directory.name, 'index.json'), compact_after=compact_after)
+        
+    def load(self):
+        storage = self.open()
+        try:
+            notes, note_id_counter = storage.load()
+        finally:
+            storage.close()
+        return {note.id: note for note in notes}, note_id_counter
+        
+    def test_journal_replays_on_top_of_the_snapshot(self):
+        storage = self.open()
+        storage.replace_all([record(1, "One"), record(2, "Two")], 3)
+        storage.save_note(record(3, "Three"), 4)
+        storage.save_note(record(1, "One edited"), 4)
+        storage.save_review(2, '2024-02-01', '2024-02-05', 4)
+        storage.delete_note(3)
+        storage.save_note_id_counter(9)
+        storage.sync()
+        storage.close()
+        
+        notes, note_id_counter = self.load()
+        self.assertEqual(sorted(notes), [1, 2])
+        self.assertEqual(notes[1].title, "One edited")
+        self.assertEqual((notes[2].next_review, notes[2].streak), ('2024-02-05', 4))
+        self.assertEqual(note_id_counter, 9)
+        
+    def test_torn_final_record_is_ignored(self):
+        storage = self.open()
+        storage.save_note(record(1, "One"), 2)
+        storage.sync()
+        storage.close()
+        with open(storage.journal_path, 'a') as f:
+            f.write('{"op":"save","note":{"id":2')
+            
+        notes, _ = self.load()
+        self.assertEqual(sorted(notes), [1])
+        
+    def test_compaction_folds_the_journal_into_the_snapshot(self):
+        storage = self.open(compact_after=3)
+        for note_id in range(1, 4):
+            storage.save_note(record(note_id, f"Note {note_id}"), note_id + 1)
+        storage.sync()
+        self.assertEqual(os.path.getsize(storage.journal_path), 0)
+        self.assertEqual(storage.journal_records, 0)
+        with open(self.path) as f:
+            snapshot = json.load(f)
+        self.assertEqual([note['id'] for note in snapshot['notes']], [1, 2, 3])
+        self.assertEqual(snapshot['generation'], 1)
+        
+        storage.save_note(record(4, "Note 4"), 5)
+        storage.sync()
+        storage.close()
+        notes, note_id_counter = self.load()
+        self.assertEqual(sorted(notes), [1, 2, 3, 4])
+        self.assertEqual(note_id_counter, 5)
+        
+    def test_journal_older_than_the_snapshot_is_skipped(self):
+        storage = self.open()
+        storage.save_note(record(1, "Old title"), 2)
+        storage.sync()
+        journal = storage.journal_path + '.old'
+        shutil.copyfile(storage.journal_path, journal)
+        storage.save_note(record(1, "New title"), 2)
+        storage.compact()
+        storage.close()
+        
+        # A crash after the new snapshot was renamed into place but before the journal was emptied
+        shutil.copyfile(journal, storage.journal_path)
+        notes, _ = self.load()
+        self.assertEqual(notes[1].title, "New title")
+
+if __name__ == '__main__':
+    unittest.main()
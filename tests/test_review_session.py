@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from knowledge_core import KnowledgeBase, SQLiteStorage
+
+def due_records(count):
+    return [{'id': i, 'title': f"Card {i}", 'tags': ['deck'], 'content': f"Answer {i}", 'created': '2024-01-01',
+             'last_reviewed': '2024-01-01', 'next_review': '2024-01-02', 'streak': i % 3} for i in range(1, count + 1)]
+
+class ReviewSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'notes.db')
+        kb = self.open()
+        kb.add_records(due_records(30))
+        kb.close()
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def open(self):
+        return KnowledgeBase(SQLiteStorage(self.path, None))
+        
+    def answer(self, session, count):
+        """Answer count cards 'good'; returns the streak each note had before"""
+        before = {}
+        for _ in range(count):
+            note = session.current()
+            before[note.id] = note.streak
+            session.answer('good')
+        return before
+        
+    def test_resume_after_a_crash_applies_every_answer_once(self):
+        kb = self.open()
+        session = kb.review_session()
+        session.batch_size = 5
+        before = self.answer(session, 7)
+        # The first batch is stored but its commit record is not written yet, and two answers are still pending
+        kb.persistence.drain()
+        session.journal.close()
+        kb.close()
+        
+        for _ in range(2):
+            kb = self.open()
+            session = kb.review_session(start=False)
+            self.assertEqual(session.position, 7)
+            self.assertEqual(session.reviewed, 7)
+            self.assertEqual({note_id: kb.notes.get(note_id).streak for note_id in before},
+                             {note_id: streak + 1 for note_id, streak in before.items()})
+            session.close()
+            kb.close()
+            
+    def test_resume_carries_on_with_the_next_card(self):
+        kb = self.open()
+        session = kb.review_session()
+        queue = list(session.queue)
+        self.answer(session, 3)
+        session.close()
+        kb.close()
+        
+        kb = self.open()
+        session = kb.review_session()
+        self.assertEqual(session.queue, queue)
+        self.assertEqual(session.current().id, queue[3])
+        session.finish()
+        self.assertFalse(os.path.exists(session.path))
+        self.assertIsNone(kb.review_session(start=False))
+        kb.close()
+        
+    def test_torn_final_record_is_ignored(self):
+        kb = self.open()
+        session = kb.review_session()
+        before = self.answer(session, 2)
+        session.close()
+        with open(session.path, 'a') as f:
+            f.write('{"op":"answer","posi')
+        kb.close()
+        
+        kb = self.open()
+        session = kb.review_session()
+        self.assertEqual(session.position, 2)
+        self.assertEqual({note_id: kb.notes.get(note_id).streak for note_id in before},
+                         {note_id: streak + 1 for note_id, streak in before.items()})
+        session.finish()
+        kb.close()
+
+if __name__ == '__main__':
+    unittest.main()
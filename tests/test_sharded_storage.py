@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from knowledge_core import KnowledgeBase
+from sharded_storage import ShardedStorage, NoteConflict
+
+class ShardedConflictTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.a = self.open()
+        self.b = self.open()
+        self.note = self.a.add_note("Shared", ['team'], "First version")
+        self.a.persistence.drain()
+        self.b.refresh()
+        
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+        self.directory.cleanup()
+        
+    def open(self):
+        return KnowledgeBase(ShardedStorage(os.path.join(self.directory.name, 'shards'), shards=2,
+                                            legacy_db_path=None, legacy_json_path=None))
+                                            
+    def edit(self, kb, title):
+        kb.edit_note(self.note.id, title, ['team'], f"{title} text")
+        kb.persistence.drain()
+        return kb.storage_error()
+        
+    def test_edit_of_a_note_changed_elsewhere_is_refused(self):
+        self.assertIsNone(self.edit(self.a, "From a"))
+        error = self.edit(self.b, "From b")
+        self.assertIsInstance(error, NoteConflict)
+        self.assertEqual(error.note_ids, [self.note.id])
+        # The stored version is kept, and b takes it in on its next refresh
+        self.assertEqual(self.b.refresh(), {self.note.id})
+        self.assertEqual(self.b.notes.get(self.note.id).title, "From a")
+        self.assertEqual(self.b.note_content(self.b.notes.get(self.note.id)), "From a text")
+        
+    def test_edit_after_taking_in_the_changes_is_stored(self):
+        self.assertIsNone(self.edit(self.a, "From a"))
+        self.b.refresh()
+        self.assertIsNone(self.edit(self.b, "From b"))
+        self.assertEqual(self.a.refresh(), {self.note.id})
+        self.assertEqual(self.a.notes.get(self.note.id).title, "From b")
+        
+    def test_delete_of_a_note_changed_elsewhere_is_refused(self):
+        self.assertIsNone(self.edit(self.a, "From a"))
+        self.b.delete_note(self.note.id)
+        self.b.persistence.drain()
+        self.assertIsInstance(self.b.storage_error(), NoteConflict)
+        self.b.refresh()
+        self.assertIn(self.note.id, self.b.notes)
+        
+    def test_own_writes_never_conflict(self):
+        self.assertIsNone(self.edit(self.a, "Again"))
+        self.assertIsNone(self.edit(self.a, "And again"))
+        self.assertEqual(self.b.refresh(), {self.note.id})
+
+if __name__ == '__main__':
+    unittest.main()